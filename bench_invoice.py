@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+合成发票语料 + 吞吐基准（完全离线）：
+- 按 roi_config.json 的ROI位置生成 N 页合成发票PDF（已知票号/日期/金额），
+  vector=矢量文字版；scanned=渲染成图片后加噪声、轻微倾斜再放回PDF（模拟扫描件）
+- 页面按配置中的 rotate 反向旋转存放，识别时按 rotate 转回正向，和真实扫描件一致
+- 跑 invoice_core.extract_pdf_to_rows，统计 页/秒、单页耗时 p50/p95、峰值内存(RSS)、字段准确率、分阶段耗时
+- 结果保存为JSON，--compare 与上一次（如另一个提交）的结果对比
+
+用法：
+python bench_invoice.py --pages 20 --out bench.json
+python bench_invoice.py --pages 20 --variant scanned --render_mode clip --out new.json --compare bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import cv2
+import fitz  # PyMuPDF
+import numpy as np
+
+import invoice_core as core
+from invoice_timing import StageTimer
+
+VARIANTS = ("vector", "scanned")
+# 正向（旋转纠正后）发票页面尺寸：A4横向，单位pt
+PAGE_W, PAGE_H = 842, 595
+# 配置中的 rotate -> 存放时页面的 /Rotate（渲染后再按 rotate 转回正向）
+STORE_ROTATION = {"0": 0, "cw90": 270, "ccw90": 90, "180": 180}
+FIELD_LABEL_TEXT = {"invoice_no": "发票号码：", "invoice_date": "开票日期：", "total_amount": "（小写）"}
+# 准确率统计的字段 -> 结果行的列名
+FIELD_COLS = {"invoice_no": "票号20位", "invoice_date": "开票日期", "total_amount": "价税合计"}
+
+
+# ------------------ 合成语料 ------------------
+def random_truth(rng: random.Random):
+    """一页的真值（与 invoice_core 归一化后的格式一致）+ 印在页面上的文字"""
+    inv = "".join(rng.choice("0123456789") for _ in range(20))
+    y, m, d = rng.randint(2019, 2026), rng.randint(1, 12), rng.randint(1, 28)
+    amt = rng.randint(100, 9_999_999) / 100.0
+    truth = {"invoice_no": inv, "invoice_date": f"{y:04d}{m:02d}{d:02d}", "total_amount": f"{amt:.2f}"}
+    printed = {"invoice_no": inv, "invoice_date": f"{y:04d}年{m:02d}月{d:02d}日", "total_amount": f"¥{amt:.2f}"}
+    return truth, printed
+
+
+def text_runs(text: str):
+    """拆成 (片段, 字体)：ASCII 用 helv，中文/全角用 china-s（china-s 的数字是全角字形，与真实发票不符）"""
+    runs = []
+    for ch in text:
+        font = "helv" if ord(ch) < 128 else "china-s"
+        if runs and runs[-1][1] == font:
+            runs[-1][0] += ch
+        else:
+            runs.append([ch, font])
+    return runs
+
+
+def fit_text(page: fitz.Page, rect: fitz.Rect, text: str):
+    """在rect内左对齐、垂直居中写一行字，字号按框高和框宽自动缩放"""
+    runs = text_runs(text)
+    unit = sum(fitz.get_text_length(t, fontname=f, fontsize=1) for t, f in runs)
+    size = min(rect.height * 0.6, rect.width * 0.92 / max(unit, 1e-6))
+    x = rect.x0 + rect.width * 0.03
+    y = rect.y0 + (rect.height + size * 0.7) / 2
+    for t, f in runs:
+        page.insert_text((x, y), t, fontsize=size, fontname=f)
+        x += fitz.get_text_length(t, fontname=f, fontsize=size)
+
+
+def draw_invoice_page(doc: fitz.Document, cfg, printed):
+    """正向坐标下画一页：标题、表格线、三个字段（ROI内）及其标签（ROI左侧）"""
+    page = doc.new_page(width=PAGE_W, height=PAGE_H)
+    page.insert_text((PAGE_W * 0.36, PAGE_H * 0.09), "电子发票（普通发票）", fontsize=20, fontname="china-s")
+    page.draw_rect(fitz.Rect(PAGE_W * 0.05, PAGE_H * 0.22, PAGE_W * 0.95, PAGE_H * 0.78), width=0.8)
+    for k in range(1, 6):
+        y = PAGE_H * (0.22 + k * 0.09)
+        page.draw_line((PAGE_W * 0.05, y), (PAGE_W * 0.95, y), width=0.5)
+    page.insert_text((PAGE_W * 0.08, PAGE_H * 0.30), "购买方信息  名称：某某科技有限公司", fontsize=10, fontname="china-s")
+    page.insert_text((PAGE_W * 0.08, PAGE_H * 0.48), "项目名称  规格型号  单位  数量  单价  金额  税率  税额",
+                     fontsize=10, fontname="china-s")
+
+    for f in core.ROI_FIELDS:
+        b = cfg[f]
+        rect = fitz.Rect(b["x1"] * PAGE_W, b["y1"] * PAGE_H, b["x2"] * PAGE_W, b["y2"] * PAGE_H)
+        fit_text(page, rect, printed[f])
+        label = FIELD_LABEL_TEXT[f]
+        size = rect.height * 0.45
+        lw = fitz.get_text_length(label, fontname="china-s", fontsize=size)
+        page.insert_text((rect.x0 - lw - 4, rect.y0 + (rect.height + size * 0.7) / 2), label,
+                         fontsize=size, fontname="china-s")
+    page.set_rotation(STORE_ROTATION[core.canonical_rotate(cfg.get("rotate", "0"))])
+    return page
+
+
+def scan_page(out: fitz.Document, page: fitz.Page, dpi: int, noise: float, skew: float, rng: random.Random):
+    """把矢量页渲染成灰度图，加倾斜和高斯噪声，JPEG后作为整页图片放进 out（模拟扫描件）"""
+    pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+    img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width).copy()
+    angle = rng.uniform(-skew, skew) if skew else 0.0
+    if angle:
+        M = cv2.getRotationMatrix2D((img.shape[1] / 2, img.shape[0] / 2), angle, 1.0)
+        img = cv2.warpAffine(img, M, (img.shape[1], img.shape[0]), borderValue=255)
+    if noise:
+        nrng = np.random.default_rng(rng.randrange(2 ** 32))
+        img = np.clip(img.astype(np.float32) + nrng.normal(0, noise, img.shape), 0, 255).astype(np.uint8)
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    dst = out.new_page(width=page.rect.width, height=page.rect.height)
+    dst.insert_image(dst.rect, stream=buf.tobytes())
+    return angle
+
+
+def make_corpus(path: str, cfg, pages: int, variant: str, seed: int = 0, dpi: int = 200,
+                noise: float = 8.0, skew: float = 1.0):
+    """生成合成发票PDF，返回每页真值列表"""
+    rng = random.Random(f"{seed}-{variant}")
+    vec = fitz.open()
+    truths = []
+    for _ in range(pages):
+        truth, printed = random_truth(rng)
+        draw_invoice_page(vec, cfg, printed)
+        truths.append(truth)
+
+    if variant == "vector":
+        vec.save(path)
+    else:
+        out = fitz.open()
+        for page in vec:
+            scan_page(out, page, dpi, noise, skew, rng)
+        out.save(path, deflate=True)
+        out.close()
+    vec.close()
+    return truths
+
+
+# ------------------ 基准 ------------------
+def peak_rss_mb():
+    """本进程及已结束子进程的峰值RSS（MB）；Windows 无 resource 模块时返回 None"""
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    # Linux 单位KB，macOS 单位字节
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    self_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    child_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return round(self_mb, 1), round(child_mb, 1)
+
+
+def percentile(values, q: float):
+    if not values:
+        return None
+    return round(float(np.percentile(values, q)), 4)
+
+
+def field_accuracy(rows, truths):
+    hits = {f: 0 for f in core.ROI_FIELDS}
+    pages_ok = 0
+    for row, truth in zip(rows, truths):
+        ok = True
+        for f, col in FIELD_COLS.items():
+            if row.get(col) == truth[f]:
+                hits[f] += 1
+            else:
+                ok = False
+        pages_ok += ok
+    n = max(1, len(truths))
+    acc = {f: round(hits[f] / n, 4) for f in core.ROI_FIELDS}
+    acc["page"] = round(pages_ok / n, 4)
+    return acc
+
+
+def run_benchmark(pdf_path: str, truths, roi_config: str, options):
+    """在独立子进程里调用（峰值RSS只算识别本身，模型加载也计入首页耗时）"""
+    stamps = []
+    t0 = time.perf_counter()
+
+    def hook(cur, total):
+        stamps.append((cur, time.perf_counter()))
+
+    timer = StageTimer()
+    rows = core.extract_pdf_to_rows(pdf_path, progress_hook=hook, roi_config=roi_config, timer=timer, **options)
+    total_sec = time.perf_counter() - t0
+
+    # 相邻两次进度回调之间的耗时按页数平摊，得到单页耗时
+    lat, prev_n, prev_t = [], 0, t0
+    for cur, t in stamps:
+        n = cur - prev_n
+        if n > 0:
+            lat += [(t - prev_t) / n] * n
+        prev_n, prev_t = cur, t
+
+    self_mb, child_mb = peak_rss_mb()
+    return {
+        "pages": len(rows),
+        "total_sec": round(total_sec, 3),
+        "pages_per_sec": round(len(rows) / total_sec, 3) if total_sec > 0 else None,
+        "first_page_sec": round(lat[0], 4) if lat else None,
+        # p50/p95 不含首页（首页包含模型加载）
+        "p50_page_sec": percentile(lat[1:] or lat, 50),
+        "p95_page_sec": percentile(lat[1:] or lat, 95),
+        "peak_rss_mb": self_mb,
+        "peak_rss_children_mb": child_mb,
+        "accuracy": field_accuracy(rows, truths),
+        "timing": timer.summary(),
+        "mismatches": [
+            {"page": i + 1, **{f: [row.get(FIELD_COLS[f]), truth[f]] for f in core.ROI_FIELDS
+                               if row.get(FIELD_COLS[f]) != truth[f]}}
+            for i, (row, truth) in enumerate(zip(rows, truths))
+            if any(row.get(FIELD_COLS[f]) != truth[f] for f in core.ROI_FIELDS)
+        ][:20],
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=str(Path(__file__).parent),
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def print_compare(cur, base):
+    """按变体打印与基准JSON的差异"""
+    print(f"\n对比基准：{base.get('meta', {}).get('commit')} -> {cur['meta'].get('commit')}")
+    for variant, r in cur["results"].items():
+        b = base.get("results", {}).get(variant)
+        if not b:
+            print(f"  {variant}: 基准中无此变体")
+            continue
+        for key in ("pages_per_sec", "p50_page_sec", "p95_page_sec", "peak_rss_mb"):
+            new, old = r.get(key), b.get(key)
+            if new is None or not old:
+                continue
+            print(f"  {variant:8s} {key:14s} {old:>10} -> {new:<10} ({(new - old) / old * 100:+.1f}%)")
+        print(f"  {variant:8s} {'page_accuracy':14s} {b['accuracy']['page']:>10} -> {r['accuracy']['page']}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="合成发票语料 + 吞吐基准（离线）")
+    ap.add_argument("--pages", type=int, default=20, help="每个变体的页数")
+    ap.add_argument("--variant", choices=["vector", "scanned", "both"], default="both", help="语料变体")
+    ap.add_argument("--roi_config", default=str(Path(__file__).with_name("roi_config.json")),
+                    help="ROI配置路径（生成语料和识别都用它）")
+    ap.add_argument("--seed", type=int, default=0, help="随机种子（相同种子生成相同语料）")
+    ap.add_argument("--scan_dpi", type=int, default=200, help="scanned 变体的“扫描”DPI")
+    ap.add_argument("--noise", type=float, default=8.0, help="scanned 变体高斯噪声标准差（灰度级）")
+    ap.add_argument("--skew", type=float, default=1.0, help="scanned 变体最大倾斜角（度）")
+    ap.add_argument("--workdir", default=None, help="语料输出目录（默认临时目录）")
+    ap.add_argument("--out", default=None, help="结果JSON路径（可选）")
+    ap.add_argument("--compare", default=None, help="与之前保存的结果JSON对比")
+    # 透传给 extract_pdf_to_rows 的运行选项
+    ap.add_argument("--render_mode", choices=["full", "clip"], default=None)
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--batch_size", type=int, default=None)
+    ap.add_argument("--text_layer", action="store_true", default=None)
+    ap.add_argument("--color_mode", choices=["bgr", "gray"], default=None)
+    args = ap.parse_args()
+
+    cfg = core.load_roi_config(args.roi_config)
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="invoice_bench_"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    options = {"render_mode": args.render_mode, "workers": args.workers,
+               "batch_size": args.batch_size, "text_layer": args.text_layer, "color_mode": args.color_mode}
+    variants = VARIANTS if args.variant == "both" else (args.variant,)
+
+    report = {
+        "meta": {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "engine": core.engine_version(),
+            "args": vars(args),
+        },
+        "results": {},
+    }
+
+    for variant in variants:
+        pdf_path = str(workdir / f"synthetic_{variant}_{args.pages}p_seed{args.seed}.pdf")
+        t = time.perf_counter()
+        truths = make_corpus(pdf_path, cfg, args.pages, variant, seed=args.seed, dpi=args.scan_dpi,
+                             noise=args.noise, skew=args.skew)
+        print(f"[{variant}] 生成语料 {args.pages}页 {time.perf_counter() - t:.1f}s -> {pdf_path}", flush=True)
+
+        # 每个变体一个新进程：峰值RSS互不影响，模型冷启动条件一致
+        with ProcessPoolExecutor(max_workers=1) as ex:
+            r = ex.submit(run_benchmark, pdf_path, truths, args.roi_config, options).result()
+        r["pdf"] = pdf_path
+        report["results"][variant] = r
+        acc = r["accuracy"]
+        print(f"[{variant}] {r['pages_per_sec']} 页/秒  p50={r['p50_page_sec']}s  p95={r['p95_page_sec']}s  "
+              f"峰值RSS={r['peak_rss_mb']}MB  准确率 票号={acc['invoice_no']} 日期={acc['invoice_date']} "
+              f"金额={acc['total_amount']} 整页={acc['page']}", flush=True)
+
+    if args.out:
+        Path(args.out).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"结果已保存：{args.out}")
+    if args.compare:
+        print_compare(report, json.loads(Path(args.compare).read_text(encoding="utf-8")))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,14 @@ ROI校准工具：
 - 支持指定PDF页码校准：--page_index (0-based)
 - 支持强制旋转：--rotate cw90/ccw90/180/0
 - 显示自适应缩放：窗口显示缩小图，但保存坐标映射回原图（相对坐标）
-输出：roi_config.json（含 rotate、dpi、3个ROI相对坐标）
+- --anchor：再框选一个锚点（如“发票号码”字样），按 --anchor_dpi 存成灰度模板，
+  识别时在低分辨率下匹配锚点求每页偏移，三个ROI一起平移；--anchor_only 只给已有配置补锚点
+- --layout_match：同时记下本页的版式特征（页面尺寸 + 低DPI缩略图签名，可加 --layout_keywords），
+  这份配置即可作为多版式配置 "profiles" 里的一个版式
+输出：roi_config.json（含 rotate、dpi、3个ROI相对坐标，可选 anchor、match）
 """
 
+import base64
 import json
 import cv2
 import fitz  # PyMuPDF
@@ -14,6 +19,8 @@ import numpy as np
 from pathlib import Path
 import argparse
 
+import invoice_core as core
+
 
 def render_page(pdf_path: str, dpi: int = 300, page_index: int = 0):
     doc = fitz.open(pdf_path)
@@ -77,6 +84,36 @@ def to_norm(box_orig, W, H):
     }
 
 
+def make_anchor(img, box_orig, calib_dpi: int, anchor_dpi: int, search: float):
+    """锚点：相对坐标 + 缩到 anchor_dpi 的灰度模板（PNG base64，直接写进配置）"""
+    H, W = img.shape[:2]
+    x, y, w, h = box_orig
+    gray = cv2.cvtColor(img[y:y + h, x:x + w], cv2.COLOR_BGR2GRAY)
+    scale = anchor_dpi / float(calib_dpi)
+    tpl = cv2.resize(gray, (max(1, int(round(w * scale))), max(1, int(round(h * scale)))),
+                     interpolation=cv2.INTER_AREA)
+    return {
+        **to_norm(box_orig, W, H),
+        "dpi": anchor_dpi,
+        "search": search,
+        "min_score": 0.6,
+        "template": base64.b64encode(cv2.imencode(".png", tpl)[1].tobytes()).decode("ascii"),
+    }
+
+
+def make_layout_match(pdf_path: str, page_index: int, keywords=None):
+    """版式特征：与识别时 invoice_core.classify_layout 用的是同一套尺寸/签名算法"""
+    with fitz.open(pdf_path) as doc:
+        page_index = page_index if 0 <= page_index < len(doc) else 0
+        match = {
+            "page_size": [round(v, 1) for v in core.page_size_mm(doc[page_index])],
+            "thumb": core.encode_layout_signature(core.layout_signature(doc, page_index)),
+        }
+    if keywords:
+        match["keywords"] = list(keywords)
+    return match
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("pdf", help="用于校准的PDF文件路径")
@@ -84,6 +121,14 @@ def main():
     ap.add_argument("--page_index", type=int, default=0, help="用于校准的PDF页码（从0开始）")
     ap.add_argument("--out", default="roi_config.json", help="输出roi_config.json路径")
     ap.add_argument("--rotate", default="0", help="旋转：0/cw90/ccw90/180（强制）")
+    ap.add_argument("--anchor", action="store_true", help="再框选一个锚点（如“发票号码”字样），用于识别时自动纠正扫描偏移")
+    ap.add_argument("--anchor_only", action="store_true", help="只框选锚点，写入已有的 --out 配置（ROI不变）")
+    ap.add_argument("--anchor_dpi", type=int, default=100, help="锚点模板分辨率（识别时按此DPI渲染搜索窗口）")
+    ap.add_argument("--anchor_search", type=float, default=0.04, help="锚点搜索窗口向外扩的相对距离（占页面宽/高）")
+    ap.add_argument("--layout_match", action="store_true",
+                    help="记下本页的版式特征（页面尺寸+缩略图签名），用作多版式配置 profiles 中的一个版式")
+    ap.add_argument("--layout_keywords", nargs="*", default=None,
+                    help="版式的文字层关键字（如 专用发票），电子发票按关键字判定版式最准")
     ap.add_argument("--max_w", type=int, default=1400)
     ap.add_argument("--max_h", type=int, default=900)
     args = ap.parse_args()
@@ -97,7 +142,21 @@ def main():
     cv2.namedWindow("invoice", cv2.WINDOW_NORMAL)
     cv2.resizeWindow("invoice", min(args.max_w, disp.shape[1]), min(args.max_h, disp.shape[0]))
 
-    print("请依次框选：票号(20位纯数字) -> 开票日期 -> 价税合计")
+    out = Path(args.out)
+    if args.anchor_only:
+        cfg = json.loads(out.read_text(encoding="utf-8"))
+        print("请框选锚点（如“发票号码”字样，选版式固定、每张都有的文字）")
+        anchor_disp = select_roi_scaled("invoice - 锚点", disp)
+        cfg["anchor"] = make_anchor(img, box_disp_to_orig(anchor_disp, scale), args.dpi,
+                                    args.anchor_dpi, args.anchor_search)
+        if args.layout_match or args.layout_keywords:
+            cfg["match"] = make_layout_match(args.pdf, args.page_index, args.layout_keywords)
+        out.write_text(json.dumps(cfg, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"已保存：{out}")
+        cv2.destroyAllWindows()
+        return
+
+    print("请依次框选：票号(20位纯数字) -> 开票日期 -> 价税合计" + (" -> 锚点" if args.anchor else ""))
     print("提示：框选后按 SPACE/ENTER 确认；按 c 取消本次框选。")
 
     inv_disp = select_roi_scaled("invoice - 1) 票号(20位)", disp)
@@ -116,8 +175,13 @@ def main():
         "invoice_date": to_norm(date_box, W, H),
         "total_amount": to_norm(amt_box, W, H)
     }
+    if args.anchor:
+        anchor_disp = select_roi_scaled("invoice - 4) 锚点（如“发票号码”字样）", disp)
+        cfg["anchor"] = make_anchor(img, box_disp_to_orig(anchor_disp, scale), args.dpi,
+                                    args.anchor_dpi, args.anchor_search)
+    if args.layout_match or args.layout_keywords:
+        cfg["match"] = make_layout_match(args.pdf, args.page_index, args.layout_keywords)
 
-    out = Path(args.out)
     out.parent.mkdir(parents=True, exist_ok=True)
     out.write_text(json.dumps(cfg, ensure_ascii=False, indent=2), encoding="utf-8")
     print(f"已保存：{out}")
@@ -6,6 +6,9 @@
 - --all_pages：处理PDF所有页（每页一行）
 - --max_pages：限制最多处理前N页
 - 输出增加“页码”列（从1开始）
+- --workers：所有文件的页分片到多进程（复用 invoice_core.iter_parallel），每个进程一个RapidOCR
+- 页级检查点日志（<输出>.journal.jsonl，invoice_journal.PageJournal）：被中断后加 --resume 跳过已完成的页
+- --debug_dir 的ROI图由后台线程写出（invoice_debug.DebugWriter），可选格式/压缩级别，可只存识别失败的页
 """
 
 import os
@@ -16,28 +19,18 @@ from pathlib import Path
 
 import fitz  # PyMuPDF
 import numpy as np
-import pandas as pd
 import cv2
 
 from rapidocr import RapidOCR
 
+import invoice_core as core
+from invoice_debug import DebugWriter, DEBUG_FORMATS, open_worker_writer
+from invoice_journal import PageJournal, default_journal_path, file_tag, run_tag
+
 IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp"}
 PDF_EXT = ".pdf"
 
 
-def rotate_img(img, rotate: str):
-    rotate = (rotate or "0").lower()
-    if rotate in ["0", "none"]:
-        return img
-    if rotate in ["cw90", "90", "right", "r"]:
-        return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
-    if rotate in ["ccw90", "-90", "left", "l"]:
-        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
-    if rotate in ["180", "flip"]:
-        return cv2.rotate(img, cv2.ROTATE_180)
-    raise ValueError(f"不支持的rotate参数: {rotate}")
-
-
 def render_pdf_page_to_bgr(doc: fitz.Document, page_index: int, dpi: int):
     """渲染PDF指定页为BGR ndarray（不依赖poppler），逐页 page.get_pixmap(dpi=...)[1](https://juejin.cn/post/7510925068987252755)[2](https://pypi.org/project/rapidocr-onnxruntime/)"""
     page = doc[page_index]
@@ -59,19 +52,6 @@ def imread_unicode(path: str):
     return img
 
 
-def crop_by_norm(img, norm_box):
-    H, W = img.shape[:2]
-    x1 = int(norm_box["x1"] * W)
-    y1 = int(norm_box["y1"] * H)
-    x2 = int(norm_box["x2"] * W)
-    y2 = int(norm_box["y2"] * H)
-    x1, y1 = max(0, x1), max(0, y1)
-    x2, y2 = min(W, x2), min(H, y2)
-    if x2 <= x1 or y2 <= y1:
-        return None
-    return img[y1:y2, x1:x2]
-
-
 def upscale_if_small(img_bgr, min_h=60):
     if img_bgr is None or img_bgr.size == 0:
         return img_bgr
@@ -233,34 +213,88 @@ def walk_files(root: str, only_pdf: bool = False):
     return sorted(files)
 
 
-def process_one_image(img_bgr, cfg, engine, rotate, debug_dir: Path | None, stem: str, page_no: int | None):
-    """对一张BGR图（已是某页）按ROI提取"""
-    img_bgr = rotate_img(img_bgr, rotate)
-
-    inv_roi = crop_by_norm(img_bgr, cfg["invoice_no"])
-    date_roi = crop_by_norm(img_bgr, cfg["invoice_date"])
-    amt_roi = crop_by_norm(img_bgr, cfg["total_amount"])
+def process_one_image(img_bgr, cfg, engine, rotate, debug: DebugWriter | None, stem: str, page_no: int | None):
+    """对一张BGR图（已是某页、未旋转）按ROI提取；ROI反向映射到原图后只旋转裁剪块，不旋转整幅图"""
+    inv_roi = core.crop_rotated_roi(img_bgr, cfg["invoice_no"], rotate)
+    date_roi = core.crop_rotated_roi(img_bgr, cfg["invoice_date"], rotate)
+    amt_roi = core.crop_rotated_roi(img_bgr, cfg["total_amount"], rotate)
 
     inv_text = ocr_text(engine, inv_roi)
     date_text = ocr_text(engine, date_roi)
     amt_text = ocr_text(engine, amt_roi)
 
-    if debug_dir:
-        debug_dir.mkdir(parents=True, exist_ok=True)
-        tag = f"{stem}_p{page_no:02d}" if page_no is not None else stem
-        if inv_roi is not None:
-            cv2.imencode(".png", inv_roi)[1].tofile(str(debug_dir / f"{tag}_inv.png"))
-        if date_roi is not None:
-            cv2.imencode(".png", date_roi)[1].tofile(str(debug_dir / f"{tag}_date.png"))
-        if amt_roi is not None:
-            cv2.imencode(".png", amt_roi)[1].tofile(str(debug_dir / f"{tag}_amt.png"))
-
-    return {
+    fields = {
         "发票号码": extract_invoice_no(inv_text),
         "开票日期": extract_date(date_text),
         "价税合计": extract_amount(amt_text),
     }
 
+    if debug:
+        # 只放进后台写出队列；有字段没提取到的页记为 failed（供 --debug_sample failed 抽样）
+        tag = f"{stem}_p{page_no:02d}" if page_no is not None else stem
+        debug.submit(tag, {"invoice_no": inv_roi, "invoice_date": date_roi, "total_amount": amt_roi},
+                     "failed" if None in fields.values() else "ok")
+    return fields
+
+
+def list_page_tasks(fp: str, args):
+    """一个文件要处理的页：PDF返回[(fp, idx), ...]；图片返回[(fp, None)]"""
+    fp_path = Path(fp)
+    if fp_path.suffix.lower() != PDF_EXT:
+        return [(fp, None)]
+    with fitz.open(str(fp_path)) as doc:
+        total = len(doc)
+    if args.all_pages:
+        page_indices = list(range(total))
+        if args.max_pages and args.max_pages > 0:
+            page_indices = page_indices[: args.max_pages]
+    else:
+        page_indices = [max(0, min(args.page_index, total - 1))]
+    return [(fp, idx) for idx in page_indices]
+
+
+def process_task(task, cfg, engine, debug: DebugWriter | None, state: dict):
+    """处理一页（PDF的某页或一张图片），返回字段dict（含页码）；state 缓存当前打开的PDF"""
+    fp, idx = task
+    fp_path = Path(fp)
+    rotate = cfg.get("rotate", "0")
+
+    if idx is None:
+        # 图片文件（不分多页）
+        img = imread_unicode(str(fp_path))
+        fields = process_one_image(img, cfg, engine, rotate, debug=debug, stem=fp_path.stem, page_no=None)
+        return {"页码": 1, **fields}
+
+    if state.get("doc_path") != fp:
+        if state.get("doc") is not None:
+            state["doc"].close()
+        state["doc"] = fitz.open(str(fp_path))
+        state["doc_path"] = fp
+    img = render_pdf_page_to_bgr(state["doc"], idx, dpi=int(cfg.get("dpi", 300)))
+    fields = process_one_image(img, cfg, engine, rotate, debug=debug, stem=fp_path.stem, page_no=idx + 1)
+    return {"页码": idx + 1, **fields}
+
+
+# 多进程worker：每个进程一个RapidOCR
+_WORKER = {}
+
+
+def _init_worker(cfg, debug_args, intra_op_threads: int | None, lazy_det: bool = False):
+    _WORKER["cfg"] = cfg
+    _WORKER["engine"] = core.create_engine(intra_op_threads,
+                                           engine_cfg=core.resolve_engine_config(cfg, intra_op_threads),
+                                           lazy_det=lazy_det)
+    _WORKER["debug"] = open_worker_writer(debug_args)
+    _WORKER["state"] = {}
+
+
+def _worker_task(task):
+    try:
+        res = process_task(task, _WORKER["cfg"], _WORKER["engine"], _WORKER["debug"], _WORKER["state"])
+        return True, res, core.engine_memory(_WORKER["engine"])
+    except Exception as e:
+        return False, str(e), None
+
 
 def main():
     ap = argparse.ArgumentParser(description="按固定ROI离线识别发票号码/开票日期/价税合计并导出Excel（支持PDF多页）")
@@ -269,21 +303,28 @@ def main():
     ap.add_argument("output_excel", help="输出Excel路径 .xlsx")
 
     ap.add_argument("--with_filename", action="store_true", help="结果包含文件名列")
-    ap.add_argument("--debug_dir", default=None, help="调试：保存ROI裁剪图到该目录（可选）")
+    ap.add_argument("--debug_dir", default=None, help="调试：保存ROI裁剪图到该目录（可选），后台线程写出")
+    ap.add_argument("--debug_format", choices=DEBUG_FORMATS, default="png",
+                    help="调试图格式（png默认快速压缩；jpg/webp更小）")
+    ap.add_argument("--debug_level", type=int, default=None, help="png压缩级别0~9（默认1）；jpg/webp质量0~100（默认90）")
+    ap.add_argument("--debug_sample", choices=["all", "failed"], default="all",
+                    help="all=每页都存；failed=只存有字段没提取到的页")
     ap.add_argument("--only_pdf", action="store_true", help="只处理PDF，忽略png/jpg等")
 
     ap.add_argument("--page_index", type=int, default=0, help="单页模式：处理指定页（从0开始），默认0")
     ap.add_argument("--all_pages", action="store_true", help="处理PDF所有页（每页一行）")
     ap.add_argument("--max_pages", type=int, default=0, help="最多处理前N页（0表示不限制）")
+    ap.add_argument("--workers", type=int, default=1, help="并行进程数（1=单进程，0=CPU核数），所有文件的页共用一个进程池")
+    ap.add_argument("--lazy_det", action="store_true",
+                    help="只识别引擎：先只加载识别模型，第一次回退到检测+识别时才加载检测模型")
+    ap.add_argument("--resume", action="store_true", help="续跑：跳过检查点日志里已完成的页，结果并回输出")
+    ap.add_argument("--journal", default=None, help="页级检查点日志路径（默认 <输出Excel>.journal.jsonl）")
 
     args = ap.parse_args()
 
     cfg = json.loads(Path(args.roi_config).read_text(encoding="utf-8"))
-    dpi = int(cfg.get("dpi", 300))
-    rotate = cfg.get("rotate", "0")
-
-    engine = RapidOCR()  # 返回 RapidOCROutput[3](https://pymupdftest.readthedocs.io/en/stable/recipes-images.html)[4](https://sqlpey.com/python/solved-how-to-extract-a-pdf-page-as-a-jpeg/)
-    debug_dir = Path(args.debug_dir) if args.debug_dir else None
+    debug = DebugWriter(args.debug_dir, fmt=args.debug_format, level=args.debug_level,
+                        sample=args.debug_sample) if args.debug_dir else None
 
     rows = []
     files = walk_files(args.input_path, only_pdf=args.only_pdf)
@@ -291,75 +332,99 @@ def main():
         print("未找到可处理文件。")
         return
 
-    for fp in files:
-        fp_path = Path(fp)
-        suf = fp_path.suffix.lower()
+    def fail_row(fp_path: Path, e):
+        # 失败也占位
+        base = {"页码": None, "发票号码": None, "开票日期": None, "价税合计": None}
+        if args.with_filename:
+            base = {"文件名": fp_path.name, **base}
+        print("[FAIL]", fp_path.name, "->", e)
+        return base
 
+    # 先列出所有页任务（文件打不开的直接记失败）
+    tasks = []
+    for fp in files:
         try:
-            if suf == PDF_EXT:
-                doc = fitz.open(str(fp_path))
-                total = len(doc)
-                if args.all_pages:
-                    page_indices = list(range(total))
-                    if args.max_pages and args.max_pages > 0:
-                        page_indices = page_indices[: args.max_pages]
-                else:
-                    page_indices = [max(0, min(args.page_index, total - 1))]
-
-                for idx in page_indices:
-                    img = render_pdf_page_to_bgr(doc, idx, dpi=dpi)
-                    fields = process_one_image(
-                        img, cfg, engine, rotate,
-                        debug_dir=debug_dir,
-                        stem=fp_path.stem,
-                        page_no=idx + 1
-                    )
-                    row = {"页码": idx + 1, **fields}
-                    if args.with_filename:
-                        row = {"文件名": fp_path.name, **row}
-                    rows.append(row)
-
-                doc.close()
-
-            else:
-                # 图片文件（不分多页）
-                img = imread_unicode(str(fp_path))
-                fields = process_one_image(
-                    img, cfg, engine, rotate,
-                    debug_dir=debug_dir,
-                    stem=fp_path.stem,
-                    page_no=None
-                )
-                row = {"页码": 1, **fields}
-                if args.with_filename:
-                    row = {"文件名": fp_path.name, **row}
-                rows.append(row)
-
-            print("[OK]", fp_path.name, "pages processed" if suf == PDF_EXT and args.all_pages else "")
-
+            tasks.extend(list_page_tasks(fp, args))
         except Exception as e:
-            # 失败也占位
-            base = {"页码": None, "发票号码": None, "开票日期": None, "价税合计": None}
-            if args.with_filename:
-                base = {"文件名": fp_path.name, **base}
-            rows.append(base)
-            print("[FAIL]", fp_path.name, "->", e)
-
-    df = pd.DataFrame(rows)
+            rows.append(fail_row(Path(fp), e))
+
+    # 检查点日志：已完成的页（续跑时）直接取记录，其余页才识别
+    journal = PageJournal(args.journal or default_journal_path(args.output_excel), resume=args.resume,
+                          tag=run_tag({"config": file_tag(args.roi_config), "with_filename": args.with_filename}))
+    resumed = {fp: journal.done_pages(fp) for fp in dict.fromkeys(fp for fp, _ in tasks)}
+    todo = [t for t in tasks if t[1] not in resumed[t[0]]]
+    if journal.resumed:
+        print(f"[RESUME] 跳过已完成 {journal.resumed} 页")
+
+    lazy_det = bool(args.lazy_det or (cfg.get("engine") or {}).get("lazy_det"))
+    workers = core.resolve_workers(args.workers)
+    if workers > 1 and len(todo) > 1:
+        workers = min(workers, len(todo))
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        results = core.iter_parallel(
+            todo, _worker_task, workers,
+            initializer=_init_worker,
+            initargs=(cfg, debug.args() if debug else None, threads, lazy_det),
+        )
+    else:
+        # 配置中的 "engine" 段只能设 ONNX Runtime 会话线程数（intra_op_threads / inter_op_threads）和 lazy_det
+        engine = core.create_engine(engine_cfg=core.resolve_engine_config(cfg), lazy_det=lazy_det)
+        state = {}
+
+        def run_serial():
+            for task in todo:
+                try:
+                    yield True, process_task(task, cfg, engine, debug, state), core.engine_memory(engine)
+                except Exception as e:
+                    yield False, str(e), None
+
+        results = run_serial()
+
+    def merged():
+        for task in tasks:
+            done = resumed[task[0]]
+            if task[1] in done:
+                yield task, (True, done[task[1]])
+                continue
+            ok, res, mem = next(results)
+            if mem:
+                core.WORKER_MEMORY[mem["pid"]] = mem
+            if ok:
+                journal.record(task[0], task[1], res)
+            yield task, (ok, res)
+
+    for i, (task, (ok, res)) in enumerate(merged()):
+        fp_path = Path(task[0])
+        if not ok:
+            rows.append(fail_row(fp_path, res))
+            continue
+        row = res
+        if args.with_filename:
+            row = {"文件名": fp_path.name, **row}
+        rows.append(row)
+
+        # 一个文件的最后一页完成时输出
+        if i + 1 == len(tasks) or tasks[i + 1][0] != task[0]:
+            print("[OK]", fp_path.name, "pages processed" if task[1] is not None and args.all_pages else "")
 
     # 列顺序
     cols = ["页码", "发票号码", "开票日期", "价税合计"]
     if args.with_filename:
         cols = ["文件名"] + cols
-    df = df[cols]
 
     out = Path(args.output_excel)
     out.parent.mkdir(parents=True, exist_ok=True)
-    with pd.ExcelWriter(out, engine="openpyxl") as w:
-        df.to_excel(w, index=False, sheet_name="发票提取")
-
+    core.write_xlsx_rows(out, cols, ([row.get(c) for c in cols] for row in rows))
+
+    journal.remove()
+    if debug is not None:
+        debug.close()
+        if debug.pages or debug.skipped:  # 多进程时写出计数在各worker里，这里只有单进程的统计
+            print("[DEBUG]", debug.summary())
+    for line in core.format_worker_memory().splitlines():
+        print("[MEMORY]", line)
     print("完成：", out)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
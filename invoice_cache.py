@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+识别结果持久缓存（SQLite，离线）：
+- 键：页面内容哈希 + 字段ROI + DPI/rotate/运行选项 + OCR引擎版本（由 invoice_core.page_cache_keys 生成）
+- 值：字段归一化结果及来源（text/ocr），JSON
+- 按条数限制大小，超出后按最近使用时间淘汰（LRU）；命中时只在内存里记下使用时间，
+  随下一次 put_many / evict / close 一起写回（不为每页命中单独提交一次）
+- hits/misses 计数；多进程时各worker用 take_stats() 交回增量，由主进程 add_stats() 汇总
+同一PDF重跑直接命中；只改了某个ROI时，只有该字段的键变化，其它字段仍命中。
+"""
+
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+DEFAULT_MAX_ENTRIES = 200_000
+# 每写入这么多条检查一次是否超限
+_EVICT_EVERY = 1000
+
+
+class ResultCache:
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = str(path)
+        self.max_entries = max(1, int(max_entries or DEFAULT_MAX_ENTRIES))
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._puts_since_evict = 0
+        self._touched = {}   # 命中但还没写回的 {key: 使用时间}
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_used ON entries(used)")
+            self._conn = conn
+        return self._conn
+
+    def get_many(self, keys) -> dict:
+        """返回 {key: value}，只包含命中的键；命中条目的使用时间先记在内存里"""
+        keys = list(keys)
+        if not keys:
+            return {}
+        db = self._db()
+        marks = ",".join("?" * len(keys))
+        found = {k: json.loads(v) for k, v in db.execute(
+            f"SELECT key, value FROM entries WHERE key IN ({marks})", keys)}
+        now = time.time()
+        self._touched.update((k, now) for k in found)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def _write_touched(self, db):
+        """把命中时记下的使用时间写回（不提交，随调用方的事务一起提交）"""
+        if self._touched:
+            db.executemany("UPDATE entries SET used=? WHERE key=?", [(t, k) for k, t in self._touched.items()])
+            self._touched.clear()
+
+    def put_many(self, items: dict):
+        if not items:
+            return
+        db = self._db()
+        now = time.time()
+        self._write_touched(db)
+        db.executemany(
+            "INSERT OR REPLACE INTO entries(key, value, used) VALUES (?, ?, ?)",
+            [(k, json.dumps(v, ensure_ascii=False), now) for k, v in items.items()],
+        )
+        db.commit()
+        self._puts_since_evict += len(items)
+        if self._puts_since_evict >= _EVICT_EVERY:
+            self.evict()
+
+    def evict(self):
+        """超出 max_entries 时删除最久未使用的条目"""
+        self._puts_since_evict = 0
+        db = self._db()
+        self._write_touched(db)
+        (count,) = db.execute("SELECT COUNT(*) FROM entries").fetchone()
+        extra = count - self.max_entries
+        if extra > 0:
+            db.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY used ASC LIMIT ?)",
+                (extra,),
+            )
+        db.commit()
+
+    def take_stats(self) -> dict:
+        """取出并清零计数（worker进程交回主进程用）"""
+        stats = {"hits": self.hits, "misses": self.misses}
+        self.hits = self.misses = 0
+        return stats
+
+    def add_stats(self, stats: dict):
+        self.hits += int(stats.get("hits", 0))
+        self.misses += int(stats.get("misses", 0))
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        rate = (self.hits / total * 100.0) if total else 0.0
+        return f"hits={self.hits} misses={self.misses} hit_rate={rate:.1f}%"
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                if self._puts_since_evict:
+                    self.evict()
+                self._write_touched(self._conn)
+                self._conn.commit()
+            finally:
+                self._conn.close()
+                self._conn = None
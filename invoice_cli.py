@@ -1,28 +1,179 @@
 # -*- coding: utf-8 -*-
 import argparse
+import json
+import time
 from pathlib import Path
-import sys
-import invoice_core as core
+
+# --startup_profile 的计时起点：本项目模块的导入必须在它之后才计得进去，所以只有下面这组 import 不在文件头
+_T0 = time.perf_counter()
+import invoice_core as core  # noqa: E402  重型依赖（fitz/cv2/rapidocr）在第一次用到时才导入
+from invoice_cache import ResultCache, DEFAULT_MAX_ENTRIES  # noqa: E402
+from invoice_debug import DebugWriter, DEBUG_FORMATS, DEBUG_SAMPLES, DEFAULT_QUEUE_PAGES  # noqa: E402
+from invoice_journal import PageJournal, default_journal_path  # noqa: E402
+from invoice_timing import StageTimer, IMPORT_TIMES, format_import_times, fresh_import_times  # noqa: E402
+
+_IMPORT_SEC = time.perf_counter() - _T0
+
+
+def stream_safe(out_path: str) -> bool:
+    """csv/jsonl 逐行落盘，中途崩溃已完成的行不丢；xlsx 要到结束才生成文件"""
+    return Path(out_path).suffix.lower() != ".xlsx"
+
 
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("pdf", help="输入PDF路径")
-    ap.add_argument("--out", default=None, help="输出Excel路径（可选）")
-    ap.add_argument("--debug_dir", default=None, help="保存ROI调试截图目录（可选）")
+    ap.add_argument("pdf", nargs="+",
+                    help="输入PDF路径；可给多个文件、目录（递归）或通配符，多个时所有页进同一个任务队列，合并输出一个文件")
+    ap.add_argument("--out", default=None, help="输出路径（可选）：.xlsx / .csv / .jsonl")
+    ap.add_argument("--roi_config", default=None, help="ROI配置路径（默认 invoice_core.ROI_CONFIG_PATH）")
+    ap.add_argument("--debug_dir", default=None, help="保存ROI调试截图目录（可选），后台线程写出，不阻塞识别")
+    ap.add_argument("--debug_format", choices=DEBUG_FORMATS, default="png", help="调试图格式（默认png）")
+    ap.add_argument("--debug_level", type=int, default=None,
+                    help="png压缩级别0~9（默认1=快）；jpg/webp为质量0~100（默认90）")
+    ap.add_argument("--debug_sample", choices=DEBUG_SAMPLES, default="all",
+                    help="all=每页都存；failed=只存有字段没通过校验的页；suspect=failed+没找到锚点的页")
+    ap.add_argument("--debug_queue", type=int, default=DEFAULT_QUEUE_PAGES,
+                    help="调试图写出队列最多积压的页数（满了识别等待，内存有上限）")
+    ap.add_argument("--render_mode", choices=["full", "clip"], default=None,
+                    help="full=整页渲染后裁剪；clip=只渲染ROI矩形（默认取ROI配置中的render_mode，缺省full）")
+    ap.add_argument("--color_mode", choices=["bgr", "gray"], default=None,
+                    help="gray=灰度渲染、单通道预处理，只在送识别模型时展开3通道（默认取ROI配置中的color_mode，缺省bgr）")
+    ap.add_argument("--workers", type=int, default=1, help="并行进程数（1=单进程，0=CPU核数）")
+    ap.add_argument("--batch_size", type=int, default=None,
+                    help="批量识别：每N页的ROI一起送识别模型（默认取ROI配置中的rec_batch_size，缺省1=不批量）")
+    ap.add_argument("--text_layer", action="store_true", default=None,
+                    help="电子发票：先按ROI读PDF文字层，校验失败的字段才渲染+OCR（也可在ROI配置中设 text_layer）")
+    ap.add_argument("--cache", default=None, help="结果缓存SQLite文件路径（可选），重跑未变化的页直接命中")
+    ap.add_argument("--cache_max", type=int, default=DEFAULT_MAX_ENTRIES, help="缓存最多条目数（超出按LRU淘汰）")
+    ap.add_argument("--stream", action="store_true",
+                    help="流式导出：逐页写入（xlsx用write_only；csv/jsonl定期落盘），内存不随页数增长；.csv/.jsonl 输出总是流式")
+    ap.add_argument("--flush_every", type=int, default=100, help="流式导出时每N行落盘一次")
+    ap.add_argument("--adaptive_dpi", action="store_true",
+                    help="按字段自适应DPI：从历史通过率够高的最低档开始只渲染该ROI，校验失败再升档（档位取ROI配置中的dpi_tiers）")
+    ap.add_argument("--dpi_history", default=None,
+                    help="自适应DPI的历史通过率JSON文件（可选），跨运行累计，下次直接从合适的档位开始")
+    ap.add_argument("--no_anchor", action="store_true",
+                    help="不按锚点重定位ROI（配置中有 anchor 时默认开启，结果加“ROI偏移”列）")
+    ap.add_argument("--auto_rotate", action="store_true", default=None,
+                    help="逐页自动判断方向和小角度倾斜（扫描件横竖混放/放歪时用），结果加“页面方向”列")
+    ap.add_argument("--dedup", action="store_true",
+                    help="去重：本次运行中相同的ROI裁剪图只OCR一次，结果加“重复票号”列（标出首次出现的文件和页）")
+    ap.add_argument("--dedup_distance", type=int, default=0,
+                    help="去重时按感知哈希近似匹配的最大汉明距离（默认0=只复用逐像素相同的ROI；票号只差一两位的发票哈希很接近，宜小）")
+    ap.add_argument("--strategy_stats", action="store_true",
+                    help="结束时打印各字段OCR策略链的最终顺序和每个策略的通过次数（STRATEGY 行）")
+    ap.add_argument("--lazy_det", action="store_true", default=None,
+                    help="只识别引擎：启动时只加载识别模型，第一次需要检测回退时才加载检测模型（也可在配置 engine.lazy_det 设置）")
+    ap.add_argument("--memory", action="store_true",
+                    help="结束时打印每个进程的内存（MEMORY 行：pid、RSS、引擎状态 full/rec/rec+det）")
+    ap.add_argument("--resume", action="store_true",
+                    help="续跑：跳过检查点日志里已完成的页，把日志中的结果并回输出（ROI配置或影响结果的选项变了则从头开始）")
+    ap.add_argument("--journal", default=None, help="页级检查点日志路径（默认 <输出文件>.journal.jsonl）")
+    ap.add_argument("--no_journal", action="store_true", help="不写检查点日志（中断后无法续跑）")
+    ap.add_argument("--timing", action="store_true", help="结束时打印分阶段耗时汇总（TIMING 行）")
+    ap.add_argument("--timing_json", default=None, help="把分阶段耗时汇总和逐页记录写入JSON文件")
+    ap.add_argument("--startup_profile", "--startup-profile", action="store_true",
+                    help="结束时打印启动耗时（STARTUP 行）：模块导入、各重型依赖的延迟导入耗时（本进程增量 + 新解释器单独导入）、到第一页完成的时间")
     args = ap.parse_args()
 
-    pdf = Path(args.pdf)
-    if not pdf.exists():
-        raise FileNotFoundError(str(pdf))
+    pdfs = core.expand_pdf_inputs(args.pdf)
+    if not pdfs:
+        raise FileNotFoundError("未找到PDF：" + " ".join(args.pdf))
+    # 只给了一个PDF文件：保持原来的单文件输出；否则合并输出并附每个文件的状态行
+    single = len(args.pdf) == 1 and Path(args.pdf[0]).is_file()
+
+    first_page = []
 
     def hook(cur, total):
+        if not first_page:
+            first_page.append(time.perf_counter() - _T0)
         # 给UI解析用：PROGRESS cur total
         print(f"PROGRESS {cur} {total}", flush=True)
 
-    rows = core.extract_pdf_to_rows(str(pdf), debug_dir=args.debug_dir, progress_hook=hook)
+    if args.out:
+        out_path = args.out
+    elif single:
+        pdf = Path(pdfs[0])
+        out_path = str(pdf.parent / f"{pdf.stem}_extract.xlsx")
+    else:
+        first = Path(args.pdf[0])
+        base = first if first.is_dir() else Path(pdfs[0]).parent
+        out_path = str(base / "batch_extract.xlsx")
+    stream = args.stream or stream_safe(out_path)
+    if args.stream and not stream_safe(out_path):
+        print("WARN --stream 输出为 .xlsx：内存恒定，但文件到结束时才生成，中途崩溃不会留下已完成的行；"
+              "需要边跑边落盘请输出 .csv/.jsonl（.xlsx 中断后可用 --resume 从检查点日志续跑）", flush=True)
+
+    cache = ResultCache(args.cache, args.cache_max) if args.cache else None
+    timer = StageTimer(keep_records=bool(args.timing_json)) if (args.timing or args.timing_json) else None
+    strategies = core.OcrStrategyChain()
+    dedup = core.RoiDedup(args.dedup_distance) if (args.dedup or args.dedup_distance) else None
+    adaptive = core.AdaptiveDpi(history_path=args.dpi_history) if (args.adaptive_dpi or args.dpi_history) else None
+    debug = DebugWriter(args.debug_dir, fmt=args.debug_format, level=args.debug_level, sample=args.debug_sample,
+                        max_queue=args.debug_queue) if args.debug_dir else None
+    # 影响结果行内容/列的选项：同时决定检查点日志的 tag，续跑时换了选项不会并回旧结果
+    result_opts = dict(roi_config=args.roi_config, render_mode=args.render_mode, batch_size=args.batch_size,
+                       text_layer=args.text_layer, color_mode=args.color_mode,
+                       anchor=False if args.no_anchor else None, auto_rotate=args.auto_rotate,
+                       adaptive=adaptive, dedup=dedup)
+    # 每完成一页写一行检查点；完整导出后删除，被中断时留给 --resume
+    journal = None if args.no_journal else PageJournal(
+        args.journal or default_journal_path(out_path), resume=args.resume, tag=core.journal_tag(**result_opts))
+    try:
+        run_opts = dict(debug_writer=debug, progress_hook=hook, workers=args.workers, cache=cache,
+                        timer=timer, strategies=strategies, journal=journal, lazy_det=args.lazy_det, **result_opts)
+        if single:
+            rows = core.iter_pdf_rows(pdfs[0], **run_opts)
+        else:
+            print(f"FILES {len(pdfs)}", flush=True)
+            rows = core.iter_batch_rows(pdfs, **run_opts)
+        # 导出也计入 export 阶段
+        with core.use_timer(timer):
+            if stream:
+                out = core.stream_rows_to_file(rows, out_path, flush_every=args.flush_every)
+            else:
+                out = core.export_rows_to_excel(list(rows), out_path)
+    finally:
+        if cache is not None:
+            cache.close()
+        if journal is not None:
+            journal.close()
+        if debug is not None:
+            debug.close()
+    if journal is not None:
+        print(f"JOURNAL {journal.summary()}", flush=True)
+        journal.remove()
+    if cache is not None:
+        print(f"CACHE {cache.summary()}", flush=True)
+    if debug is not None:
+        print(f"DEBUG {debug.summary()}", flush=True)
+    if dedup is not None:
+        print(f"DEDUP {dedup.summary()}", flush=True)
+    if adaptive is not None:
+        adaptive.save()
+        for line in adaptive.format_summary().splitlines():
+            print(f"DPI {line}", flush=True)
+    if args.memory:
+        for line in core.format_worker_memory().splitlines():
+            print(f"MEMORY {line}", flush=True)
+    if args.strategy_stats:
+        for line in strategies.format_summary().splitlines():
+            print(f"STRATEGY {line}", flush=True)
+    if args.timing:
+        for line in timer.format_summary().splitlines():
+            print(f"TIMING {line}", flush=True)
+    if args.timing_json:
+        data = {"summary": timer.summary(), "pages": timer.records}
+        Path(args.timing_json).write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"TIMING_JSON {args.timing_json}", flush=True)
 
-    out_xlsx = args.out if args.out else str(pdf.parent / f"{pdf.stem}_extract.xlsx")
-    out = core.export_rows_to_excel(rows, out_xlsx)
+    if args.startup_profile:
+        print(f"STARTUP imports {_IMPORT_SEC * 1000:.1f}ms", flush=True)
+        # 进程内的延迟导入耗时只是增量（依赖已被先导入的模块带进来时接近0），另在新解释器里逐个单独测一次
+        for line in format_import_times(fresh_import_times(IMPORT_TIMES)).splitlines():
+            print(f"STARTUP lazy {line}", flush=True)
+        if first_page:
+            print(f"STARTUP first_page {first_page[0]:.3f}s", flush=True)
 
     # 给UI解析用：RESULT path
     print(f"RESULT {out}", flush=True)
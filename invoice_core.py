@@ -1,49 +1,285 @@
 # -*- coding: utf-8 -*-
 """
 核心提取逻辑（离线）：
-- PDF逐页渲染 -> 旋转 -> ROI裁剪 -> OCR -> 导出Excel
+- PDF逐页渲染 -> 旋转 -> ROI裁剪 -> OCR -> 导出Excel（clip模式只渲染ROI，电子发票优先读文字层）
 - 固定ROI配置路径：C:\\Users\\MY43DN\\Documents\\ocr\\roi_config.json
 - 票号：严格只提取 20 位纯数字（不拼接、不退化）
 - 日期：YYYYMMDD
 - 新增：progress_hook(current_page, total_pages) 回调，用于UI进度条
+- 多文件/多进程/批量识别、结果缓存、续跑、去重、多版式等选项见 iter_pdf_rows / iter_batch_rows
+- 重型依赖（fitz/numpy/cv2/rapidocr）延迟到第一次使用时导入
 """
 
+from __future__ import annotations
+
 import re
+import csv
+import base64
+import contextlib
+import gc
 import json
+import hashlib
+import math
+import time
 from pathlib import Path
 import os
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from invoice_cache import ResultCache
+from invoice_debug import DebugWriter, open_worker_writer
+from invoice_journal import PageJournal, run_tag
+from invoice_timing import StageTimer, LazyModule
 
-import fitz  # PyMuPDF
-import numpy as np
-import cv2
-import pandas as pd
-from rapidocr import RapidOCR
+# 重型依赖第一次用到时才导入：import invoice_core 本身只要几毫秒，CLI/子进程启动不再为用不到的模块付费
+fitz = LazyModule("fitz")  # PyMuPDF
+np = LazyModule("numpy")
+cv2 = LazyModule("cv2")
+rapidocr = LazyModule("rapidocr")
+rapidocr_rec = LazyModule("rapidocr.ch_ppocr_rec")
+
+if TYPE_CHECKING:
+    from rapidocr import RapidOCR
 
 ROI_CONFIG_PATH = r"C:\Users\MY43DN\Documents\ocr\roi_config.json"
 
+# 三个ROI字段（roi_config.json 中的键）
+ROI_FIELDS = ("invoice_no", "invoice_date", "total_amount")
+# 各字段OCR前要求的最小像素高度（与 upscale_if_small 的 min_h 一致）
+FIELD_MIN_H = {"invoice_no": 70, "invoice_date": 60, "total_amount": 60}
 
-def rotate_img(img, rotate: str):
+# 分阶段计时：只在 use_timer() 范围内生效；未开启时 timed() 返回同一个空上下文
+_TIMER = None
+_NO_TIMING = contextlib.nullcontext()
+
+
+def timed(stage: str):
+    return _TIMER.stage(stage) if _TIMER is not None else _NO_TIMING
+
+
+def timed_page(pdf_path: str, page_indices):
+    return _TIMER.page(pdf_path, page_indices) if _TIMER is not None else _NO_TIMING
+
+
+def note_attempt(field: str | None, kind: str, retry: bool = False):
+    if _TIMER is not None:
+        _TIMER.attempt(field or "roi", kind, retry)
+
+
+@contextlib.contextmanager
+def use_timer(timer: StageTimer | None):
+    """在此范围内把各阶段耗时记到 timer（None 则不计时）"""
+    global _TIMER
+    prev, _TIMER = _TIMER, timer
+    try:
+        yield timer
+    finally:
+        _TIMER = prev
+
+
+def canonical_rotate(rotate: str) -> str:
+    """rotate参数归一化为 0 / cw90 / ccw90 / 180"""
     rotate = (rotate or "0").lower()
     if rotate in ["0", "none"]:
-        return img
+        return "0"
     if rotate in ["cw90", "90", "right", "r"]:
-        return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+        return "cw90"
     if rotate in ["ccw90", "-90", "left", "l"]:
-        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+        return "ccw90"
     if rotate in ["180", "flip"]:
-        return cv2.rotate(img, cv2.ROTATE_180)
+        return "180"
     raise ValueError(f"不支持的rotate参数: {rotate}")
 
 
+def rotate_img(img, rotate: str):
+    rotate = canonical_rotate(rotate)
+    if rotate == "cw90":
+        return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+    if rotate == "ccw90":
+        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    if rotate == "180":
+        return cv2.rotate(img, cv2.ROTATE_180)
+    return img
+
+
+def deskew_img(img, angle: float):
+    """按页面倾斜角（度，逆时针为正，同 cv2.getRotationMatrix2D）反向转正一小块图；边缘用近邻像素填充"""
+    if img is None or img.size == 0 or not angle:
+        return img
+    h, w = img.shape[:2]
+    M = cv2.getRotationMatrix2D((w / 2.0, h / 2.0), -angle, 1.0)
+    return cv2.warpAffine(img, M, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+def pixmap_view(pix: fitz.Pixmap):
+    """Pixmap像素的 ndarray 视图（不拷贝，只在 pix 存活期间有效）"""
+    return np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+
+
+def pixels_to_bgr(img):
+    """Pixmap像素（RGB/带alpha）-> BGR，总是返回新数组"""
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+
+
+def pixmap_to_bgr(pix: fitz.Pixmap):
+    return pixels_to_bgr(pixmap_view(pix))
+
+
+def pixels_to_roi(img, gray: bool):
+    """裁剪块 -> 流水线格式：gray=True 时（灰度Pixmap）复制成单通道二维数组，否则转BGR"""
+    if gray:
+        return img[:, :, 0].copy()
+    return pixels_to_bgr(img)
+
+
+def to_engine_input(img):
+    """识别模型需要3通道：单通道图只在这里（推理入口）展开一次"""
+    if img is not None and img.ndim == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    return img
+
+
+def pixmap_colorspace(gray: bool):
+    return fitz.csGRAY if gray else fitz.csRGB
+
+
 def render_pdf_page_to_bgr(doc: fitz.Document, page_index: int, dpi: int):
     page = doc[page_index]
     pix = page.get_pixmap(dpi=dpi)
-    img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
-    if pix.n == 4:
-        img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    return pixmap_to_bgr(pix)
+
+
+def norm_box_to_page_rect(page: fitz.Page, norm_box, rotate: str) -> fitz.Rect:
+    """
+    把“旋转后整页图像”上的相对ROI反向映射回PDF页面坐标（与 page.rect / get_pixmap(clip=...) 同一坐标系）。
+    整页渲染图像与 page.rect 等比例对应，因此只需撤销 rotate_img 的旋转。
+    """
+    x1, y1, x2, y2 = norm_box["x1"], norm_box["y1"], norm_box["x2"], norm_box["y2"]
+    rotate = canonical_rotate(rotate)
+    if rotate == "cw90":
+        # 顺时针90°：旋转后(u', v') <- 旋转前(u=v', v=1-u')
+        u1, v1, u2, v2 = y1, 1 - x2, y2, 1 - x1
+    elif rotate == "ccw90":
+        # 逆时针90°：旋转前(u=1-v', v=u')
+        u1, v1, u2, v2 = 1 - y2, x1, 1 - y1, x2
+    elif rotate == "180":
+        u1, v1, u2, v2 = 1 - x2, 1 - y2, 1 - x1, 1 - y1
     else:
-        img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-    return img
+        u1, v1, u2, v2 = x1, y1, x2, y2
+    r = page.rect
+    return fitz.Rect(
+        r.x0 + u1 * r.width, r.y0 + v1 * r.height,
+        r.x0 + u2 * r.width, r.y0 + v2 * r.height,
+    )
+
+
+def clip_dpi_for_rect(rect: fitz.Rect, rotate: str, base_dpi: int, min_h: int) -> int:
+    """局部渲染DPI：至少 base_dpi，且保证旋转后的裁剪图高度 >= min_h（从而无需再 upscale_if_small）"""
+    h_pt = rect.width if canonical_rotate(rotate) in ("cw90", "ccw90") else rect.height
+    if h_pt <= 0:
+        return base_dpi
+    need = int(np.ceil(min_h * 72.0 / h_pt))
+    return max(int(base_dpi), need)
+
+
+def render_pdf_clip_to_bgr(page: fitz.Page, rect: fitz.Rect, dpi: int, gray: bool = False):
+    """只渲染页面中的 rect 区域；gray=True 时直接按灰度渲染，返回单通道图"""
+    rect = rect & page.rect
+    if rect.is_empty:
+        return None
+    pix = page.get_pixmap(dpi=dpi, clip=rect, colorspace=pixmap_colorspace(gray))
+    if pix.width <= 0 or pix.height <= 0:
+        return None
+    return pixels_to_roi(pixmap_view(pix), gray)
+
+
+def rotated_roi_to_src_box(W: int, H: int, norm_box, rotate: str):
+    """
+    “整幅旋转后按相对坐标裁剪”的像素框，换算到未旋转图像（W x H）上：返回 (x1, y1, x2, y2) 或 None。
+    先在原图上裁这个框、再只旋转这一小块，与 crop_by_norm(rotate_img(img)) 逐像素一致。
+    """
+    rotate = canonical_rotate(rotate)
+    RW, RH = (H, W) if rotate in ("cw90", "ccw90") else (W, H)
+    x1 = max(0, int(norm_box["x1"] * RW))
+    y1 = max(0, int(norm_box["y1"] * RH))
+    x2 = min(RW, int(norm_box["x2"] * RW))
+    y2 = min(RH, int(norm_box["y2"] * RH))
+    if x2 <= x1 or y2 <= y1:
+        return None
+    if rotate == "cw90":
+        # 旋转后 (x', y') <- 原图 (x=y', y=H-1-x')
+        return y1, H - x2, y2, H - x1
+    if rotate == "ccw90":
+        # 旋转后 (x', y') <- 原图 (x=W-1-y', y=x')
+        return W - y2, x1, W - y1, x2
+    if rotate == "180":
+        return W - x2, H - y2, W - x1, H - y1
+    return x1, y1, x2, y2
+
+
+def crop_rotated_roi(img, norm_box, rotate: str):
+    """在未旋转的整幅图上裁出“旋转后图像”的ROI，只旋转裁剪块（不产生整幅旋转副本）"""
+    H, W = img.shape[:2]
+    box = rotated_roi_to_src_box(W, H, norm_box, rotate)
+    if box is None:
+        return None
+    x1, y1, x2, y2 = box
+    return rotate_img(img[y1:y2, x1:x2], rotate)
+
+
+def render_page_view(doc: fitz.Document, page_index: int, dpi: int, gray: bool = False):
+    """整页渲染，返回 (pix, 像素视图)；视图只在 pix 存活期间有效，调用方需一直持有 pix"""
+    with timed("render"):
+        pix = doc[page_index].get_pixmap(dpi=dpi, colorspace=pixmap_colorspace(gray))
+        return pix, pixmap_view(pix)
+
+
+def crop_rois_full(doc: fitz.Document, page_index: int, cfg, dpi: int, rotate: str, fields=ROI_FIELDS,
+                   gray: bool = False, view=None):
+    """
+    整页渲染 -> 按相对坐标裁剪ROI：ROI反向映射到未旋转的渲染图上，
+    只对裁剪块做旋转和RGB->BGR，整页只有 Pixmap 本身一份内存（不再整页 cvtColor / rotate）。
+    gray=True：直接按灰度渲染，ROI为单通道图
+    view：已渲染好的 (pix, 像素视图)（自动方向检测时复用同一次渲染）
+    cfg["skew"]：本页倾斜角，裁剪块旋转后再各自转正
+    """
+    pix, img = view or render_page_view(doc, page_index, dpi, gray)
+    skew = cfg.get("skew", 0.0)
+    rois = {}
+    for f in fields:
+        with timed("crop"):
+            H, W = img.shape[:2]
+            box = rotated_roi_to_src_box(W, H, cfg[f], rotate)
+            if box is None:
+                rois[f] = None
+                continue
+            x1, y1, x2, y2 = box
+            roi = pixels_to_roi(img[y1:y2, x1:x2], gray)
+        with timed("rotate"):
+            rois[f] = deskew_img(rotate_img(roi, rotate), skew)
+    return rois
+
+
+def crop_rois_clip(doc: fitz.Document, page_index: int, cfg, dpi: int, rotate: str, fields=ROI_FIELDS,
+                   gray: bool = False):
+    """
+    局部渲染：每个ROI反向映射到PDF页面坐标后单独渲染，再旋转这一小块。
+    每个ROI可在配置中单独指定 "dpi"，否则按 FIELD_MIN_H 自动取足够的DPI。
+    """
+    page = doc[page_index]
+    skew = cfg.get("skew", 0.0)
+    rois = {}
+    for f in fields:
+        box = cfg[f]
+        rect = norm_box_to_page_rect(page, box, rotate)
+        field_dpi = box.get("dpi") or clip_dpi_for_rect(rect, rotate, dpi, FIELD_MIN_H[f])
+        with timed("render"):
+            img = render_pdf_clip_to_bgr(page, rect, int(field_dpi), gray=gray)
+        with timed("rotate"):
+            rois[f] = deskew_img(rotate_img(img, rotate), skew) if img is not None else None
+    return rois
 
 
 def crop_by_norm(img, norm_box):
@@ -70,13 +306,15 @@ def upscale_if_small(img_bgr, min_h=70):
 
 
 def light_preprocess(img_bgr):
+    """模糊 + CLAHE；输入单通道图时全程单通道并返回单通道（灰度流水线），否则返回BGR"""
     if img_bgr is None or img_bgr.size == 0:
         return img_bgr
-    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
+    single = img_bgr.ndim == 2
+    gray = img_bgr if single else cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
     gray = cv2.GaussianBlur(gray, (3, 3), 0)
     clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
     gray = clahe.apply(gray)
-    return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+    return gray if single else cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
 
 
 def get_txt_from_rapid_output(out):
@@ -90,41 +328,35 @@ def get_txt_from_rapid_output(out):
 
 
 def extract_no20_only(text: str) -> str | None:
-    """严格只提取20位纯数字票号"""
+    """
+    严格只提取20位纯数字票号：识别文本里的数字正好20位才算通过。
+    只识别（不检测）时偶尔会多读出一位（21位），截取前20位会得到一个“合格”的错号，
+    所以多于或少于20位一律不通过，交给策略链的下一个策略 / 更高DPI档
+    """
     if not text:
         return None
     digits = re.sub(r"\D", "", text)
-    m = re.search(r"\d{20}", digits)
-    return m.group(0) if m else None
+    return digits if len(digits) == 20 else None
 
 
-def ocr_inv_text(engine: RapidOCR, img_bgr) -> str:
-    """票号区域：强制 use_det=True 更稳"""
-    if img_bgr is None or img_bgr.size == 0:
-        return ""
-    img1 = upscale_if_small(img_bgr, min_h=70)
+def ocr_rec(engine: RapidOCR, img, field: str | None = None, retry: bool = False, kind: str = "rec") -> str:
+    """不检测直接识别（整张图当一行文字）；field/retry/kind 只用于计时记录"""
+    note_attempt(field, kind, retry)
     try:
-        out = engine(img1, use_det=True, use_cls=False, use_rec=True, box_thresh=0.3, text_score=0.3)
+        with timed("ocr_rec"):
+            out = engine(to_engine_input(img), use_det=False, use_cls=False, use_rec=True)
         return get_txt_from_rapid_output(out)
     except Exception:
         return ""
 
 
-def ocr_text_simple(engine: RapidOCR, img_bgr) -> str:
-    """日期/金额：优先不检测直接识别，失败再det重试"""
-    if img_bgr is None or img_bgr.size == 0:
-        return ""
-    img1 = upscale_if_small(img_bgr, min_h=60)
-    img1 = light_preprocess(img1)
-    try:
-        out = engine(img1, use_det=False, use_cls=False, use_rec=True)
-        t = get_txt_from_rapid_output(out)
-        if t:
-            return t
-    except Exception:
-        pass
+def ocr_det_rec(engine: RapidOCR, img, field: str | None = None, retry: bool = False, kind: str = "det+rec") -> str:
+    """先检测文字框再识别；field/retry/kind 只用于计时记录"""
+    note_attempt(field, kind, retry)
     try:
-        out = engine(img1, use_det=True, use_cls=False, use_rec=True, box_thresh=0.3, text_score=0.3)
+        with timed("ocr_det_rec"):
+            out = engine(to_engine_input(img), use_det=True, use_cls=False, use_rec=True,
+                         box_thresh=0.3, text_score=0.3)
         return get_txt_from_rapid_output(out)
     except Exception:
         return ""
@@ -151,88 +383,2106 @@ def normalize_amount(s: str):
 
 
 def load_roi_config(path=ROI_CONFIG_PATH):
+    """有 "profiles"（多版式）时各版式展开为完整配置，见 resolve_profiles"""
     p = Path(path)
     if not p.exists():
         raise FileNotFoundError(f"ROI配置不存在：{path}")
-    return json.loads(p.read_text(encoding="utf-8"))
+    cfg = json.loads(p.read_text(encoding="utf-8"))
+    if cfg.get("profiles"):
+        cfg["profiles"] = resolve_profiles(cfg, p.parent)
+    return cfg
+
+
+# 字段校验/归一化：返回 None 表示不合格
+FIELD_VALIDATORS = {
+    "invoice_no": extract_no20_only,
+    "invoice_date": normalize_date_to_yyyymmdd,
+    "total_amount": normalize_amount,
+}
+FIELD_LABELS = {"invoice_no": "票号", "invoice_date": "日期", "total_amount": "金额"}
+
+
+def resolve_render_mode(cfg, render_mode: str | None = None) -> str:
+    render_mode = (render_mode or cfg.get("render_mode") or "full").lower()
+    if render_mode not in ("full", "clip"):
+        raise ValueError(f"不支持的render_mode参数: {render_mode}")
+    return render_mode
+
+
+def resolve_color_mode(cfg, color_mode: str | None = None) -> str:
+    """bgr=原来的3通道流水线；gray=单通道灰度流水线"""
+    color_mode = (color_mode or cfg.get("color_mode") or "bgr").lower()
+    if color_mode not in ("bgr", "gray"):
+        raise ValueError(f"不支持的color_mode参数: {color_mode}")
+    return color_mode
+
+
+def resolve_batch_size(cfg, batch_size: int | None = None) -> int:
+    """批量识别大小：None 时取配置中的 rec_batch_size；<=1 表示不批量"""
+    if batch_size is None:
+        batch_size = cfg.get("rec_batch_size", 1)
+    return max(1, int(batch_size or 1))
+
 
+# 进批量识别的字段：只放校验严格的字段（票号必须正好20位），批量只识别读错时能被校验拦下再逐张重试；
+# 日期/金额的校验较宽，批量缩放后读错的值可能直接通过，默认逐张走自己的策略链
+DEFAULT_BATCH_FIELDS = ("invoice_no",)
 
-def extract_pdf_to_rows(pdf_path: str, debug_dir: str | None = None, progress_hook=None):
+
+def resolve_batch_fields(cfg):
+    """配置 "rec_batch_fields" > 默认（只有票号）"""
+    fields = tuple(cfg.get("rec_batch_fields") or DEFAULT_BATCH_FIELDS)
+    unknown = [f for f in fields if f not in ROI_FIELDS]
+    if unknown:
+        raise ValueError(f"不支持的批量识别字段: {unknown}（可选：{list(ROI_FIELDS)}）")
+    return fields
+
+
+def resolve_options(cfg, render_mode: str | None = None, batch_size: int | None = None,
+                    text_layer: bool | None = None, color_mode: str | None = None, anchor: bool | None = None,
+                    auto_rotate: bool | None = None, lazy_det: bool | None = None):
     """
-    progress_hook: callable(current_page:int, total_pages:int)
+    合并“参数 > ROI配置 > 默认值”，得到一次运行的选项dict（会传给worker进程，需可pickle）
+    """
+    if lazy_det is None:
+        lazy_det = (cfg.get("engine") or {}).get("lazy_det", False)
+    profiles = (cfg.get("profiles") or {}).values()
+    has_anchor = bool(cfg.get("anchor")) or any(p.get("anchor") for p in profiles)
+    return {
+        "render_mode": resolve_render_mode(cfg, render_mode),
+        "batch_size": resolve_batch_size(cfg, batch_size),
+        "batch_fields": resolve_batch_fields(cfg),
+        "text_layer": bool(cfg.get("text_layer", False) if text_layer is None else text_layer),
+        "color_mode": resolve_color_mode(cfg, color_mode),
+        # 配置（或任一版式）里有锚点模板时默认开启重定位；anchor=False 可关闭
+        "anchor": has_anchor if anchor is None else bool(anchor and has_anchor),
+        "auto_rotate": bool(cfg.get("auto_rotate", False) if auto_rotate is None else auto_rotate),
+        "lazy_det": bool(lazy_det),
+        "layouts": bool(cfg.get("profiles")),
+    }
+
+
+# ------------------ ONNX Runtime 会话参数：线程数（经RapidOCR自己的 EngineConfig.onnxruntime 配置传入） ------------------
+# 配置 "engine"：{"intra_op_threads", "inter_op_threads", "lazy_det"}
+ENGINE_DEFAULTS = {"intra_op_threads": None, "inter_op_threads": None}
+
+
+def resolve_engine_config(cfg, intra_op_threads: int | None = None) -> dict | None:
+    """
+    配置 "engine" 段 -> 会话参数；没有该段返回 None（保持RapidOCR默认行为）。
+    intra_op_threads（多进程时按核数均分的线程数）只在配置没写死线程数时使用。
+    """
+    section = (cfg or {}).get("engine")
+    if not section:
+        return None
+    ecfg = {**ENGINE_DEFAULTS, **section}
+    if not ecfg["intra_op_threads"] and intra_op_threads:
+        ecfg["intra_op_threads"] = int(intra_op_threads)
+    return ecfg
+
+
+def create_engine(intra_op_threads: int | None = None, rec_batch_num: int | None = None,
+                  engine_cfg: dict | None = None, lazy_det: bool = False) -> RapidOCR:
+    """
+    创建RapidOCR：
+    - intra_op_threads：多进程时限制每个进程的ONNX线程数，避免抢核
+    - rec_batch_num：识别模型一次推理的图片数（批量识别时使用）
+    - engine_cfg：resolve_engine_config 的结果（会话线程数），None 用RapidOCR默认
+    - lazy_det：返回 LazyDetEngine，启动时只保留识别模型，第一次 use_det=True 时才加载完整引擎
     """
-    cfg = load_roi_config()
-    dpi = int(cfg.get("dpi", 300))
+    with timed("engine_init"):
+        if lazy_det:
+            return LazyDetEngine(lambda rec_only: _create_engine(intra_op_threads, rec_batch_num, engine_cfg,
+                                                                 rec_only=rec_only))
+        return _create_engine(intra_op_threads, rec_batch_num, engine_cfg)
+
+
+def _create_engine(intra_op_threads: int | None, rec_batch_num: int | None,
+                   engine_cfg: dict | None = None, rec_only: bool = False) -> RapidOCR:
+    if engine_cfg and engine_cfg.get("intra_op_threads"):
+        intra_op_threads = engine_cfg["intra_op_threads"]
+    params = {}
+    if intra_op_threads:
+        params["EngineConfig.onnxruntime.intra_op_num_threads"] = int(intra_op_threads)
+    if engine_cfg and engine_cfg.get("inter_op_threads"):
+        params["EngineConfig.onnxruntime.inter_op_num_threads"] = int(engine_cfg["inter_op_threads"])
+    if rec_batch_num:
+        params["Rec.rec_batch_num"] = int(rec_batch_num)
+    if rec_only:
+        params["Global.use_det"] = False
+        params["Global.use_cls"] = False
+    return rapidocr.RapidOCR(params=params) if params else rapidocr.RapidOCR()
+
+
+class LazyDetEngine:
+    """
+    只识别引擎：固定ROI的日期/金额/票号大多 use_det=False 一次就通过，检测和方向分类模型常常用不到。
+    启动时建一个只识别的RapidOCR，并释放它已加载的检测/分类模型（旧版构造时总会加载）；
+    第一次调用 use_det=True 时才建完整引擎替换掉它（同一时刻只保留一套模型）。
+    其余属性转发给当前引擎（批量识别取识别模型时用）。
+    """
+
+    def __init__(self, factory):
+        self._factory = factory  # callable(rec_only: bool) -> RapidOCR
+        self.engine = factory(True)
+        for attr in ("text_det", "text_cls"):
+            if getattr(self.engine, attr, None) is not None:
+                setattr(self.engine, attr, None)
+        gc.collect()
+        self.det_loaded = False
+
+    def load_det(self):
+        if self.det_loaded:
+            return
+        with timed("engine_init"):
+            full = self._factory(False)
+        self.engine, self.det_loaded = full, True
+        gc.collect()
+
+    def __call__(self, img, use_det=None, **kwargs):
+        if use_det:
+            self.load_det()
+        return self.engine(img, use_det=use_det, **kwargs)
+
+    def __getattr__(self, name):
+        if name == "engine":
+            raise AttributeError(name)
+        return getattr(self.engine, name)
+
+
+def warm_up_engine(engine: RapidOCR):
+    """
+    用一张空白小图跑一次，提前把模型加载进内存（常驻worker启动时用）；
+    LazyDetEngine 只预热识别，不为预热加载检测模型
+    """
+    blank = np.full((48, 160, 3), 255, dtype=np.uint8)
+    use_det = not isinstance(engine, LazyDetEngine)
+    try:
+        engine(blank, use_det=use_det, use_cls=False, use_rec=True)
+    except Exception:
+        pass
+
+
+# ------------------ 进程内存：每个worker的RSS，便于估算一台机器能放几个worker ------------------
+WORKER_MEMORY = {}  # pid -> engine_memory()，多进程时由 _merge_worker_stats 汇总
+
+
+def process_rss_mb() -> float | None:
+    """当前进程RSS（MB）：Linux 读 /proc/self/statm，其它平台有 psutil 时用 psutil，都没有返回 None"""
+    try:
+        with open("/proc/self/statm", "r") as fh:
+            pages = int(fh.read().split()[1])
+        return round(pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return round(psutil.Process().memory_info().rss / (1024 * 1024), 1)
+
+
+def engine_memory(engine) -> dict:
+    """本进程的RSS和引擎状态：full（完整引擎）/ rec（只识别）/ rec+det（只识别引擎已按需加载检测）"""
+    if isinstance(engine, LazyDetEngine):
+        state = "rec+det" if engine.det_loaded else "rec"
+    else:
+        state = "full" if engine is not None else "none"
+    return {"pid": os.getpid(), "rss_mb": process_rss_mb(), "engine": state}
+
+
+def format_worker_memory() -> str:
+    """每个进程一行：pid RSS 引擎状态；单进程时只有主进程"""
+    mems = list(WORKER_MEMORY.values())
+    return "\n".join(f"pid={m['pid']} rss={m['rss_mb']}MB engine={m['engine']}" for m in mems)
+
+
+def make_row(pdf_path: str, page_index: int, values, sources=None):
+    """values: {字段: 归一化后的值}；sources: {字段: "text"/"ocr"}（开启文字层时输出“识别来源”列）"""
+    ticket20 = values.get("invoice_no")
+    row = {
+        "文件名": Path(pdf_path).name,
+        "页码": page_index + 1,
+        "票号20位": ticket20,
+        "票号完整": "Y" if (ticket20 and len(ticket20) == 20) else "N",
+        "开票日期": values.get("invoice_date"),
+        "价税合计": values.get("total_amount")
+    }
+    if sources:
+        row["识别来源"] = " ".join(f"{FIELD_LABELS[f]}:{sources[f]}" for f in ROI_FIELDS if f in sources)
+    return row
+
+
+def debug_page_status(row) -> str:
+    """调试图抽样用：failed=有字段没通过校验；suspect=没找到锚点（ROI未平移）或页面方向没确认；其余 ok"""
+    if row.get("票号完整") != "Y" or row.get("开票日期") is None or row.get("价税合计") is None:
+        return "failed"
+    if str(row.get("ROI偏移") or "").startswith("未找到锚点") or "未" in str(row.get("页面方向") or ""):
+        return "suspect"
+    return "ok"
+
+
+def save_debug_rois(dbg: DebugWriter, pdf_path: str, page_index: int, rois, row):
+    """只放进后台写出队列（队列满时才等待），编码和写盘不占识别线程"""
+    dbg.submit(f"{Path(pdf_path).stem}_p{page_index+1:02d}", rois, debug_page_status(row))
+
+
+def open_debug_writer(debug_dir: str | None, debug_writer: DebugWriter | None = None):
+    """-> (写出器, 是否由本函数新建)；只给 debug_dir 时按默认设置新建，由调用处用完关闭"""
+    if debug_writer is not None:
+        return debug_writer, False
+    if debug_dir:
+        return DebugWriter(debug_dir), True
+    return None, False
+
+
+# ------------------ 文字层快速通道：电子发票直接读矢量文字 ------------------
+def text_layer_fields(page: fitz.Page, cfg, rotate: str, fields=ROI_FIELDS):
+    """
+    按ROI读取PDF文字层（PyMuPDF），经字段校验后返回 {字段: 值或None}。
+    文字坐标是未旋转页面坐标，ROI矩形需先乘 derotation_matrix。
+    整页只建一次 TextPage，没有文字的扫描件几乎零开销。
+    """
+    words = page.get_text("words")
+    if not words:
+        return {f: None for f in fields}
+
+    out = {}
+    for f in fields:
+        rect = norm_box_to_page_rect(page, cfg[f], rotate) * page.derotation_matrix
+        hit = [w for w in words if fitz.Point((w[0] + w[2]) / 2, (w[1] + w[3]) / 2) in rect]
+        hit.sort(key=lambda w: (w[5], w[6], w[7]))  # block, line, word
+        out[f] = FIELD_VALIDATORS[f](" ".join(w[4] for w in hit))
+    return out
+
+
+# ------------------ 锚点重定位：低分辨率下匹配锚点模板，整页ROI按偏移平移 ------------------
+# 配置 "anchor"：{"x1","y1","x2","y2"（旋转后页面相对坐标）, "template"（灰度PNG的base64，calibrate_roi.py 生成）,
+#                 "dpi"（模板分辨率）, "search"（搜索窗口向外扩的相对距离）, "min_score"（低于此匹配度不平移）}
+ANCHOR_DEFAULTS = {"dpi": 100, "search": 0.04, "min_score": 0.6}
+_ANCHOR_TEMPLATES = {}
+
+
+def anchor_template(anchor):
+    """解码锚点模板（灰度图）；同一份base64只解码一次"""
+    b64 = anchor["template"]
+    tpl = _ANCHOR_TEMPLATES.get(b64)
+    if tpl is None:
+        buf = np.frombuffer(base64.b64decode(b64), dtype=np.uint8)
+        tpl = _ANCHOR_TEMPLATES[b64] = cv2.imdecode(buf, cv2.IMREAD_GRAYSCALE)
+    return tpl
+
+
+def encode_anchor_template(gray) -> str:
+    return base64.b64encode(cv2.imencode(".png", gray)[1].tobytes()).decode("ascii")
+
+
+def locate_anchor(doc: fitz.Document, page_index: int, cfg):
+    """
+    只按低DPI灰度渲染锚点周围的搜索窗口，模板匹配找到锚点。
+    返回 {"dx", "dy"（相对坐标偏移）, "score", "found"}；没配锚点返回 None
+    """
+    anchor = cfg.get("anchor")
+    if not anchor or not anchor.get("template"):
+        return None
+    a = {**ANCHOR_DEFAULTS, **anchor}
+    m = float(a["search"])
+    win = {"x1": max(0.0, a["x1"] - m), "y1": max(0.0, a["y1"] - m),
+           "x2": min(1.0, a["x2"] + m), "y2": min(1.0, a["y2"] + m)}
+    tpl = anchor_template(anchor)
+    page = doc[page_index]
     rotate = cfg.get("rotate", "0")
+    with timed("anchor"):
+        img = render_pdf_clip_to_bgr(page, norm_box_to_page_rect(page, win, rotate), int(a["dpi"]), gray=True)
+        img = rotate_img(img, rotate) if img is not None else None
+        if img is None or img.shape[0] < tpl.shape[0] or img.shape[1] < tpl.shape[1]:
+            return {"dx": 0.0, "dy": 0.0, "score": 0.0, "found": False}
+        res = cv2.matchTemplate(img, tpl, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (bx, by) = cv2.minMaxLoc(res)
+    h, w = img.shape[:2]
+    sx, sy = (win["x2"] - win["x1"]) / w, (win["y2"] - win["y1"]) / h
+    dx = bx * sx - (a["x1"] - win["x1"])
+    dy = by * sy - (a["y1"] - win["y1"])
+    found = score >= float(a["min_score"])
+    return {"dx": dx if found else 0.0, "dy": dy if found else 0.0, "score": float(score), "found": found}
+
+
+def shift_rois(cfg, dx: float, dy: float):
+    """返回三个ROI整体平移后的配置副本（平移后仍限制在页面内）"""
+    out = dict(cfg)
+    for f in ROI_FIELDS:
+        box = dict(cfg[f])
+        ddx = min(max(dx, -box["x1"]), 1.0 - box["x2"])
+        ddy = min(max(dy, -box["y1"]), 1.0 - box["y2"])
+        box.update(x1=box["x1"] + ddx, x2=box["x2"] + ddx, y1=box["y1"] + ddy, y2=box["y2"] + ddy)
+        out[f] = box
+    return out
+
+
+def relocate_rois(doc: fitz.Document, page_index: int, cfg, opts):
+    """开启锚点时返回 (平移后的配置, 定位结果)，否则 (cfg, None)"""
+    if not opts.get("anchor"):
+        return cfg, None
+    info = locate_anchor(doc, page_index, cfg)
+    if not info or not info["found"]:
+        return cfg, info
+    return shift_rois(cfg, info["dx"], info["dy"]), info
+
+
+def format_anchor_offset(doc: fitz.Document, page_index: int, cfg, info) -> str | None:
+    """每页偏移日志（“ROI偏移”列）：毫米 + 匹配度；没找到锚点时注明未平移"""
+    if info is None:
+        return None
+    if not info["found"]:
+        return f"未找到锚点 score={info['score']:.2f}"
+    rect = doc[page_index].rect
+    w, h = (rect.height, rect.width) if canonical_rotate(cfg.get("rotate", "0")) in ("cw90", "ccw90") \
+        else (rect.width, rect.height)
+    mm = 25.4 / 72
+    return f"dx={info['dx'] * w * mm:+.1f}mm dy={info['dy'] * h * mm:+.1f}mm score={info['score']:.2f}"
+
+
+# ------------------ 自动方向/倾斜：小缩略图上的投影轮廓 ------------------
+ORIENT_THUMB_SIDE = 300   # 缩略图长边像素
+ORIENT_THUMB_DPI = 30     # 局部渲染模式下单独渲染缩略图的DPI
+ORIENT_MAX_POINTS = 6000  # 投影最多用这么多墨迹点（多了等间隔抽样）
+DEFAULT_MAX_SKEW = 3.0    # 倾斜角搜索范围（度）
+MIN_DESKEW = 0.3          # 小于此角度不转正裁剪块
+
+
+def page_thumbnail(img, side: int = ORIENT_THUMB_SIDE):
+    """整页渲染图 -> 灰度缩略图：按整数步长抽样（比缩放快得多，投影轮廓够用）"""
+    h, w = img.shape[:2]
+    k = max(1, int(round(max(h, w) / float(side))))
+    small = img[::k, ::k]
+    if small.ndim == 3:
+        small = small[:, :, 1] if small.shape[2] >= 3 else small[:, :, 0]
+    return np.ascontiguousarray(small)
+
+
+def text_ink_points(thumb, max_points: int = ORIENT_MAX_POINTS):
+    """二值化后去掉表格长线，只留文字笔画的像素坐标 (ys, xs)；点太多时等间隔抽样"""
+    _, bw = cv2.threshold(thumb, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    L = max(15, min(thumb.shape[:2]) // 12)
+    lines = cv2.morphologyEx(bw, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (L, 1))) | \
+        cv2.morphologyEx(bw, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (1, L)))
+    text = cv2.subtract(bw, cv2.dilate(lines, np.ones((3, 3), np.uint8)))
+    ys, xs = np.nonzero(text)
+    k = max(1, len(ys) // max_points)
+    return ys[::k].astype(np.float32), xs[::k].astype(np.float32)
+
+
+def _profile_sharpness(rows, n: int) -> float:
+    """行投影的相邻差平方和（按墨迹量归一）：文字行与行间空白交替越清楚越大"""
+    if n == 0:
+        return 0.0
+    hist = np.bincount((rows - rows.min()).astype(np.int32)).astype(np.float32)
+    return float(np.sum(np.diff(hist) ** 2) / n)
+
+
+def estimate_skew(ys, xs, max_skew: float = DEFAULT_MAX_SKEW):
+    """
+    在 ±max_skew 内找让行投影最“锐利”的角度：先0.5°粗搜，再在粗搜结果 ±0.2° 内按0.1°细搜。
+    返回 (倾斜角, 锐度)；角度逆时针为正（同 cv2.getRotationMatrix2D）
+    """
+    n = len(ys)
+
+    def score(a):
+        t = np.deg2rad(a)
+        # 内容逆时针转了a：把点顺时针转回去后的行坐标
+        return _profile_sharpness(ys * np.cos(t) + xs * np.sin(t), n)
+
+    coarse = max(np.arange(-max_skew, max_skew + 1e-6, 0.5), key=score)
+    fine = max(np.arange(coarse - 0.2, coarse + 0.21, 0.1), key=score)
+    return round(float(fine), 1) + 0.0, score(fine)
+
+
+def detect_orientation(thumb, rotate: str, max_skew: float = DEFAULT_MAX_SKEW):
+    """
+    缩略图 -> (候选rotate列表, 倾斜角)。
+    横排文字的行投影锐度远高于列投影：比较“原图按行”和“原图按列”两个方向的最佳锐度，
+    判断页面是否需要转90°。同一族里（0/180、cw90/ccw90）投影分不出，两个都是候选，
+    配置的 rotate 在族里时排前面；由 orient_page 用文字层或锚点确认。
+    转180°/顺逆时针90°只让投影镜像，锐度不变：倾斜角直接取这两次搜索的结果（按列时变号）。
+    """
+    ys, xs = text_ink_points(thumb)
+    a_rows, s_rows = estimate_skew(ys, xs, max_skew)
+    a_cols, s_cols = estimate_skew(xs, ys, max_skew)
+    rotate = canonical_rotate(rotate)
+    if s_cols > s_rows:
+        family, skew = ("cw90", "ccw90"), -a_cols + 0.0
+    else:
+        family, skew = ("0", "180"), a_rows
+    first = rotate if rotate in family else family[0]
+    return [first] + [r for r in family if r != first], skew
+
+
+def text_layer_rotate(page: fitz.Page, min_chars: int = 10):
+    """
+    文字层的书写方向 -> 让文字转正的 rotate（按字数投票）；没有文字层（扫描件）时 None。
+    line["dir"] 是未旋转页面坐标里的方向，渲染图还要加上页面自带的 /Rotate（顺时针）
+    """
+    votes = {}
+    for block in page.get_text("dict", flags=0)["blocks"]:
+        for line in block.get("lines", ()):
+            n = sum(len(span["text"].strip()) for span in line["spans"])
+            if n:
+                dx, dy = line["dir"]
+                a = (round(math.degrees(math.atan2(dy, dx)) / 90.0) * 90 + page.rotation) % 360
+                votes[a] = votes.get(a, 0) + n
+    if sum(votes.values()) < min_chars:
+        return None
+    # 文字在渲染图里顺时针转了 a 度：顺时针再转 360-a 度回正
+    return {0: "0", 90: "ccw90", 180: "180", 270: "cw90"}[max(votes, key=votes.get)]
+
+
+def confirm_rotate(doc: fitz.Document, page_index: int, cfg, opts, candidates):
+    """
+    同族两个方向投影分不出：先看文字层书写方向，再看锚点在哪个方向上匹配得上。
+    返回 (rotate, 依据 "text"/"anchor")；都确认不了时 (None, None)
+    """
+    rotate = text_layer_rotate(doc[page_index])
+    if rotate in candidates:
+        return rotate, "text"
+    if opts.get("anchor"):
+        for rotate in candidates:
+            info = locate_anchor(doc, page_index, {**cfg, "rotate": rotate})
+            if info is not None and info["found"]:
+                return rotate, "anchor"
+    return None, None
+
+
+def skew_rois(cfg, skew: float, page_w: float, page_h: float):
+    """
+    页面内容绕页面中心转了 skew 度：三个ROI（和锚点框）的中心跟着转（框大小不变），返回配置副本；
+    之后锚点匹配出的偏移只剩平移部分
+    """
+    out = dict(cfg)
+    M = cv2.getRotationMatrix2D((page_w / 2.0, page_h / 2.0), skew, 1.0)
+    for f in ROI_FIELDS + (("anchor",) if cfg.get("anchor") else ()):
+        box = dict(cfg[f])
+        cx, cy = (box["x1"] + box["x2"]) / 2 * page_w, (box["y1"] + box["y2"]) / 2 * page_h
+        nx, ny = M @ np.array([cx, cy, 1.0])
+        dx, dy = (nx - cx) / page_w, (ny - cy) / page_h
+        box.update(x1=box["x1"] + dx, x2=box["x2"] + dx, y1=box["y1"] + dy, y2=box["y2"] + dy)
+        out[f] = box
+    return out
+
+
+def orient_page(doc: fitz.Document, page_index: int, cfg, opts, view=None):
+    """
+    自动检测本页方向和小角度倾斜，返回 (本页配置副本, 结果)；未开启时 (cfg, None)。
+    结果 {"rotate", "skew", "basis", "skipped"}；本页配置里 rotate 换成检测到的方向，
+    skew 写入 "skew"（裁剪块转正用），ROI中心按倾斜角跟着转。
+    0/180、cw90/ccw90 只有文字层或锚点确认了才翻转（basis="text"/"anchor"），否则不猜：
+    - 配置的 rotate 在检测出的族里：按配置方向处理，basis=None（“页面方向”列标“未确认”）
+    - 横竖和配置不符：分不出顺/逆时针，跳过本页的自动转向（按配置方向、不纠偏），skipped=True
+    view：整页渲染模式下已渲染好的 (pix, 像素视图)，缩略图直接从它抽样；否则单独低DPI渲染
+    """
+    if not opts.get("auto_rotate"):
+        return cfg, None
+    page = doc[page_index]
+    configured = canonical_rotate(cfg.get("rotate", "0"))
+    with timed("orient"):
+        if view is not None:
+            thumb = page_thumbnail(view[1])
+        else:
+            pix = page.get_pixmap(dpi=ORIENT_THUMB_DPI, colorspace=fitz.csGRAY)
+            thumb = page_thumbnail(pixmap_view(pix))
+        candidates, skew = detect_orientation(thumb, configured, float(cfg.get("max_skew", DEFAULT_MAX_SKEW)))
+        rotate, basis = confirm_rotate(doc, page_index, cfg, opts, candidates)
+    skipped = False
+    if rotate is None:
+        rotate = configured
+        if configured not in candidates:
+            skew, skipped = 0.0, True
+    pcfg = {**cfg, "rotate": rotate}
+    if abs(skew) >= MIN_DESKEW:
+        rect = page.rect
+        w, h = (rect.height, rect.width) if rotate in ("cw90", "ccw90") else (rect.width, rect.height)
+        pcfg = skew_rois(pcfg, skew, w, h)
+        pcfg["skew"] = skew
+    return pcfg, {"rotate": rotate, "skew": skew, "basis": basis, "skipped": skipped}
+
+
+def format_orientation(info) -> str | None:
+    """每页方向报告（“页面方向”列）；没确认的方向带上提示，便于筛出来人工复核"""
+    if info is None:
+        return None
+    if info["skipped"]:
+        return f"{info['rotate']} 未自动转向：横竖与配置不符，无文字层/锚点分不出顺逆时针"
+    s = f"{info['rotate']} skew={info['skew']:+.1f}°"
+    return s if info["basis"] else s + " 未确认(0/180或顺逆时针)"
+
+
+# ------------------ 多版式：每页先判定版式，再用该版式的ROI配置 ------------------
+# 配置 "profiles"：{版式名: {"config": 另一份ROI配置（可选，相对本配置所在目录）, "match": 判定条件, 其余键覆盖基础配置}}
+# match：{"page_size": [宽mm, 高mm]（不分横竖）, "size_tol_mm", "keywords": [文字层关键字], "thumb": 缩略图签名, "thumb_max"}
+# 判定从便宜到贵：页面尺寸筛选 -> 文字层关键字 -> 低DPI缩略图签名 -> 只写了尺寸的版式；都不符合时用基础配置（default）
+LAYOUT_DEFAULTS = {"size_tol_mm": 6.0, "thumb_max": 24.0}
+LAYOUT_THUMB_DPI = 12   # 版式签名的渲染DPI
+LAYOUT_SIG_SIDE = 16    # 签名：缩到 16x16 的灰度图
+DEFAULT_LAYOUT = "default"
+LAYOUT_KEYS = (*ROI_FIELDS, "anchor", "rotate", "dpi")
+
+
+def resolve_profiles(cfg, base_dir: Path) -> dict:
+    """"profiles" -> {版式名: 完整配置}；每个版式在基础配置上叠加，没写的键沿用基础配置"""
+    base = {k: v for k, v in cfg.items() if k not in ("profiles", "match")}
+    profiles = {}
+    for name, prof in cfg["profiles"].items():
+        merged = dict(base)
+        if prof.get("config"):
+            # 单独校准的版式：ROI几何（框/锚点/旋转/DPI）只取自它自己的配置
+            for k in LAYOUT_KEYS:
+                merged.pop(k, None)
+            path = Path(prof["config"])
+            if not path.is_absolute():
+                path = base_dir / path
+            merged.update({k: v for k, v in load_roi_config(path).items() if k != "profiles"})
+        merged.update({k: v for k, v in prof.items() if k != "config"})
+        merged["layout"] = name
+        profiles[name] = merged
+    return profiles
+
+
+def page_size_mm(page: fitz.Page):
+    """页面尺寸（毫米，短边在前）"""
+    mm = 25.4 / 72
+    return sorted((page.rect.width * mm, page.rect.height * mm))
+
+
+def layout_signature(doc: fitz.Document, page_index: int):
+    """低DPI灰度渲染整页再缩到 16x16：只保留标题/表格线的大致位置，每页约一毫秒"""
+    pix = doc[page_index].get_pixmap(dpi=LAYOUT_THUMB_DPI, colorspace=fitz.csGRAY)
+    img = pixmap_view(pix)[:, :, 0]
+    return cv2.resize(img, (LAYOUT_SIG_SIDE, LAYOUT_SIG_SIDE), interpolation=cv2.INTER_AREA)
+
+
+def encode_layout_signature(sig) -> str:
+    return base64.b64encode(sig.tobytes()).decode("ascii")
+
+
+def signature_distance(sig, encoded: str) -> float:
+    """与配置中签名的平均灰度差（0~255）；扫描件可能转了90/180度，取四个方向中最小的"""
+    ref = np.frombuffer(base64.b64decode(encoded), dtype=np.uint8).reshape(LAYOUT_SIG_SIDE, LAYOUT_SIG_SIDE)
+    sig = sig.astype(np.int16)
+    return min(float(np.abs(np.rot90(sig, k) - ref).mean()) for k in range(4))
+
+
+def _match_layout(doc: fitz.Document, page_index: int, profiles):
+    """-> (版式名或None, 判定依据)"""
+    page = doc[page_index]
+    size = page_size_mm(page)
+    cands = []
+    for name, prof in profiles.items():
+        m = {**LAYOUT_DEFAULTS, **(prof.get("match") or {})}
+        want = m.get("page_size")
+        if want and any(abs(a - b) > m["size_tol_mm"] for a, b in zip(size, sorted(want))):
+            continue
+        cands.append((name, m))
+
+    if any(m.get("keywords") for _, m in cands):
+        text = re.sub(r"\s+", "", page.get_text("text"))
+        if text:
+            for name, m in cands:
+                if any(k in text for k in m.get("keywords") or ()):
+                    return name, "text"
+
+    best = None
+    if any(m.get("thumb") for _, m in cands):
+        sig = layout_signature(doc, page_index)
+        for name, m in cands:
+            if m.get("thumb"):
+                d = signature_distance(sig, m["thumb"])
+                if d <= m["thumb_max"] and (best is None or d < best[1]):
+                    best = (name, d)
+    if best is not None:
+        return best[0], "thumb"
+
+    for name, m in cands:
+        if m.get("page_size") and not m.get("keywords") and not m.get("thumb"):
+            return name, "size"
+    return None, "default"
+
+
+def classify_layout(doc: fitz.Document, page_index: int, cfg):
+    """
+    配置里有 "profiles" 时判定本页版式，返回 (本页配置, 判定结果 {"layout", "by", "ms"})；
+    没有多版式时返回 (cfg, None)
+    """
+    profiles = cfg.get("profiles")
+    if not profiles:
+        return cfg, None
+    t0 = time.perf_counter()
+    with timed("layout"):
+        name, by = _match_layout(doc, page_index, profiles)
+    info = {"layout": name or DEFAULT_LAYOUT, "by": by, "ms": (time.perf_counter() - t0) * 1000}
+    return (profiles[name] if name else cfg), info
+
+
+def format_layout(info) -> str | None:
+    """每页版式报告（“版式”列）：版式名 + 判定依据 + 判定耗时"""
+    if info is None:
+        return None
+    return f"{info['layout']} {info['by']} {info['ms']:.1f}ms"
+
+
+# ------------------ OCR策略链：按顺序尝试，第一个通过字段校验的结果即返回 ------------------
+def _prep_plain(img, field: str):
+    return upscale_if_small(img, min_h=FIELD_MIN_H[field])
+
+
+def _prep_light(img, field: str):
+    return light_preprocess(upscale_if_small(img, min_h=FIELD_MIN_H[field]))
+
+
+def _prep_x2(img, field: str):
+    img = upscale_if_small(img, min_h=FIELD_MIN_H[field])
+    h, w = img.shape[:2]
+    return light_preprocess(cv2.resize(img, (w * 2, h * 2), interpolation=cv2.INTER_CUBIC))
+
+
+# 策略名 -> (预处理, 是否检测)
+OCR_STRATEGIES = {
+    "rec": (_prep_plain, False),
+    "rec_pre": (_prep_light, False),
+    "det_rec": (_prep_plain, True),
+    "det_rec_pre": (_prep_light, True),
+    "det_rec_x2": (_prep_x2, True),
+}
+# 相对耗时（排序用）：只识别 << 检测+识别，放大2倍后检测更慢
+STRATEGY_COST = {"rec": 1.0, "rec_pre": 1.1, "det_rec": 4.0, "det_rec_pre": 4.2, "det_rec_x2": 8.0}
+DEFAULT_OCR_STRATEGIES = {
+    "invoice_no": ("rec", "det_rec", "det_rec_pre"),
+    "invoice_date": ("rec_pre", "det_rec_pre"),
+    "total_amount": ("rec_pre", "det_rec_pre"),
+}
+# 批量识别（只跑识别模型）对应的策略：批量失败后逐张重试时跳过它
+BATCH_STRATEGY = {"invoice_no": "rec", "invoice_date": "rec_pre", "total_amount": "rec_pre"}
+
+
+def resolve_strategies(cfg, field: str):
+    """字段的策略链：ROI内 "strategies" > 配置 "ocr_strategies"[字段] > 默认"""
+    names = cfg[field].get("strategies") or (cfg.get("ocr_strategies") or {}).get(field) \
+        or DEFAULT_OCR_STRATEGIES[field]
+    unknown = [n for n in names if n not in OCR_STRATEGIES]
+    if unknown:
+        raise ValueError(f"不支持的OCR策略: {unknown}（可选：{list(OCR_STRATEGIES)}）")
+    return list(names)
+
+
+class OcrStrategyChain:
+    """
+    每个字段一条策略链。reorder=True 时按 相对耗时 / 通过率 从小到大排序（通过率做加一平滑，
+    没试过的策略按五五开估计），所以常能通过的便宜策略会排到前面；耗时相同按配置顺序。
+    多进程时各worker用 take_stats() 交回增量，由主进程 add_stats() 汇总（同 ResultCache）。
+    """
+
+    def __init__(self, reorder: bool = True):
+        self.reorder = reorder
+        self.chains = {f: list(DEFAULT_OCR_STRATEGIES[f]) for f in ROI_FIELDS}
+        self.cost = dict(STRATEGY_COST)
+        self.stats = {}     # {字段: {策略: [尝试, 通过]}}（本进程累计，决定顺序）
+        self._pending = {}  # 还没交回主进程的增量
+        self._layout_chains = {}  # {(版式, 字段): 策略链}：多版式时各版式自己的 strategies/ocr_strategies
+
+    def configure(self, cfg):
+        self.chains = {f: resolve_strategies(cfg, f) for f in ROI_FIELDS}
+        self._layout_chains = {}
+        self.cost.update(cfg.get("strategy_cost") or {})
+        if "strategy_reorder" in cfg:
+            self.reorder = bool(cfg["strategy_reorder"])
+        return self
+
+    def chain(self, field: str, cfg=None):
+        """本页配置的策略链：多版式时按版式取（第一次用到时解析），否则为 configure 的基础配置"""
+        layout = (cfg or {}).get("layout")
+        if layout is None:
+            return self.chains[field]
+        key = (layout, field)
+        if key not in self._layout_chains:
+            self._layout_chains[key] = resolve_strategies(cfg, field)
+        return self._layout_chains[key]
+
+    def order(self, field: str, cfg=None):
+        chain = self.chain(field, cfg)
+        if not self.reorder:
+            return chain
+        per = self.stats.get(field, {})
+
+        def expected_cost(k):
+            tried, passed = per.get(chain[k], (0, 0))
+            return self.cost.get(chain[k], 1.0) * (tried + 2) / (passed + 1), k
+        return [chain[k] for k in sorted(range(len(chain)), key=expected_cost)]
+
+    def record(self, field: str, name: str, passed: bool):
+        for table in (self.stats, self._pending):
+            t = table.setdefault(field, {}).setdefault(name, [0, 0])
+            t[0] += 1
+            t[1] += int(passed)
+
+    def take_stats(self) -> dict:
+        stats, self._pending = self._pending, {}
+        return stats
+
+    def add_stats(self, stats: dict):
+        for f, per in stats.items():
+            for name, (tried, passed) in per.items():
+                t = self.stats.setdefault(f, {}).setdefault(name, [0, 0])
+                t[0] += tried
+                t[1] += passed
+
+    def summary(self) -> dict:
+        return {
+            f: {
+                "order": self.order(f),
+                "strategies": {n: {"tried": t, "passed": p, "rate": round(p / t, 4) if t else None}
+                               for n, (t, p) in self.stats.get(f, {}).items()},
+            }
+            for f in ROI_FIELDS
+        }
+
+    def format_summary(self) -> str:
+        lines = []
+        for f, st in self.summary().items():
+            detail = " ".join(f"{n}={v['passed']}/{v['tried']}" for n, v in st["strategies"].items())
+            lines.append(f"{FIELD_LABELS[f]} 顺序={'>'.join(st['order'])} {detail}".rstrip())
+        return "\n".join(lines)
+
+
+def run_strategy(engine: RapidOCR, name: str, field: str, roi, retry: bool = False) -> str:
+    prep, use_det = OCR_STRATEGIES[name]
+    with timed("preprocess"):
+        img = prep(roi, field)
+    run = ocr_det_rec if use_det else ocr_rec
+    return run(engine, img, field, retry, kind=name)
+
+
+def ocr_field(engine: RapidOCR, field: str, roi, retry: bool = False,
+              strategies: OcrStrategyChain | None = None, skip=(), dedup=None, fp=None, cfg=None):
+    """
+    单个ROI按策略链依次识别，第一个通过字段校验的值即返回（都失败返回 None）。
+    strategies=None 时按默认顺序且不统计；cfg：本页配置（多版式时按版式取策略链）；skip：已经试过的策略（如批量识别）；
+    retry=True 表示这是批量识别/低DPI校验失败后的重试
+    dedup：RoiDedup，相同（近似）的ROI直接复用之前的值；fp 为已算好的指纹
+    """
+    if roi is None or roi.size == 0:
+        return None
+    if dedup is not None:
+        fp = fp or dedup.fingerprint(roi)
+        value = dedup.get(field, fp)
+        if value is not None:
+            return value
+        value = _ocr_field_chain(engine, field, roi, retry, strategies, skip, cfg)
+        dedup.put(field, fp, value)
+        return value
+    return _ocr_field_chain(engine, field, roi, retry, strategies, skip, cfg)
+
+
+def _ocr_field_chain(engine: RapidOCR, field: str, roi, retry: bool, strategies, skip, cfg=None):
+    names = strategies.order(field, cfg) if strategies is not None else DEFAULT_OCR_STRATEGIES[field]
+    for name in names:
+        if name in skip:
+            continue
+        value = FIELD_VALIDATORS[field](run_strategy(engine, name, field, roi, retry))
+        if strategies is not None:
+            strategies.record(field, name, value is not None)
+        if value is not None:
+            return value
+        retry = True
+    return None
+
+
+# ------------------ 去重：同一次运行里相同/近似的ROI裁剪图直接复用已识别的值 ------------------
+DEDUP_HASH_H = 16  # 感知哈希的缩略图高度（宽度按比例取8的倍数）
+DEDUP_MAX_ENTRIES = 50_000    # RoiDedup 每张表最多条数（超出按最近使用淘汰）
+DUPLICATE_WINDOW = 200_000    # “重复票号”列最多记住的票号数
+
+
+def roi_fingerprint(roi, near: bool = False):
+    """
+    (精确指纹, 感知哈希位)：精确指纹为像素内容SHA1（同一页复制进多个PDF时渲染结果逐像素相同）；
+    near=True 时另算均值哈希（灰度缩到16像素高，暗于均值的位为1），用于近似匹配
+    """
+    digest = hashlib.sha1(repr((roi.shape, roi.dtype.str)).encode() + roi.tobytes()).digest()
+    if not near:
+        return digest, None
+    g = roi if roi.ndim == 2 else cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+    h, w = g.shape[:2]
+    W = max(8, int(round(w * DEDUP_HASH_H / max(h, 1) / 8)) * 8)
+    small = cv2.resize(g, (W, DEDUP_HASH_H), interpolation=cv2.INTER_AREA)
+    return digest, np.packbits(small < small.mean())
+
+
+class RoiDedup:
+    """
+    按字段记录 指纹 -> 已通过校验的值。精确指纹命中直接复用；
+    max_distance>0 时再按感知哈希的汉明距离找近似图（同尺寸才比较）。
+    注意：票号只差一两位的不同发票，感知哈希距离可能和同一张重扫的差不多，近似匹配阈值宜小；
+    重扫件主要靠输出里的“重复票号”列发现。
+    两张表各最多 max_entries 条，超出按最近使用淘汰（LRU），长批量内存不随页数增长；
+    近似匹配按哈希分段建索引（见 _bands），只和至少有一段相同的哈希比距离，不逐条扫描。
+    多进程时各进程各有一张表（只在进程内去重），命中计数用 take_stats()/add_stats() 汇总。
+    """
+
+    def __init__(self, max_distance: int = 0, max_entries: int = DEDUP_MAX_ENTRIES):
+        self.max_distance = int(max_distance)
+        self.max_entries = max(1, int(max_entries))
+        self.exact = OrderedDict()   # {(字段, 精确指纹): 值}
+        self.near = OrderedDict()    # {编号: (字段, 哈希位, 值)}，编号按写入顺序递增
+        self._buckets = {}           # {_bands 的段键: {编号}}
+        self._next_id = 0
+        self._reset()
+
+    def _reset(self):
+        self.hits = {"exact": 0, "near": 0}
+        self.misses = 0
+
+    def args(self):
+        """传给worker进程重建同样设置的去重表"""
+        return self.max_distance, self.max_entries
+
+    def fingerprint(self, roi):
+        with timed("dedup"):
+            return roi_fingerprint(roi, near=self.max_distance > 0)
+
+    def _bands(self, field: str, bits):
+        """
+        哈希按字节切成 max_distance+1 段：汉明距离 <= max_distance 的两个哈希至少有一段完全相同（抽屉原理），
+        所以只需比较至少一段相同的候选。字节数不够切时所有同尺寸哈希放一个桶（退化为在有上限的表里逐条比较）
+        """
+        raw = bits.tobytes()
+        n = self.max_distance + 1
+        if n > len(raw):
+            return [(field, len(raw), -1, b"")]
+        cuts = [len(raw) * i // n for i in range(n + 1)]
+        return [(field, len(raw), i, raw[cuts[i]:cuts[i + 1]]) for i in range(n)]
+
+    def get(self, field: str, fp):
+        digest, bits = fp
+        value = self.exact.get((field, digest))
+        if value is not None:
+            self.exact.move_to_end((field, digest))
+            self.hits["exact"] += 1
+            return value
+        if bits is not None:
+            with timed("dedup"):
+                cands = set()
+                for key in self._bands(field, bits):
+                    cands.update(self._buckets.get(key, ()))
+                for i in sorted(cands):
+                    _, other, v = self.near[i]
+                    if int(np.unpackbits(bits ^ other).sum()) <= self.max_distance:
+                        self.near.move_to_end(i)
+                        self._put_exact(field, digest, v)
+                        self.hits["near"] += 1
+                        return v
+        self.misses += 1
+        return None
+
+    def _put_exact(self, field: str, digest, value):
+        self.exact[(field, digest)] = value
+        self.exact.move_to_end((field, digest))
+        if len(self.exact) > self.max_entries:
+            self.exact.popitem(last=False)
+
+    def put(self, field: str, fp, value):
+        if value is None:
+            return
+        digest, bits = fp
+        self._put_exact(field, digest, value)
+        if bits is None:
+            return
+        i, self._next_id = self._next_id, self._next_id + 1
+        self.near[i] = (field, bits, value)
+        for key in self._bands(field, bits):
+            self._buckets.setdefault(key, set()).add(i)
+        if len(self.near) > self.max_entries:
+            old, (f, old_bits, _) = self.near.popitem(last=False)
+            for key in self._bands(f, old_bits):
+                bucket = self._buckets[key]
+                bucket.discard(old)
+                if not bucket:
+                    del self._buckets[key]
+
+    def take_stats(self) -> dict:
+        stats = {"hits": self.hits, "misses": self.misses}
+        self._reset()
+        return stats
+
+    def add_stats(self, stats: dict):
+        for k, n in stats["hits"].items():
+            self.hits[k] += n
+        self.misses += stats["misses"]
+
+    def summary(self) -> str:
+        return f"exact={self.hits['exact']} near={self.hits['near']} ocr={self.misses}"
+
+
+def flag_duplicate_invoices(rows, seen: OrderedDict, max_entries: int = DUPLICATE_WINDOW):
+    """
+    给结果行加“重复票号”列：票号之前出现过时写上首次出现的 文件名 第N页。
+    seen: {票号: (文件名, 页码)}，跨文件共用一份；只保留最近出现的 max_entries 个票号（LRU），
+    所以只在这个窗口内查重，内存不随总页数增长
+    """
+    for row in rows:
+        no = row.get("票号20位")
+        first = seen.get(no) if no else None
+        row["重复票号"] = f"{first[0]} 第{first[1]}页" if first else None
+        if first is not None:
+            seen.move_to_end(no)
+        elif no and row.get("页码"):
+            seen[no] = (row["文件名"], row["页码"])
+            if len(seen) > max_entries:
+                seen.popitem(last=False)
+        yield row
+
+
+# ------------------ 自适应DPI：每个字段从历史上能通过校验的最低DPI开始，失败再升档 ------------------
+DEFAULT_DPI_TIERS = (150, 200, 300)
+# 历史通过率文件格式版本：票号校验改为必须正好20位之前记下的低档通过率偏高（多读一位也算通过），不再沿用
+DPI_HISTORY_VERSION = 2
+
+
+def resolve_dpi_tiers(cfg, field: str):
+    """字段的DPI档位（升序）：ROI内 "dpi_tiers" > 配置 "dpi_tiers" > 默认；最高档不超过全局 dpi"""
+    base = int(cfg.get("dpi", 300))
+    tiers = cfg[field].get("dpi_tiers") or cfg.get("dpi_tiers") or DEFAULT_DPI_TIERS
+    tiers = sorted({int(d) for d in tiers if int(d) <= base} | {base})
+    return tiers
+
+
+class AdaptiveDpi:
+    """
+    每个字段一组DPI档位。按历史通过率选起始档：
+    该档尝试次数 < min_samples（还没摸清）或通过率 >= target 时从该档开始，否则跳到更高档。
+    统计每个字段最终由哪一档解决（resolved）、每档尝试/通过次数、送进OCR的像素数。
+    多进程时各worker用 take_stats() 交回增量，由主进程 add_stats() 汇总（同 ResultCache）。
+    """
+
+    def __init__(self, min_samples: int = 5, target: float = 0.9, history_path: str | None = None):
+        self.min_samples = int(min_samples)
+        self.target = float(target)
+        self.history_path = history_path
+        self.tiers = {}
+        self._layout_tiers = {}  # {(版式, 字段): 档位}：多版式时各版式自己的 dpi/dpi_tiers
+        self._reset()
+        self.history = {}  # {field: {dpi: [尝试, 通过]}}，决定起始档
+        if history_path and Path(history_path).exists():
+            try:
+                raw = json.loads(Path(history_path).read_text(encoding="utf-8"))
+                if raw.get("version") == DPI_HISTORY_VERSION:
+                    self.history = {f: {int(d): list(v) for d, v in h.items()} for f, h in raw["fields"].items()}
+            except Exception:
+                self.history = {}
+
+    def _reset(self):
+        self.attempts = {}   # {field: {dpi: [尝试, 通过]}}（本次运行）
+        self.resolved = {}   # {field: {dpi 或 "unresolved": 页数}}
+        self.pixels = {}     # {field: 送进OCR的像素数}
+
+    def configure(self, cfg):
+        self.tiers = {f: resolve_dpi_tiers(cfg, f) for f in ROI_FIELDS}
+        self._layout_tiers = {}
+        return self
+
+    def tiers_for(self, field: str, cfg=None):
+        """本页配置的档位：多版式时按版式取（第一次用到时解析），否则为 configure 的基础配置"""
+        layout = (cfg or {}).get("layout")
+        if layout is None:
+            return self.tiers[field]
+        key = (layout, field)
+        if key not in self._layout_tiers:
+            self._layout_tiers[key] = resolve_dpi_tiers(cfg, field)
+        return self._layout_tiers[key]
+
+    def start_index(self, field: str, tiers=None) -> int:
+        """历史按 (字段, DPI) 统计，各版式共用：同一DPI的通过率对不同版式的参考意义相近"""
+        tiers = tiers or self.tiers[field]
+        hist = self.history.get(field, {})
+        for k, dpi in enumerate(tiers):
+            tried, passed = hist.get(dpi, (0, 0))
+            if tried < self.min_samples or passed / tried >= self.target:
+                return k
+        return len(tiers) - 1
+
+    def record(self, field: str, dpi: int, passed: bool, pixels: int):
+        for table in (self.history, self.attempts):
+            t = table.setdefault(field, {}).setdefault(dpi, [0, 0])
+            t[0] += 1
+            t[1] += int(passed)
+        self.pixels[field] = self.pixels.get(field, 0) + int(pixels)
+
+    def finish(self, field: str, dpi):
+        r = self.resolved.setdefault(field, {})
+        r[dpi] = r.get(dpi, 0) + 1
+
+    def take_stats(self) -> dict:
+        stats = {"attempts": self.attempts, "resolved": self.resolved, "pixels": self.pixels}
+        self._reset()
+        return stats
+
+    def add_stats(self, stats: dict):
+        for f, per in stats["attempts"].items():
+            for dpi, (tried, passed) in per.items():
+                for table in (self.history, self.attempts):
+                    t = table.setdefault(f, {}).setdefault(int(dpi), [0, 0])
+                    t[0] += tried
+                    t[1] += passed
+        for f, per in stats["resolved"].items():
+            r = self.resolved.setdefault(f, {})
+            for dpi, n in per.items():
+                r[dpi] = r.get(dpi, 0) + n
+        for f, n in stats["pixels"].items():
+            self.pixels[f] = self.pixels.get(f, 0) + n
+
+    def summary(self) -> dict:
+        return {
+            f: {
+                "tiers": self.tiers.get(f),
+                "resolved": {str(k): v for k, v in self.resolved.get(f, {}).items()},
+                "attempts": {str(k): v for k, v in self.attempts.get(f, {}).items()},
+                "ocr_pixels": self.pixels.get(f, 0),
+            }
+            for f in ROI_FIELDS
+        }
+
+    def format_summary(self) -> str:
+        lines = []
+        for f, st in self.summary().items():
+            resolved = " ".join(f"{k}dpi={v}" if k != "unresolved" else f"未解决={v}"
+                                for k, v in st["resolved"].items())
+            lines.append(f"{FIELD_LABELS[f]} {resolved or '-'} 像素={st['ocr_pixels']}")
+        return "\n".join(lines)
+
+    def save(self):
+        """把累计的历史通过率写回 history_path，下次运行直接从合适的档位开始"""
+        if not self.history_path:
+            return
+        Path(self.history_path).parent.mkdir(parents=True, exist_ok=True)
+        fields = {f: {str(d): v for d, v in h.items()} for f, h in self.history.items()}
+        Path(self.history_path).write_text(json.dumps({"version": DPI_HISTORY_VERSION, "fields": fields}, indent=2),
+                                           encoding="utf-8")
+
+
+def ocr_field_adaptive(doc: fitz.Document, page_index: int, cfg, engine: RapidOCR, field: str,
+                       adaptive: AdaptiveDpi, gray: bool = False, strategies: OcrStrategyChain | None = None,
+                       dedup: RoiDedup | None = None):
+    """
+    只渲染该字段的ROI：从起始档DPI开始，校验失败就按更高一档重新渲染这块ROI再识别。
+    低档能否“胜出”全靠字段校验：票号必须正好读出20位数字（extract_no20_only），低DPI下多读/少读一位都会升档。
+    返回 (值, 最后一次的ROI图)
+    """
+    page = doc[page_index]
+    rotate = cfg.get("rotate", "0")
+    rect = norm_box_to_page_rect(page, cfg[field], rotate)
+    tiers = adaptive.tiers_for(field, cfg)
+    start = adaptive.start_index(field, tiers)
+    value, roi = None, None
+    for k in range(start, len(tiers)):
+        with timed("render"):
+            img = render_pdf_clip_to_bgr(page, rect, tiers[k], gray=gray)
+        with timed("rotate"):
+            roi = deskew_img(rotate_img(img, rotate), cfg.get("skew", 0.0)) if img is not None else None
+        value = ocr_field(engine, field, roi, retry=k > start, strategies=strategies, dedup=dedup, cfg=cfg)
+        adaptive.record(field, tiers[k], value is not None, roi.size if roi is not None else 0)
+        if value is not None:
+            adaptive.finish(field, tiers[k])
+            return value, roi
+    adaptive.finish(field, "unresolved")
+    return value, roi
+
+
+# ------------------ 结果缓存：按页面内容哈希 + 字段ROI 命中 ------------------
+# 结果格式/字段校验版本：改了 FIELD_VALIDATORS 或归一化规则时加一，旧缓存全部失效
+# 2：票号必须正好20位（不再截取前20位）
+RESULT_SCHEMA_VERSION = 2
+_ENGINE_VERSION = None
+
+
+def engine_version() -> str:
+    global _ENGINE_VERSION
+    if _ENGINE_VERSION is None:
+        import importlib.metadata
+        try:
+            _ENGINE_VERSION = importlib.metadata.version("rapidocr")
+        except Exception:
+            _ENGINE_VERSION = "unknown"
+    return _ENGINE_VERSION
+
+
+def page_content_hash(doc: fitz.Document, page_index: int) -> str:
+    """页面内容哈希：页面尺寸/旋转 + 内容流 + 引用的图片和表单XObject原始流"""
+    page = doc[page_index]
+    h = hashlib.sha1()
+    h.update(repr((tuple(page.rect), page.rotation)).encode())
+    h.update(page.read_contents() or b"")
+    for img in page.get_images(full=True):
+        h.update(doc.xref_stream_raw(img[0]) or b"")
+    for xo in page.get_xobjects():
+        h.update(doc.xref_stream_raw(xo[0]) or b"")
+    return h.hexdigest()
+
+
+def page_cache_keys(doc: fitz.Document, page_index: int, cfg, opts, fields=ROI_FIELDS):
+    """每个字段一个键：只含该字段自己的ROI，所以改一个ROI只会让这个字段失效"""
+    page_hash = page_content_hash(doc, page_index)
+    common = {
+        "schema": RESULT_SCHEMA_VERSION,
+        "engine": engine_version(),
+        "dpi": int(cfg.get("dpi", 300)),
+        "rotate": canonical_rotate(cfg.get("rotate", "0")),
+        "render_mode": opts["render_mode"],
+        "text_layer": bool(opts.get("text_layer")),
+        "batched": opts["batch_size"] > 1,
+        "color_mode": opts.get("color_mode", "bgr"),
+        "adaptive_dpi": bool(opts.get("adaptive_dpi")),
+        # 多版式时 opts["anchor"] 表示“任一版式有锚点”，本页版式可能没有
+        "anchor": hashlib.sha1(json.dumps(cfg["anchor"], sort_keys=True).encode()).hexdigest()
+        if opts.get("anchor") and cfg.get("anchor") else None,
+        "auto_rotate": bool(opts.get("auto_rotate")),
+    }
+    keys = {}
+    for f in fields:
+        raw = json.dumps([page_hash, f, cfg[f], resolve_strategies(cfg, f), common], sort_keys=True, ensure_ascii=False)
+        keys[f] = hashlib.sha1(raw.encode("utf-8")).hexdigest()
+    return keys
+
+
+def page_known_fields(doc: fitz.Document, page_index: int, cfg, opts, cache=None):
+    """
+    OCR之前能直接拿到的字段：先查缓存，再读文字层（若开启）。
+    返回 (值, 来源, 缓存键, 来自缓存的字段)
+    """
+    values, sources, keys, cached = {}, {}, {}, set()
+    if cache is not None:
+        with timed("cache"):
+            keys = page_cache_keys(doc, page_index, cfg, opts)
+            hit = cache.get_many(keys.values())
+        for f, k in keys.items():
+            if k in hit and hit[k]["value"] is not None:
+                values[f] = hit[k]["value"]
+                sources[f] = hit[k]["source"]
+                cached.add(f)
+
+    if opts.get("text_layer"):
+        todo = [f for f in ROI_FIELDS if f not in values]
+        if todo:
+            with timed("text_layer"):
+                got = text_layer_fields(doc[page_index], cfg, cfg.get("rotate", "0"), fields=todo)
+            for f, v in got.items():
+                if v is not None:
+                    values[f] = v
+                    sources[f] = "text"
+    return values, sources, keys, cached
+
+
+def store_fields(cache, keys, values, sources, cached):
+    """只缓存通过校验的字段：没识别出来的下次照常重新OCR（可能换了DPI/策略就能通过）"""
+    if cache is None or not keys:
+        return
+    with timed("cache"):
+        cache.put_many({
+            keys[f]: {"value": values[f], "source": sources.get(f)}
+            for f in ROI_FIELDS if f not in cached and values.get(f) is not None
+        })
+
+
+def extract_page_row(doc: fitz.Document, page_index: int, pdf_path: str, cfg, engine: RapidOCR,
+                     opts, dbg: DebugWriter | None = None, cache=None, adaptive: AdaptiveDpi | None = None,
+                     strategies: OcrStrategyChain | None = None, dedup: RoiDedup | None = None):
+    """
+    单页：（缓存/文字层）-> 渲染/裁剪 -> OCR -> 一行结果；只有前面没拿到的字段才渲染+OCR。
+    adaptive：每个字段按自适应DPI单独渲染ROI，校验失败再升档
+    strategies：OCR策略链（按通过率自动排序），None 时按默认顺序
+    dedup：RoiDedup，本次运行中相同的ROI裁剪图不再OCR
+    opts["anchor"]：先按锚点模板求本页偏移，三个ROI一起平移后再裁剪（偏移写入“ROI偏移”列）
+    opts["auto_rotate"]：先从缩略图检测本页方向和倾斜角，按本页方向裁剪（写入“页面方向”列）
+    opts["layouts"]：配置有多版式时先判定本页版式，之后全用该版式的配置（写入“版式”列）
+    """
+    info, orient, rois = None, None, {}
+    with timed_page(pdf_path, [page_index]):
+        cfg, layout = classify_layout(doc, page_index, cfg)
+        dpi, pcfg = int(cfg.get("dpi", 300)), cfg
+        values, sources, keys, cached = page_known_fields(doc, page_index, cfg, opts, cache)
+        missing = [f for f in ROI_FIELDS if f not in values]
+        if missing:
+            gray = opts["color_mode"] == "gray"
+            pcfg, orient, crop_rois = prepare_page_crop(doc, page_index, cfg, opts, dpi, gray,
+                                                        full_view=adaptive is None)
+            pcfg, info = relocate_rois(doc, page_index, pcfg, opts)
+            rotate = pcfg.get("rotate", "0")
+            if adaptive is not None:
+                rois = {}
+                for f in missing:
+                    values[f], rois[f] = ocr_field_adaptive(doc, page_index, pcfg, engine, f, adaptive, gray=gray,
+                                                            strategies=strategies, dedup=dedup)
+                    sources[f] = "ocr"
+            else:
+                rois = crop_rois(doc, page_index, pcfg, dpi, rotate, fields=missing, gray=gray)
+                for f in missing:
+                    values[f] = ocr_field(engine, f, rois[f], strategies=strategies, dedup=dedup, cfg=pcfg)
+                    sources[f] = "ocr"
+
+        store_fields(cache, keys, values, sources, cached)
+        row = finish_row(doc, pdf_path, page_index, values, sources, opts, pcfg, info, orient, layout)
+        # debug保存ROI图（后台写出）
+        if dbg and rois:
+            with timed("debug_write"):
+                save_debug_rois(dbg, pdf_path, page_index, rois, row)
+    return row
+
+
+def prepare_page_crop(doc: fitz.Document, page_index: int, cfg, opts, dpi: int, gray: bool, full_view: bool = True):
+    """
+    本页裁剪前的准备：自动方向（若开启）-> (本页配置, 方向结果, 裁剪函数)。
+    整页渲染模式下开启自动方向时先渲染整页，缩略图和ROI裁剪共用这一次渲染
+    """
+    if opts["render_mode"] == "clip":
+        return (*orient_page(doc, page_index, cfg, opts), crop_rois_clip)
+    if not opts.get("auto_rotate") or not full_view:
+        return (*orient_page(doc, page_index, cfg, opts), crop_rois_full)
+    view = render_page_view(doc, page_index, dpi, gray)
+    pcfg, orient = orient_page(doc, page_index, cfg, opts, view=view)
+
+    def crop_rois(doc, page_index, cfg, dpi, rotate, fields=ROI_FIELDS, gray=False):
+        return crop_rois_full(doc, page_index, cfg, dpi, rotate, fields=fields, gray=gray, view=view)
+    return pcfg, orient, crop_rois
+
+
+def finish_row(doc: fitz.Document, pdf_path: str, page_index: int, values, sources, opts, pcfg, info, orient,
+               layout=None):
+    """结果行 + 按运行选项出现的逐页日志列（版式 / ROI偏移 / 页面方向）"""
+    row = make_row(pdf_path, page_index, values, sources if opts.get("text_layer") else None)
+    if opts.get("layouts"):
+        row["版式"] = format_layout(layout)
+    if opts.get("anchor"):
+        row["ROI偏移"] = format_anchor_offset(doc, page_index, pcfg, info)
+    if opts.get("auto_rotate"):
+        row["页面方向"] = format_orientation(orient)
+    return row
+
+
+# ------------------ 批量识别：多页多ROI一起送识别模型 ------------------
+def get_text_recognizer(engine: RapidOCR):
+    """取RapidOCR内部的识别模型（新版按需加载）"""
+    loader = getattr(engine, "_load_rec_model", None)
+    if loader is not None:
+        return loader()
+    return getattr(engine, "text_rec", None)
+
+
+def resize_to_height(img, target_h: int):
+    """等比缩放到识别模型输入高度"""
+    if img is None or img.size == 0:
+        return img
+    h, w = img.shape[:2]
+    if h == target_h:
+        return img
+    new_w = max(1, int(round(w * target_h / float(h))))
+    interp = cv2.INTER_AREA if h > target_h else cv2.INTER_CUBIC
+    return cv2.resize(img, (new_w, target_h), interpolation=interp)
+
+
+def recognize_batch(engine: RapidOCR, imgs) -> list[str]:
+    """
+    只跑识别模型（不检测），一次送入多张图；返回与 imgs 一一对应的文本。
+    图片先缩放到识别模型输入高度，批大小由识别模型的 rec_batch_num 决定。
+    """
+    if not imgs:
+        return []
+    rec = get_text_recognizer(engine)
+    if rec is None:
+        # 拿不到识别模型时退回逐张调用
+        out = []
+        for img in imgs:
+            try:
+                out.append(get_txt_from_rapid_output(
+                    engine(to_engine_input(img), use_det=False, use_cls=False, use_rec=True)))
+            except Exception:
+                out.append("")
+        return out
+
+    target_h = int(rec.rec_image_shape[1])
+    batch = [to_engine_input(resize_to_height(img, target_h)) for img in imgs]
+    try:
+        res = rec(rapidocr_rec.TextRecInput(img=batch))
+    except Exception:
+        return [""] * len(imgs)
+    txts = list(res.txts or [])
+    txts += [""] * (len(imgs) - len(txts))
+    return [(t or "").strip() if isinstance(t, str) else "" for t in txts]
+
+
+def extract_pages_rows_batched(doc: fitz.Document, page_indices, pdf_path: str, cfg, engine: RapidOCR,
+                               opts, dbg: DebugWriter | None = None, cache=None,
+                               strategies: OcrStrategyChain | None = None, dedup: RoiDedup | None = None):
+    """
+    多页批量：先裁出所有页（文字层未命中字段）的ROI，opts["batch_fields"] 里的字段（默认只有票号）
+    一起只跑识别模型（批量），再把结果分回各页；校验不通过的（票号不是正好20位）才逐张走策略链的其余策略，
+    其余字段逐张走完整策略链。
+    批量识别记为该字段的 BATCH_STRATEGY 一次尝试；开启 dedup 时已识别过的相同ROI不进批量。
+    """
+    batch_fields = opts.get("batch_fields", DEFAULT_BATCH_FIELDS)
+    gray = opts["color_mode"] == "gray"
+
+    with timed_page(pdf_path, page_indices):
+        pages, page_keys = [], []
+        for i in page_indices:
+            # 多版式时每页各用自己版式的配置（同一批里不同版式的ROI照样一起批量识别）
+            lcfg, layout = classify_layout(doc, i, cfg)
+            dpi = int(lcfg.get("dpi", 300))
+            values, sources, keys, cached = page_known_fields(doc, i, lcfg, opts, cache)
+            missing = [f for f in ROI_FIELDS if f not in values]
+            info, orient, pcfg, rois = None, None, lcfg, {}
+            if missing:
+                pcfg, orient, crop_rois = prepare_page_crop(doc, i, lcfg, opts, dpi, gray)
+                pcfg, info = relocate_rois(doc, i, pcfg, opts)
+                rois = crop_rois(doc, i, pcfg, dpi, pcfg.get("rotate", "0"), fields=missing, gray=gray)
+            pages.append((i, values, sources, rois))
+            page_keys.append((keys, cached, (pcfg, info, orient, layout)))
+
+        # 去重：相同ROI直接复用，不进批量
+        fps = {}
+        if dedup is not None:
+            for k, (_, values, sources, rois) in enumerate(pages):
+                for f, roi in rois.items():
+                    if roi is None or roi.size == 0:
+                        continue
+                    fps[(k, f)] = dedup.fingerprint(roi)
+                    v = dedup.get(f, fps[(k, f)])
+                    if v is not None:
+                        values[f] = v
+                        sources[f] = "ocr"
+
+        # 收集：(页序号, 字段, 预处理后的图)
+        slots, imgs = [], []
+        with timed("preprocess"):
+            for k, (_, values, _, rois) in enumerate(pages):
+                for f, roi in rois.items():
+                    if roi is None or roi.size == 0 or f in values or f not in batch_fields:
+                        continue
+                    if f == "invoice_no":
+                        img = upscale_if_small(roi, min_h=FIELD_MIN_H[f])
+                    else:
+                        img = light_preprocess(upscale_if_small(roi, min_h=FIELD_MIN_H[f]))
+                    slots.append((k, f))
+                    imgs.append(img)
+
+        for _, f in slots:
+            note_attempt(f, "rec_batch")
+        with timed("rec_batch"):
+            txts = recognize_batch(engine, imgs)
+        for (k, f), t in zip(slots, txts):
+            _, values, sources, _ = pages[k]
+            v = FIELD_VALIDATORS[f](t)
+            if strategies is not None:
+                strategies.record(f, BATCH_STRATEGY[f], v is not None)
+            if v is not None:
+                values[f] = v
+                sources[f] = "ocr"
+                if dedup is not None:
+                    dedup.put(f, fps[(k, f)], v)
+
+        batched = set(slots)
+        rows = []
+        for k, ((i, values, sources, rois), (keys, cached, (pcfg, info, orient, layout))) in enumerate(
+                zip(pages, page_keys)):
+            for f in rois:
+                if f not in values:
+                    tried = (k, f) in batched
+                    values[f] = ocr_field(engine, f, rois[f], retry=tried, strategies=strategies,
+                                          skip=(BATCH_STRATEGY[f],) if tried else (), cfg=pcfg)
+                    sources[f] = "ocr"
+                    if (k, f) in fps:
+                        dedup.put(f, fps[(k, f)], values[f])
+            store_fields(cache, keys, values, sources, cached)
+            rows.append(finish_row(doc, pdf_path, i, values, sources, opts, pcfg, info, orient, layout))
+            if dbg and rois:
+                with timed("debug_write"):
+                    save_debug_rois(dbg, pdf_path, i, rois, rows[-1])
+    return rows
+
+
+def extract_pages_rows(doc: fitz.Document, page_indices, pdf_path: str, cfg, engine: RapidOCR,
+                       opts, dbg: DebugWriter | None = None, cache=None, adaptive: AdaptiveDpi | None = None,
+                       strategies: OcrStrategyChain | None = None, dedup: RoiDedup | None = None):
+    """adaptive（自适应DPI）按字段逐个渲染+升档，此时不走批量识别"""
+    if opts["batch_size"] > 1 and adaptive is None:
+        return extract_pages_rows_batched(doc, page_indices, pdf_path, cfg, engine, opts, dbg=dbg, cache=cache,
+                                          strategies=strategies, dedup=dedup)
+    return [extract_page_row(doc, i, pdf_path, cfg, engine, opts, dbg=dbg, cache=cache, adaptive=adaptive,
+                             strategies=strategies, dedup=dedup)
+            for i in page_indices]
+
+
+def chunk_pages(page_indices, size: int):
+    size = max(1, int(size or 1))
+    page_indices = list(page_indices)
+    return [page_indices[k:k + size] for k in range(0, len(page_indices), size)]
+
+
+# ------------------ 多进程：按页分片 ------------------
+def resolve_workers(workers: int | None) -> int:
+    """workers: None/1=单进程；0=CPU核数；N=N个进程"""
+    if workers is None:
+        return 1
+    workers = int(workers)
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return max(1, workers)
+
+
+def iter_parallel(tasks, task_fn, workers: int, initializer=None, initargs=(), progress_hook=None,
+                  weights=None):
+    """
+    在进程池中执行 task_fn(task)，按 tasks 原顺序逐个 yield 结果。
+    - 同时在途的任务数有上限（workers*4），结果缓冲不会随任务数增长
+    - progress_hook(done, total) 按“已完成”数量回调（完成顺序可能乱序，但计数准确）
+    - weights：每个任务折算的进度数（如一个任务含多页），默认每个任务计1
+    task_fn / initializer 必须是模块级函数（Windows spawn 需要可pickle）。
+    """
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    tasks = list(tasks)
+    weights = list(weights) if weights is not None else [1] * len(tasks)
+    n_tasks = len(tasks)
+    total = sum(weights)
+    window = max(1, workers * 4)
+    done_count = 0
+    pending = {}   # future -> idx
+    finished = {}  # idx -> result
+    next_submit = 0
+    next_yield = 0
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as ex:
+        try:
+            while next_yield < n_tasks:
+                while next_submit < n_tasks and (next_submit - next_yield) < window:
+                    fut = ex.submit(task_fn, tasks[next_submit])
+                    pending[fut] = next_submit
+                    next_submit += 1
+
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for fut in done:
+                    idx = pending.pop(fut)
+                    finished[idx] = fut.result()
+                    done_count += weights[idx]
+                    if progress_hook:
+                        try:
+                            progress_hook(done_count, total)
+                        except Exception:
+                            pass
+
+                while next_yield in finished:
+                    yield finished.pop(next_yield)
+                    next_yield += 1
+        finally:
+            # 调用方提前停止（取消/异常）时，撤掉还没开始的任务，只等正在跑的
+            for fut in pending:
+                fut.cancel()
+
+
+# 每个worker进程内的状态：引擎只建一次；PDF句柄按路径缓存
+_WORKER = {}
+_WORKER_MAX_DOCS = 4
+
+
+def _init_page_worker(cfg, opts, debug_args, intra_op_threads: int | None,
+                      cache_args=None, timing: bool = False, adaptive_args=None, dedup_args=None):
+    _WORKER["cfg"] = cfg
+    _WORKER["cache"] = ResultCache(*cache_args) if cache_args else None
+    _WORKER["timer"] = StageTimer() if timing else None
+    _WORKER["strategies"] = OcrStrategyChain().configure(cfg)
+    _WORKER["dedup"] = RoiDedup(*dedup_args) if dedup_args else None
+    _WORKER["adaptive"] = None
+    if adaptive_args:
+        min_samples, target, history = adaptive_args
+        _WORKER["adaptive"] = AdaptiveDpi(min_samples, target).configure(cfg)
+        _WORKER["adaptive"].history = history
+    _WORKER["opts"] = opts
+    _WORKER["dbg"] = open_worker_writer(debug_args)
+    with use_timer(_WORKER["timer"]):
+        _WORKER["engine"] = create_engine(intra_op_threads,
+                                          rec_batch_num=opts["batch_size"] if opts["batch_size"] > 1 else None,
+                                          engine_cfg=resolve_engine_config(cfg, intra_op_threads),
+                                          lazy_det=opts["lazy_det"])
+    _WORKER["docs"] = OrderedDict()
+
+
+def _worker_doc(pdf_path: str) -> fitz.Document:
+    docs = _WORKER["docs"]
+    doc = docs.get(pdf_path)
+    if doc is None:
+        doc = fitz.open(pdf_path)
+        docs[pdf_path] = doc
+        while len(docs) > _WORKER_MAX_DOCS:
+            _, old = docs.popitem(last=False)
+            old.close()
+    else:
+        docs.move_to_end(pdf_path)
+    return doc
+
+
+def _worker_stats():
+    """缓存命中计数、计时记录、DPI档位统计、OCR策略通过率、去重命中、调试图写出计数交回主进程汇总"""
+    cache, timer, adaptive, dedup = _WORKER["cache"], _WORKER["timer"], _WORKER["adaptive"], _WORKER["dedup"]
+    dbg = _WORKER["dbg"]
+    return {
+        "debug": dbg.take_stats() if dbg is not None else None,
+        "dedup": dedup.take_stats() if dedup is not None else None,
+        "strategies": _WORKER["strategies"].take_stats(),
+        "cache": cache.take_stats() if cache is not None else None,
+        "timing": timer.take_stats() if timer is not None else None,
+        "adaptive": adaptive.take_stats() if adaptive is not None else None,
+        "memory": engine_memory(_WORKER["engine"]),
+    }
+
+
+def _merge_worker_stats(stats, cache, timer, adaptive=None, strategies=None, dedup=None, debug=None):
+    if stats.get("debug") and debug is not None:
+        debug.add_stats(stats["debug"])
+    if stats.get("dedup"):
+        dedup.add_stats(stats["dedup"])
+    if strategies is not None:
+        strategies.add_stats(stats["strategies"])
+    if stats["cache"]:
+        cache.add_stats(stats["cache"])
+    if stats["timing"]:
+        timer.add_stats(stats["timing"])
+    if stats.get("adaptive"):
+        adaptive.add_stats(stats["adaptive"])
+    if stats.get("memory"):
+        WORKER_MEMORY[stats["memory"]["pid"]] = stats["memory"]
+
+
+def _adaptive_worker_args(adaptive):
+    return (adaptive.min_samples, adaptive.target, adaptive.history) if adaptive is not None else None
+
+
+def _pages_task(task):
+    pdf_path, page_indices = task
+    doc = _worker_doc(pdf_path)
+    with use_timer(_WORKER["timer"]):
+        rows = extract_pages_rows(doc, page_indices, pdf_path, _WORKER["cfg"], _WORKER["engine"],
+                                  _WORKER["opts"], dbg=_WORKER["dbg"], cache=_WORKER["cache"],
+                                  adaptive=_WORKER["adaptive"], strategies=_WORKER["strategies"],
+                                  dedup=_WORKER["dedup"])
+    return rows, _worker_stats()
+
+
+def iter_pdf_rows(pdf_path: str, debug_dir: str | None = None, progress_hook=None,
+                  render_mode: str | None = None, workers: int | None = None,
+                  batch_size: int | None = None, text_layer: bool | None = None,
+                  cache: ResultCache | None = None, engine: RapidOCR | None = None,
+                  roi_config: str | None = None, timer: StageTimer | None = None,
+                  color_mode: str | None = None, adaptive: AdaptiveDpi | None = None,
+                  strategies: OcrStrategyChain | None = None, dedup: RoiDedup | None = None,
+                  anchor: bool | None = None, auto_rotate: bool | None = None,
+                  journal: PageJournal | None = None, lazy_det: bool | None = None,
+                  debug_writer: DebugWriter | None = None):
+    """
+    逐页产出结果行（生成器，按页码顺序）；内存只与在途页数有关，与总页数无关。
+    提前停止迭代（break / close()）即可中途取消。
+    progress_hook: callable(current_page:int, total_pages:int)
+    render_mode: "full"（整页渲染后裁剪）/ "clip"（只渲染ROI矩形）；None 时取配置中的 render_mode，默认 full
+    workers: 进程数；None/1=单进程逐页，0=CPU核数。多进程时每个进程只建一个RapidOCR，结果仍按页码顺序返回
+    batch_size: >1 时每 batch_size 页为一组，三个ROI一起批量识别（识别模型批大小同为 batch_size）
+    text_layer: 先按ROI读PDF文字层，校验通过的字段不再渲染/OCR；结果增加“识别来源”列
+    cache: invoice_cache.ResultCache；命中的字段不再渲染/OCR，运行后 cache.hits / cache.misses 为本次计数
+    engine: 单进程时复用调用方已加载的RapidOCR（常驻worker用），None 则新建
+    roi_config: ROI配置文件路径，None 时用固定路径 ROI_CONFIG_PATH；配置含 "profiles" 时逐页判定版式，结果加“版式”列
+    timer: invoice_timing.StageTimer；记录每页各阶段耗时/OCR尝试/重试，结束后 timer.summary() 汇总
+    color_mode: "bgr" / "gray"（灰度渲染+单通道预处理）；None 时取配置中的 color_mode，默认 bgr
+    adaptive: AdaptiveDpi；每个字段从历史通过率够高的最低DPI档开始只渲染该ROI，校验失败再升档，
+              运行后 adaptive.summary() 为各档位解决的字段数
+    strategies: OcrStrategyChain；每个字段的OCR策略链，按通过率/耗时在运行中自动排序，
+                运行后 strategies.summary() 为各策略通过率；None 时内部新建（同样自动排序）
+    dedup: RoiDedup；本次运行中相同（近似）的ROI裁剪图复用已识别的值（多进程时只在各进程内去重），
+           并给结果加“重复票号”列，运行后 dedup.summary() 为命中数
+    anchor: 配置中有锚点模板（calibrate_roi.py --anchor）时默认按锚点重定位ROI，结果加“ROI偏移”列；False 关闭
+    auto_rotate: 逐页从缩略图检测方向（横/竖版混排）和小角度倾斜，按本页方向裁剪并转正，结果加“页面方向”列；
+                 None 时取配置中的 auto_rotate
+    journal: PageJournal；新识别的页逐页写入日志，日志里已有的页（续跑）不再识别，直接按页码并回结果
+    lazy_det: 只识别引擎（LazyDetEngine），检测模型到第一次 det 回退时才加载；None 时取配置 engine.lazy_det。
+              每个进程的RSS和引擎状态记在 WORKER_MEMORY（format_worker_memory() 输出）
+    debug_dir: 保存ROI调试图的目录；图在后台线程编码写出，不阻塞识别（默认设置：png快速压缩、每页都存）
+    debug_writer: DebugWriter；自定义格式/压缩级别/抽样/队列长度时由调用方创建（优先于 debug_dir），
+                  调用方负责 close()，之后 debug_writer.summary() 为写出页数和队列积压
+    """
+    cfg = load_roi_config(roi_config or ROI_CONFIG_PATH)
+    opts = resolve_options(cfg, render_mode=render_mode, batch_size=batch_size, text_layer=text_layer,
+                           color_mode=color_mode, anchor=anchor,
+                           auto_rotate=auto_rotate, lazy_det=lazy_det)
+    opts["adaptive_dpi"] = adaptive is not None
+    if adaptive is not None:
+        adaptive.configure(cfg)
+    strategies = (strategies or OcrStrategyChain()).configure(cfg)
+    mark = _duplicate_marker(dedup)
+    workers = resolve_workers(workers)
+    batch_size = opts["batch_size"]
+
+    dbg, own_dbg = open_debug_writer(debug_dir, debug_writer)
 
-    engine = RapidOCR()
     doc = fitz.open(pdf_path)
     total_pages = len(doc)
-    rows = []
-
-    dbg = Path(debug_dir) if debug_dir else None
-    if dbg:
-        dbg.mkdir(parents=True, exist_ok=True)
-
-    for i in range(total_pages):
-        img = render_pdf_page_to_bgr(doc, i, dpi=dpi)
-        img = rotate_img(img, rotate)
-
-        inv_roi = crop_by_norm(img, cfg["invoice_no"])
-        date_roi = crop_by_norm(img, cfg["invoice_date"])
-        amt_roi = crop_by_norm(img, cfg["total_amount"])
-
-        inv_text = ocr_inv_text(engine, inv_roi)
-        ticket20 = extract_no20_only(inv_text)
-        if ticket20 is None and inv_roi is not None:
-            inv_text2 = ocr_inv_text(engine, light_preprocess(inv_roi))
-            ticket20 = extract_no20_only(inv_text2)
-
-        date_text = ocr_text_simple(engine, date_roi)
-        amt_text = ocr_text_simple(engine, amt_roi)
-
-        rows.append({
-            "文件名": Path(pdf_path).name,
-            "页码": i + 1,
-            "票号20位": ticket20,
-            "票号完整": "Y" if (ticket20 and len(ticket20) == 20) else "N",
-            "开票日期": normalize_date_to_yyyymmdd(date_text),
-            "价税合计": normalize_amount(amt_text)
-        })
+    resumed = journal.done_pages(pdf_path) if journal is not None else {}
+    groups = chunk_pages([i for i in range(total_pages) if i not in resumed], batch_size)
+    progress_hook = _resumed_progress(progress_hook, len(resumed))
+    if workers > 1 and len(groups) > 1:
+        doc.close()
+        workers = min(workers, len(groups))
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        tasks = [(str(pdf_path), g) for g in groups]
+        cache_args = (cache.path, cache.max_entries) if cache is not None else None
+        parts = iter_parallel(
+            tasks, _pages_task, workers,
+            initializer=_init_page_worker,
+            initargs=(cfg, opts, dbg.args() if dbg else None, threads, cache_args, timer is not None,
+                      _adaptive_worker_args(adaptive),
+                      dedup.args() if dedup is not None else None),
+            progress_hook=progress_hook,
+            weights=[len(g) for g in groups],
+        )
+
+        def new_rows():
+            for part, stats in parts:
+                _merge_worker_stats(stats, cache, timer, adaptive, strategies, dedup, dbg)
+                yield from journal_rows(journal, pdf_path, part)
 
-        # debug保存ROI图
-        if dbg:
-            stem = Path(pdf_path).stem
-            tag = f"{stem}_p{i+1:02d}"
-            if inv_roi is not None:
-                cv2.imencode(".png", inv_roi)[1].tofile(str(dbg / f"{tag}_inv.png"))
-            if date_roi is not None:
-                cv2.imencode(".png", date_roi)[1].tofile(str(dbg / f"{tag}_date.png"))
-            if amt_roi is not None:
-                cv2.imencode(".png", amt_roi)[1].tofile(str(dbg / f"{tag}_amt.png"))
-
-        # 进度回调
-        if progress_hook:
+        try:
+            yield from mark(merge_resumed(new_rows(), resumed))
+        finally:
+            parts.close()
+            if own_dbg:
+                dbg.close()
+        return
+
+    def new_rows():
+        nonlocal engine
+        if engine is None and groups:
+            with use_timer(timer):
+                engine = create_engine(rec_batch_num=batch_size if batch_size > 1 else None,
+                                       engine_cfg=resolve_engine_config(cfg), lazy_det=opts["lazy_det"])
+        if not groups and progress_hook:
             try:
-                progress_hook(i + 1, total_pages)
+                progress_hook(0, 0)  # 全部页都在日志里
             except Exception:
                 pass
+        done = 0
+        for g in groups:
+            with use_timer(timer):
+                part = extract_pages_rows(doc, g, pdf_path, cfg, engine, opts, dbg=dbg, cache=cache,
+                                          adaptive=adaptive, strategies=strategies, dedup=dedup)
+            done += len(part)
 
-    doc.close()
-    return rows
+            # 进度回调
+            if progress_hook:
+                try:
+                    progress_hook(done, total_pages - len(resumed))
+                except Exception:
+                    pass
+
+            yield from journal_rows(journal, pdf_path, part)
+        if engine is not None:
+            WORKER_MEMORY[os.getpid()] = engine_memory(engine)
+
+    try:
+        yield from mark(merge_resumed(new_rows(), resumed))
+    finally:
+        doc.close()
+        if own_dbg:
+            dbg.close()
+
+
+# ------------------ 续跑：页级检查点日志 ------------------
+def journal_tag(roi_config: str | None = None, render_mode: str | None = None, batch_size: int | None = None,
+                text_layer: bool | None = None, color_mode: str | None = None, anchor: bool | None = None,
+                auto_rotate: bool | None = None, adaptive: AdaptiveDpi | None = None, dedup: RoiDedup | None = None):
+    """
+    页级日志的任务头 tag：展开后的ROI配置（含各版式）+ 解析后的运行选项 + 自适应DPI/去重 + 结果格式版本。
+    参数同 iter_pdf_rows；续跑时任何一项不同，旧记录的行是按别的方式识别的（列也可能不同），不能并回
+    """
+    cfg = load_roi_config(roi_config or ROI_CONFIG_PATH)
+    opts = resolve_options(cfg, render_mode, batch_size, text_layer, color_mode, anchor, auto_rotate)
+    opts.pop("lazy_det")  # 只影响内存，不影响结果
+    return run_tag({"config": cfg, "options": opts, "adaptive_dpi": adaptive is not None,
+                    "dedup": None if dedup is None else dedup.max_distance, "schema": RESULT_SCHEMA_VERSION})
+
+
+def journal_rows(journal: PageJournal | None, pdf_path: str, rows):
+    """新识别的行逐行写入日志（出错的页不记，续跑时重新识别），原样产出"""
+    for row in rows:
+        if journal is not None and row.get("页码") and not row.get("状态"):
+            journal.record(pdf_path, row["页码"] - 1, row)
+        yield row
+
+
+def merge_resumed(rows, resumed: dict):
+    """按页码顺序把日志里已完成的页（{页索引: 行}）并回新识别的行"""
+    pending = sorted(resumed.items())
+    k = 0
+    for row in rows:
+        page = row["页码"] - 1 if row.get("页码") else None
+        while page is not None and k < len(pending) and pending[k][0] < page:
+            yield pending[k][1]
+            k += 1
+        yield row
+    for _, row in pending[k:]:
+        yield row
+
+
+def _resumed_progress(progress_hook, skipped: int):
+    """续跑时进度按全部页计：已在日志里的页算作已完成"""
+    if not progress_hook or not skipped:
+        return progress_hook
+    return lambda cur, total: progress_hook(cur + skipped, total + skipped)
+
+
+def _duplicate_marker(dedup):
+    """开启去重时，按输出顺序给行加“重复票号”列（跨文件共用一份已见票号）"""
+    if dedup is None:
+        return iter
+    seen = OrderedDict()
+    return lambda rows: flag_duplicate_invoices(rows, seen)
+
+
+# ------------------ 多文件批量：所有文件的页进同一个任务队列 ------------------
+PDF_EXT = ".pdf"
+GLOB_CHARS = set("*?[")
+
+
+def expand_pdf_inputs(inputs) -> list[str]:
+    """
+    inputs：文件 / 目录（递归找 .pdf）/ 通配符（如 "发票/**/*.pdf"）混合；
+    返回去重后的PDF路径列表（目录和通配符内按路径排序，整体保持输入顺序）
+    """
+    import glob
+
+    out, seen = [], set()
+
+    def add(p: Path):
+        key = os.path.normcase(str(p.resolve()))
+        if key not in seen:
+            seen.add(key)
+            out.append(str(p))
+
+    for item in inputs:
+        p = Path(item)
+        if p.is_file():
+            add(p)
+        elif p.is_dir():
+            for fp in sorted(p.rglob("*")):
+                if fp.is_file() and fp.suffix.lower() == PDF_EXT:
+                    add(fp)
+        elif GLOB_CHARS & set(str(item)):
+            for fp in sorted(glob.glob(str(item), recursive=True)):
+                fp = Path(fp)
+                if fp.is_file() and fp.suffix.lower() == PDF_EXT:
+                    add(fp)
+        else:
+            raise FileNotFoundError(str(item))
+    return out
+
+
+def failed_page_row(pdf_path: str, page_index: int, err: str):
+    """识别出错的页也占一行，状态列写错误信息"""
+    row = make_row(pdf_path, page_index, {})
+    row["状态"] = f"失败：{err}"
+    return row
+
+
+def file_status_row(pdf_path: str, pages: int, failed: int, err: str | None = None):
+    """每个文件结束后追加一行汇总状态（页码为空）"""
+    if err:
+        status = f"失败：{err}"
+    elif failed:
+        status = f"部分失败：{failed}/{pages}页"
+    else:
+        status = f"完成：{pages}页"
+    return {"文件名": Path(pdf_path).name, "页码": None, "票号20位": None, "票号完整": None,
+            "开票日期": None, "价税合计": None, "状态": status}
+
+
+def _batch_pages_task(task):
+    """多文件模式的worker任务：单个分片出错只记错误，不中断整个批次"""
+    try:
+        rows, stats = _pages_task(task)
+        return rows, stats, None
+    except Exception as e:
+        return [], _worker_stats(), f"{type(e).__name__}: {e}"
+
+
+def _iter_tasks_serial(tasks, cfg, engine: RapidOCR, opts, dbg: DebugWriter | None, cache, progress_hook, total: int,
+                       timer: StageTimer | None = None, adaptive: AdaptiveDpi | None = None,
+                       strategies: OcrStrategyChain | None = None, dedup: RoiDedup | None = None):
+    """单进程依次执行 (pdf_path, page_indices) 任务；同一文件的连续任务复用一个打开的文档"""
+    cur_path, doc, done = None, None, 0
+    try:
+        for pdf_path, g in tasks:
+            err = None
+            rows = []
+            try:
+                if pdf_path != cur_path:
+                    if doc is not None:
+                        doc.close()
+                    cur_path, doc = pdf_path, None
+                    doc = fitz.open(pdf_path)
+                with use_timer(timer):
+                    rows = extract_pages_rows(doc, g, pdf_path, cfg, engine, opts, dbg=dbg, cache=cache,
+                                              adaptive=adaptive, strategies=strategies, dedup=dedup)
+            except Exception as e:
+                err = f"{type(e).__name__}: {e}"
+            done += len(g)
+            if progress_hook:
+                try:
+                    progress_hook(done, total)
+                except Exception:
+                    pass
+            if engine is not None:
+                WORKER_MEMORY[os.getpid()] = engine_memory(engine)
+            yield rows, None, err
+    finally:
+        if doc is not None:
+            doc.close()
+
+
+def iter_batch_rows(pdf_paths, debug_dir: str | None = None, progress_hook=None,
+                    render_mode: str | None = None, workers: int | None = None,
+                    batch_size: int | None = None, text_layer: bool | None = None,
+                    cache: ResultCache | None = None, engine: RapidOCR | None = None,
+                    roi_config: str | None = None, timer: StageTimer | None = None,
+                    color_mode: str | None = None, adaptive: AdaptiveDpi | None = None,
+                    strategies: OcrStrategyChain | None = None, dedup: RoiDedup | None = None,
+                    anchor: bool | None = None, auto_rotate: bool | None = None,
+                    journal: PageJournal | None = None, lazy_det: bool | None = None,
+                    debug_writer: DebugWriter | None = None):
+    """
+    多个PDF一起处理（生成器）：所有文件的所有页按 batch_size 分片后放进同一个任务队列，
+    大小文件在各worker间自动均衡；引擎只建一次（每个进程一个）。
+    输出按文件、页码顺序；每个文件的页之后追加一行文件状态（页码为空，“状态”列为 完成/部分失败/失败）。
+    单页/单文件出错不会中断整个批次，出错页也占一行。
+    progress_hook(done_pages, total_pages) 按所有文件的总页数计数；其余参数同 iter_pdf_rows。
+    """
+    cfg = load_roi_config(roi_config or ROI_CONFIG_PATH)
+    opts = resolve_options(cfg, render_mode=render_mode, batch_size=batch_size, text_layer=text_layer,
+                           color_mode=color_mode, anchor=anchor,
+                           auto_rotate=auto_rotate, lazy_det=lazy_det)
+    opts["adaptive_dpi"] = adaptive is not None
+    if adaptive is not None:
+        adaptive.configure(cfg)
+    strategies = (strategies or OcrStrategyChain()).configure(cfg)
+    mark = _duplicate_marker(dedup)
+    workers = resolve_workers(workers)
+
+    dbg, own_dbg = open_debug_writer(debug_dir, debug_writer)
+
+    # 先数页：打不开的文件直接记失败；续跑时日志里已完成的页不再排进队列
+    files = []  # (path, groups, resumed, err)
+    for p in pdf_paths:
+        try:
+            with fitz.open(str(p)) as d:
+                n = len(d)
+            resumed = journal.done_pages(str(p)) if journal is not None else {}
+            todo = [i for i in range(n) if i not in resumed]
+            files.append((str(p), chunk_pages(todo, opts["batch_size"]), resumed, None))
+        except Exception as e:
+            files.append((str(p), [], {}, f"{type(e).__name__}: {e}"))
+    tasks = [(path, g) for path, groups, _, _ in files for g in groups]
+    total = sum(len(g) for _, g in tasks)
+    progress_hook = _resumed_progress(progress_hook, sum(len(r) for _, _, r, _ in files))
+
+    if workers > 1 and len(tasks) > 1:
+        workers = min(workers, len(tasks))
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        cache_args = (cache.path, cache.max_entries) if cache is not None else None
+        results = iter_parallel(
+            tasks, _batch_pages_task, workers,
+            initializer=_init_page_worker,
+            initargs=(cfg, opts, dbg.args() if dbg else None, threads, cache_args, timer is not None,
+                      _adaptive_worker_args(adaptive),
+                      dedup.args() if dedup is not None else None),
+            progress_hook=progress_hook,
+            weights=[len(g) for _, g in tasks],
+        )
+    else:
+        if engine is None and tasks:
+            with use_timer(timer):
+                engine = create_engine(rec_batch_num=opts["batch_size"] if opts["batch_size"] > 1 else None,
+                                       engine_cfg=resolve_engine_config(cfg), lazy_det=opts["lazy_det"])
+        results = _iter_tasks_serial(tasks, cfg, engine, opts, dbg, cache, progress_hook, total, timer, adaptive,
+                                     strategies, dedup)
+
+    def with_cols(row):
+        # 流式导出按第一行定列：占位行也带上本次运行会出现的全部可选列
+        row.setdefault("状态", None)
+        if opts["text_layer"]:
+            row.setdefault("识别来源", None)
+        if opts["layouts"]:
+            row.setdefault("版式", None)
+        if opts["anchor"]:
+            row.setdefault("ROI偏移", None)
+        if opts["auto_rotate"]:
+            row.setdefault("页面方向", None)
+        if dedup is not None:
+            row.setdefault("重复票号", None)
+        return row
+
+    def file_rows(path, groups):
+        nonlocal failed
+        for g in groups:
+            rows, stats, err = next(results)
+            if stats:
+                _merge_worker_stats(stats, cache, timer, adaptive, strategies, dedup, dbg)
+            if err:
+                rows = [failed_page_row(path, i, err) for i in g]
+                failed += len(g)
+            yield from journal_rows(journal, path, rows)
+
+    try:
+        for path, groups, resumed, open_err in files:
+            failed = 0
+            for row in mark(merge_resumed(file_rows(path, groups), resumed)):
+                yield with_cols(row)
+            pages = sum(len(g) for g in groups) + len(resumed)
+            yield with_cols(file_status_row(path, pages, failed, open_err))
+    finally:
+        results.close()
+        if own_dbg:
+            dbg.close()
+
+
+def extract_pdf_to_rows(pdf_path: str, debug_dir: str | None = None, progress_hook=None, **kwargs):
+    """一次性返回全部结果行；参数同 iter_pdf_rows"""
+    return list(iter_pdf_rows(pdf_path, debug_dir=debug_dir, progress_hook=progress_hook, **kwargs))
+
+
+# 导出固定列；按运行选项才会出现的列，追加在固定列之后
+EXPORT_COLS = ["文件名", "页码", "票号20位", "开票日期", "价税合计", "票号完整"]
+OPTIONAL_COLS = ["识别来源", "版式", "页面方向", "ROI偏移", "重复票号", "状态"]
 
 
 def export_rows_to_excel(rows, excel_path: str):
-    df = pd.DataFrame(rows)
-    cols = ["文件名", "页码", "票号20位", "开票日期", "价税合计", "票号完整"]
-    df = df[cols]
+    """列 = 固定列 + 任一行里出现过的可选列；逐行直接写 openpyxl（不经过 DataFrame）"""
+    rows = list(rows)
+    present = set().union(*rows) if rows else set()
+    cols = list(EXPORT_COLS) + [c for c in OPTIONAL_COLS if c in present]
     out = Path(excel_path)
     out.parent.mkdir(parents=True, exist_ok=True)
-    with pd.ExcelWriter(out, engine="openpyxl") as w:
-        df.to_excel(w, index=False, sheet_name="发票提取")
+    with timed("export"):
+        write_xlsx_rows(out, cols, ([row.get(c) for c in cols] for row in rows))
     return str(out)
 
 
+def write_xlsx_rows(path, cols, values, sheet_name: str = "发票提取"):
+    """表头 cols + 每行一个值列表，openpyxl write_only 写出（None 为空单元格）"""
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_name)
+    ws.append(list(cols))
+    for v in values:
+        ws.append(v)
+    wb.save(str(path))
+
+
+# ------------------ 流式导出：边识别边落盘，内存恒定 ------------------
+STREAM_FORMATS = (".xlsx", ".csv", ".jsonl")
+
+
+class RowStreamWriter:
+    """
+    逐行追加写出，格式按扩展名：
+    - .csv / .jsonl：每 flush_every 行 flush+fsync 一次，进程中途退出时已完成的行都在磁盘上
+    - .xlsx：openpyxl write_only 模式（行直接写入临时XML，内存恒定），close() 时才生成文件；
+      中途崩溃时输出文件里什么都没有（flush() 对 xlsx 无效），只有 csv/jsonl 能防崩溃丢行，xlsx 靠检查点日志续跑
+    列在写第一行时确定：固定列 + 第一行中出现的可选列。
+    """
+
+    def __init__(self, path: str, flush_every: int = 100):
+        self.path = Path(path)
+        self.fmt = self.path.suffix.lower()
+        if self.fmt not in STREAM_FORMATS:
+            raise ValueError(f"不支持的导出格式: {self.fmt}（支持 {'/'.join(STREAM_FORMATS)}）")
+        self.flush_every = max(1, int(flush_every))
+        self.count = 0
+        self.cols = None
+        self._fh = None
+        self._csv = None
+        self._wb = None
+        self._ws = None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def _open(self, first_row):
+        self.cols = list(EXPORT_COLS) + [c for c in OPTIONAL_COLS if c in first_row]
+        if self.fmt == ".xlsx":
+            from openpyxl import Workbook
+            self._wb = Workbook(write_only=True)
+            self._ws = self._wb.create_sheet("发票提取")
+            self._ws.append(self.cols)
+        elif self.fmt == ".csv":
+            # utf-8-sig：Excel直接打开不乱码
+            self._fh = open(self.path, "w", encoding="utf-8-sig", newline="")
+            self._csv = csv.writer(self._fh)
+            self._csv.writerow(self.cols)
+        else:
+            self._fh = open(self.path, "w", encoding="utf-8")
+
+    def write(self, row):
+        with timed("export"):
+            self._write(row)
+
+    def _write(self, row):
+        if self.cols is None:
+            self._open(row)
+        if self.fmt == ".xlsx":
+            self._ws.append([row.get(c) for c in self.cols])
+        elif self.fmt == ".csv":
+            self._csv.writerow(["" if row.get(c) is None else row.get(c) for c in self.cols])
+        else:
+            self._fh.write(json.dumps({c: row.get(c) for c in self.cols}, ensure_ascii=False) + "\n")
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        """csv/jsonl：已写的行落盘（之后即使进程被杀，文件也能读出这些行）；xlsx 无操作"""
+        if self._fh is not None:
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+
+    def close(self) -> str:
+        with timed("export"):
+            return self._close()
+
+    def _close(self) -> str:
+        if self.cols is None:
+            # 没有任何行也输出只有表头的文件
+            self._open({})
+        if self._wb is not None:
+            self._wb.save(str(self.path))
+            self._wb = None
+        if self._fh is not None:
+            self.flush()
+            self._fh.close()
+            self._fh = None
+        return str(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def stream_rows_to_file(rows, path: str, flush_every: int = 100) -> str:
+    """把行迭代器（如 iter_pdf_rows）边产出边写入 path"""
+    with RowStreamWriter(path, flush_every=flush_every) as w:
+        for row in rows:
+            w.write(row)
+    return str(w.path)
+
+
 def open_file_windows(path: str):
     try:
         os.startfile(path)  # noqa
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+调试ROI图的后台写出（--debug_dir）：
+- 识别线程只把裁剪图放进有界队列，编码+写盘在后台线程完成；队列满时识别线程等待（内存有上限）
+- 格式：png（压缩级别0~9，默认1=快）/ jpg / webp（质量0~100，默认90）
+- 抽样：all=每页都存；failed=只存有字段没通过校验的页；suspect=failed + 可疑页（如锚点没找到）
+- 统计：写出/抽样跳过的页数、写出文件数、失败数、队列最大积压、识别线程因队列满等待的总时长
+多进程时每个进程各有一个写出线程，统计用 take_stats()/add_stats() 汇总（同 ResultCache）。
+"""
+
+import queue
+import threading
+import time
+from pathlib import Path
+
+from invoice_timing import LazyModule
+
+cv2 = LazyModule("cv2")
+
+DEBUG_FORMATS = ("png", "jpg", "webp")
+DEBUG_SAMPLES = ("all", "failed", "suspect")
+DEFAULT_QUEUE_PAGES = 32
+# 调试图文件名后缀：字段 -> 简写
+DEBUG_SUFFIX = {"invoice_no": "inv", "invoice_date": "date", "total_amount": "amt"}
+
+
+def encode_params(fmt: str, level: int | None):
+    """cv2.imencode 的扩展名和参数；level 为 None 时用默认（png快速压缩 / jpg,webp 质量90）"""
+    if fmt == "png":
+        return ".png", [cv2.IMWRITE_PNG_COMPRESSION, 1 if level is None else int(level)]
+    if fmt == "jpg":
+        return ".jpg", [cv2.IMWRITE_JPEG_QUALITY, 90 if level is None else int(level)]
+    if fmt == "webp":
+        return ".webp", [cv2.IMWRITE_WEBP_QUALITY, 90 if level is None else int(level)]
+    raise ValueError(f"不支持的调试图格式: {fmt}")
+
+
+class DebugWriter:
+    def __init__(self, out_dir: str, fmt: str = "png", level: int | None = None, sample: str = "all",
+                 max_queue: int = DEFAULT_QUEUE_PAGES):
+        if fmt not in DEBUG_FORMATS:
+            raise ValueError(f"不支持的调试图格式: {fmt}")
+        if sample not in DEBUG_SAMPLES:
+            raise ValueError(f"不支持的调试图抽样方式: {sample}")
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.fmt, self.level, self.sample = fmt, level, sample
+        self.max_queue = max(1, int(max_queue))
+        self._q = queue.Queue(self.max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pages = 0         # 提交写出的页数
+        self.skipped = 0       # 被抽样跳过的页数
+        self.files = 0         # 写出的图片数
+        self.errors = 0        # 编码/写盘失败的图片数
+        self.max_backlog = 0   # 队列中最多同时积压的页数
+        self.wait_sec = 0.0    # 识别线程因队列满而等待的时长
+
+    def args(self):
+        """传给worker进程重建同样设置的写出器"""
+        return str(self.out_dir), self.fmt, self.level, self.sample, self.max_queue
+
+    def wanted(self, status: str) -> bool:
+        """status: ok / failed / suspect（由调用方按结果行判断）"""
+        if self.sample == "all":
+            return True
+        if self.sample == "failed":
+            return status == "failed"
+        return status in ("failed", "suspect")
+
+    def submit(self, tag: str, rois, status: str = "ok"):
+        """
+        把一页的ROI图 {字段: 图} 放进写出队列，文件名 <tag>_<inv|date|amt>.<格式>；
+        抽样不要的页直接跳过。队列满时阻塞，直到后台线程写出一页。
+        """
+        if not self.wanted(status):
+            self.skipped += 1
+            return
+        # 裁剪块可能是整页图的视图：复制一份，避免队列里的一页把整页图一直留在内存里
+        imgs = [(DEBUG_SUFFIX.get(f, f), img if img.base is None else img.copy())
+                for f, img in rois.items() if img is not None and img.size]
+        if not imgs:
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="debug-writer", daemon=True)
+            self._thread.start()
+        item = (tag, imgs)
+        try:
+            self._q.put_nowait(item)
+        except queue.Full:
+            t0 = time.perf_counter()
+            self._q.put(item)
+            self.wait_sec += time.perf_counter() - t0
+        self.pages += 1
+        self.max_backlog = max(self.max_backlog, self._q.qsize())
+
+    def backlog(self) -> int:
+        """当前队列中等待写出的页数"""
+        return self._q.qsize()
+
+    def _run(self):
+        ext, params = encode_params(self.fmt, self.level)
+        while True:
+            item = self._q.get()
+            try:
+                if item is None:
+                    return
+                tag, imgs = item
+                for suffix, img in imgs:
+                    try:
+                        ok, buf = cv2.imencode(ext, img, params)
+                        if not ok:
+                            raise ValueError("imencode failed")
+                        buf.tofile(str(self.out_dir / f"{tag}_{suffix}{ext}"))
+                        with self._lock:
+                            self.files += 1
+                    except Exception:
+                        with self._lock:
+                            self.errors += 1
+            finally:
+                self._q.task_done()
+
+    def flush(self):
+        """等待队列中已提交的图全部写完"""
+        if self._thread is not None:
+            self._q.join()
+
+    def close(self):
+        if self._thread is not None:
+            self._q.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def take_stats(self) -> dict:
+        """不等队列写完：还在写的图计入下一次交回的 files（进程退出前由 close() 写完）"""
+        with self._lock:
+            stats = {"pages": self.pages, "skipped": self.skipped, "files": self.files, "errors": self.errors,
+                     "max_backlog": self.max_backlog, "wait_sec": self.wait_sec}
+            self._reset()
+        return stats
+
+    def add_stats(self, stats: dict):
+        with self._lock:
+            for k in ("pages", "skipped", "files", "errors", "wait_sec"):
+                setattr(self, k, getattr(self, k) + stats[k])
+            self.max_backlog = max(self.max_backlog, stats["max_backlog"])
+
+    def summary(self) -> str:
+        s = (f"pages={self.pages} skipped={self.skipped} files={self.files} format={self.fmt} "
+             f"backlog={self.backlog()} max_backlog={self.max_backlog}/{self.max_queue} wait={self.wait_sec:.3f}s")
+        return s + f" errors={self.errors}" if self.errors else s
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_worker_writer(writer_args):
+    """worker进程里按主进程写出器的 args() 重建；进程退出时先把队列写完再退出"""
+    if not writer_args:
+        return None
+    import multiprocessing.util
+    writer = DebugWriter(*writer_args)
+    multiprocessing.util.Finalize(None, writer.close, exitpriority=10)
+    return writer
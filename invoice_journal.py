@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+批量任务的页级检查点日志（JSONL，只追加）：
+- 第一行是任务头 {"tag": ...}（ROI配置 + 影响结果行的运行选项的哈希，见 run_tag），
+  续跑时 tag 不一致（或任务头只写了一半、无法确认）说明配置/选项变了，旧记录作废
+- 之后每完成一页追加一行 {"pdf": 路径, "size": 文件字节数, "page": 页索引（0起，图片为null）, "row": 结果行}
+- 默认放在输出文件旁：<输出文件>.journal.jsonl；每 flush_every 行 fsync 一次，进程被终止时最多丢最后几行
+- 进程中途被杀时最后一行可能只写了一半，读取时跳过
+- resume=True：读入已有记录，调用方跳过这些页并把记录里的行按页码并回结果；PDF被替换（大小变了）时该文件的记录不用
+只记录识别成功的页；出错的页续跑时会重新识别。
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+JOURNAL_SUFFIX = ".journal.jsonl"
+
+
+def default_journal_path(out_path: str) -> str:
+    return str(out_path) + JOURNAL_SUFFIX
+
+
+def file_tag(path: str) -> str | None:
+    """文件内容的短哈希（用作任务头 tag）；文件不存在返回 None"""
+    p = Path(path)
+    if not p.is_file():
+        return None
+    return hashlib.sha1(p.read_bytes()).hexdigest()[:16]
+
+
+def run_tag(signature) -> str:
+    """任务头 tag：影响结果行内容和列的一切（配置、运行选项）放进一个可JSON序列化的对象，取短哈希"""
+    raw = json.dumps(signature, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _pdf_key(pdf_path: str) -> str:
+    return os.path.normcase(str(Path(pdf_path).resolve()))
+
+
+def _file_size(pdf_path: str) -> int | None:
+    try:
+        return Path(pdf_path).stat().st_size
+    except OSError:
+        return None
+
+
+class PageJournal:
+    def __init__(self, path: str, resume: bool = False, tag: str | None = None, flush_every: int = 20):
+        self.path = Path(path)
+        self.tag = tag
+        self.flush_every = max(1, int(flush_every))
+        self.resumed = 0    # 本次从日志直接取用的页数
+        self.recorded = 0   # 本次新写入的页数
+        self.stale = False  # 续跑时日志的 tag 与本次不一致，旧记录已丢弃
+        self._done = {}     # (pdf_key, size) -> {page: row}
+        self._since_sync = 0
+        self._torn = False
+        if resume and self.path.exists():
+            self._load()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self._done:
+            self._fh = open(self.path, "a", encoding="utf-8")
+            if self._torn:
+                self._fh.write("\n")  # 半行单独成行，下次读取时跳过
+        else:
+            # 新任务（或旧日志不可用）：重写任务头
+            self._fh = open(self.path, "w", encoding="utf-8")
+            self._append({"tag": self.tag})
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8") as fh:
+            text = fh.read()
+        self._torn = bool(text) and not text.endswith("\n")
+        lines = text.splitlines()
+        if not lines:
+            return
+        try:
+            head = json.loads(lines[0])
+        except ValueError:
+            head = None  # 任务头写了一半：无法确认 tag，当作配置变了
+        if not isinstance(head, dict) or "tag" not in head or head["tag"] != self.tag:
+            self.stale = True
+            return
+        done = {}
+        for line in lines[1:]:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # 被中断时写了一半的行
+            if "pdf" in rec and isinstance(rec.get("row"), dict):
+                done.setdefault((rec["pdf"], rec.get("size")), {})[rec.get("page")] = rec["row"]
+        self._done = done
+
+    def _append(self, rec):
+        self._fh.write(json.dumps(rec, ensure_ascii=False, default=str) + "\n")
+        self._fh.flush()
+        self._since_sync += 1
+        if self._since_sync >= self.flush_every:
+            self.sync()
+
+    def done_pages(self, pdf_path: str) -> dict:
+        """该文件已完成的页 {page: row}（返回行的副本，调用方可以随意修改）；同时计入 resumed"""
+        done = self._done.get((_pdf_key(pdf_path), _file_size(pdf_path)), {})
+        self.resumed += len(done)
+        return {page: dict(row) for page, row in done.items()}
+
+    def record(self, pdf_path: str, page_index: int | None, row):
+        self._append({"pdf": _pdf_key(pdf_path), "size": _file_size(pdf_path), "page": page_index, "row": row})
+        self.recorded += 1
+
+    def sync(self):
+        if self._fh is not None:
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+        self._since_sync = 0
+
+    def close(self):
+        if self._fh is not None:
+            self.sync()
+            self._fh.close()
+            self._fh = None
+
+    def remove(self):
+        """任务完整结束、结果已导出后删除日志"""
+        self.close()
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def summary(self) -> str:
+        s = f"resumed={self.resumed} recorded={self.recorded}"
+        return s + " stale=1" if self.stale else s
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+分阶段计时（离线）：定位吞吐下降出在哪一步。
+- 阶段：engine_init / cache / text_layer / render / rotate / crop / preprocess /
+  ocr_det_rec / ocr_rec / rec_batch / debug_write / export
+- 每页（批量模式下为每组页）一条记录：各阶段耗时、跑了哪些OCR尝试、是否触发重试，回调 page_hook(record)
+- 结束时 summary() 汇总：各阶段总耗时/次数/占比、单页耗时 p50/p95、OCR尝试次数、重试次数
+- 多进程时各worker用 take_stats() 交回增量，由主进程 add_stats() 汇总（同 ResultCache）
+- LazyModule：重型依赖（fitz/numpy/cv2/rapidocr）第一次用到时才导入，导入耗时记在 IMPORT_TIMES（--startup_profile）；
+  这是在已导入模块之上的增量，单独导入的耗时用 fresh_import_times() 在新解释器里测
+不开启时 invoice_core 里只剩一次 None 判断，几乎没有开销。
+"""
+
+import importlib
+import sys
+import time
+from collections import Counter
+
+# 模块名 -> (导入耗时秒, 开始导入时距本模块加载的秒数, 导入前是否已被别的模块导入)
+IMPORT_TIMES = {}
+_T0 = time.perf_counter()
+
+
+class LazyModule:
+    """
+    模块代理：第一次访问属性时才 import，之后把取到的属性缓存在代理上（再次访问不再经过 __getattr__）。
+    用法：cv2 = LazyModule("cv2")，其余代码照常写 cv2.resize(...)。
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._mod = None
+
+    def _load(self):
+        if self._mod is None:
+            preloaded = self._name in sys.modules
+            t0 = time.perf_counter()
+            self._mod = importlib.import_module(self._name)
+            IMPORT_TIMES[self._name] = (time.perf_counter() - t0, t0 - _T0, preloaded)
+        return self._mod
+
+    def __getattr__(self, attr):
+        value = getattr(self._load(), attr)
+        setattr(self, attr, value)
+        return value
+
+    def __repr__(self):
+        state = "loaded" if self._mod is not None else "not loaded"
+        return f"<LazyModule {self._name} ({state})>"
+
+
+_FRESH_IMPORT = "import time; t0 = time.perf_counter(); import {}; print(time.perf_counter() - t0)"
+
+
+def fresh_import_times(names) -> dict:
+    """每个模块在一个新解释器里单独导入的耗时（秒）；导入失败的模块记 None"""
+    import subprocess  # 只在 --startup_profile 时用到，不加到启动路径上
+    out = {}
+    for name in names:
+        try:
+            r = subprocess.run([sys.executable, "-c", _FRESH_IMPORT.format(name)],
+                               capture_output=True, text=True, timeout=120)
+            out[name] = float(r.stdout.strip()) if r.returncode == 0 else None
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            out[name] = None
+    return out
+
+
+def format_import_times(fresh: dict | None = None) -> str:
+    """
+    按导入先后列出已触发的延迟导入：模块 增量耗时 [单独导入耗时] @首次使用时刻。
+    增量 = 在本进程已导入的模块之上多花的时间（如 rapidocr 已带进 cv2/numpy，之后 cv2 的增量接近0，
+    这种标 preloaded）；fresh 传 fresh_import_times() 的结果时加一列新解释器里单独导入的耗时
+    """
+    lines = []
+    for name, (sec, at, preloaded) in sorted(IMPORT_TIMES.items(), key=lambda kv: kv[1][1]):
+        line = f"{name:24s} incremental={sec * 1000:.1f}ms"
+        if fresh is not None:
+            line += " fresh=" + ("n/a" if fresh.get(name) is None else f"{fresh[name] * 1000:.1f}ms")
+        line += f"  @{at:.3f}s"
+        lines.append(line + (" preloaded" if preloaded else ""))
+    return "\n".join(lines)
+
+
+np = LazyModule("numpy")
+
+
+class _Stage:
+    __slots__ = ("timer", "name", "t0")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.timer.add(self.name, time.perf_counter() - self.t0)
+
+
+class _Page:
+    __slots__ = ("timer", "record", "t0")
+
+    def __init__(self, timer, record):
+        self.timer = timer
+        self.record = record
+
+    def __enter__(self):
+        self.timer._page = self.record
+        self.t0 = time.perf_counter()
+        return self.record
+
+    def __exit__(self, exc_type, exc, tb):
+        self.record["sec"] = round(time.perf_counter() - self.t0, 6)
+        self.timer._page = None
+        self.timer._finish(self.record)
+
+
+class StageTimer:
+    def __init__(self, page_hook=None, keep_records: bool = False):
+        """
+        page_hook: callable(record)，每页（组）结束时回调；多进程时在主进程汇总时回调
+        keep_records: 是否保留所有页记录（records 属性，用于导出JSON）
+        """
+        self.page_hook = page_hook
+        self.keep_records = keep_records
+        self.records = []
+        self.t0 = time.perf_counter()
+        self._reset()
+
+    def _reset(self):
+        self.stage_sec = Counter()
+        self.stage_count = Counter()
+        self.attempts = Counter()
+        self.retries = 0
+        self.retry_pages = 0
+        self.pages = 0
+        self.page_sec = []     # 每页耗时（批量组按页数平摊）
+        self._pending = []     # 还没交回主进程的页记录
+        self._page = None
+
+    # ---------- 记录 ----------
+    def stage(self, name: str):
+        return _Stage(self, name)
+
+    def add(self, name: str, sec: float):
+        self.stage_sec[name] += sec
+        self.stage_count[name] += 1
+        if self._page is not None:
+            st = self._page["stages"]
+            st[name] = st.get(name, 0.0) + sec
+
+    def attempt(self, field: str, kind: str, retry: bool = False):
+        """一次OCR调用：field=字段，kind=det+rec / rec / rec_batch；retry=是否为校验失败后的重试"""
+        label = f"{field}:{kind}" + (":retry" if retry else "")
+        self.attempts[label] += 1
+        if retry:
+            self.retries += 1
+        if self._page is not None:
+            self._page["ocr"].append(label)
+            if retry:
+                self._page["retry"] = True
+
+    def page(self, pdf_path: str, page_indices):
+        record = {"file": str(pdf_path), "pages": [i + 1 for i in page_indices],
+                  "stages": {}, "ocr": [], "retry": False}
+        return _Page(self, record)
+
+    def _finish(self, record):
+        n = max(1, len(record["pages"]))
+        record["stages"] = {k: round(v, 6) for k, v in record["stages"].items()}
+        self.pages += len(record["pages"])
+        self.retry_pages += len(record["pages"]) if record["retry"] else 0
+        self.page_sec += [record["sec"] / n] * n
+        self._pending.append(record)
+        self._emit(record)
+
+    def _emit(self, record):
+        if self.keep_records:
+            self.records.append(record)
+        if self.page_hook:
+            try:
+                self.page_hook(record)
+            except Exception:
+                pass
+
+    # ---------- 多进程汇总 ----------
+    def take_stats(self) -> dict:
+        """取出并清零（worker进程交回主进程用）"""
+        stats = {
+            "stage_sec": dict(self.stage_sec), "stage_count": dict(self.stage_count),
+            "attempts": dict(self.attempts), "retries": self.retries, "retry_pages": self.retry_pages,
+            "pages": self.pages, "page_sec": self.page_sec, "records": self._pending,
+        }
+        self._reset()
+        return stats
+
+    def add_stats(self, stats: dict):
+        self.stage_sec.update(stats["stage_sec"])
+        self.stage_count.update(stats["stage_count"])
+        self.attempts.update(stats["attempts"])
+        self.retries += stats["retries"]
+        self.retry_pages += stats["retry_pages"]
+        self.pages += stats["pages"]
+        self.page_sec += stats["page_sec"]
+        for record in stats["records"]:
+            self._emit(record)
+
+    # ---------- 汇总 ----------
+    def summary(self) -> dict:
+        total = sum(self.stage_sec.values()) or 1.0
+        stages = {
+            name: {
+                "sec": round(sec, 4),
+                "count": self.stage_count[name],
+                "mean_ms": round(sec / max(1, self.stage_count[name]) * 1000, 3),
+                "share": round(sec / total, 4),
+            }
+            for name, sec in self.stage_sec.most_common()
+        }
+        return {
+            "pages": self.pages,
+            "wall_sec": round(time.perf_counter() - self.t0, 4),
+            "page_p50_sec": round(float(np.percentile(self.page_sec, 50)), 4) if self.page_sec else None,
+            "page_p95_sec": round(float(np.percentile(self.page_sec, 95)), 4) if self.page_sec else None,
+            "stages": stages,
+            "ocr_attempts": dict(self.attempts.most_common()),
+            "retries": self.retries,
+            "retry_pages": self.retry_pages,
+        }
+
+    def format_summary(self) -> str:
+        s = self.summary()
+        lines = [f"pages={s['pages']} wall={s['wall_sec']}s "
+                 f"page_p50={s['page_p50_sec']}s page_p95={s['page_p95_sec']}s "
+                 f"retries={s['retries']} retry_pages={s['retry_pages']}"]
+        for name, st in s["stages"].items():
+            lines.append(f"{name:12s} {st['sec']:>9.3f}s {st['share'] * 100:5.1f}%  "
+                         f"n={st['count']:<6d} mean={st['mean_ms']:.1f}ms")
+        for label, n in s["ocr_attempts"].items():
+            lines.append(f"ocr {label} x{n}")
+        return "\n".join(lines)
@@ -1,16 +1,17 @@
 # -*- coding: utf-8 -*-
 import sys
 import json
+import queue
+import threading
 import subprocess
 from pathlib import Path
 from datetime import datetime
+from collections import OrderedDict
 
-import numpy as np
-import cv2
 import fitz  # PyMuPDF
 
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QSize
-from PyQt5.QtGui import QPixmap, QImage, QIcon, QPainter, QPainterPath, QColor
+from PyQt5.QtCore import Qt, QThread, pyqtSignal, QSize, QRectF
+from PyQt5.QtGui import QPixmap, QImage, QIcon, QPainter, QPainterPath, QColor, QPen
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QLabel, QPushButton, QFileDialog,
     QMessageBox, QCheckBox, QTextEdit, QHBoxLayout, QInputDialog, QSpinBox,
@@ -53,155 +54,301 @@ def rounded_square_pixmap(pix: QPixmap, size: int = 48, radius: int = 12) -> QPi
 
 
 # ------------------ 预览相关工具 ------------------
-def rotate_img(img, rotate: str):
+def rotate_degrees(rotate: str) -> int:
+    """rotate参数 -> 渲染矩阵的旋转角度（PyMuPDF 正角度=顺时针）"""
     rotate = (rotate or "0").lower()
     if rotate in ["0", "none"]:
-        return img
+        return 0
     if rotate in ["cw90", "90", "right", "r"]:
-        return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+        return 90
     if rotate in ["ccw90", "-90", "left", "l"]:
-        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+        return -90
     if rotate in ["180", "flip"]:
-        return cv2.rotate(img, cv2.ROTATE_180)
+        return 180
     raise ValueError(f"不支持的rotate参数: {rotate}")
 
 
-def render_pdf_page_to_bgr(doc: fitz.Document, page_index: int, dpi: int):
+def render_page_qimage(doc: fitz.Document, page_index: int, width: int, rotate: str = "0") -> QImage:
+    """按目标像素宽度（屏幕分辨率）渲染，旋转并入渲染矩阵；可在后台线程调用（QImage 不依赖GUI线程）"""
     page = doc[page_index]
-    pix = page.get_pixmap(dpi=dpi)
-    img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
-    if pix.n == 4:
-        img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
-    else:
-        img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-    return img
+    deg = rotate_degrees(rotate)
+    page_w = page.rect.height if deg in (90, -90) else page.rect.width
+    zoom = width / max(1.0, page_w)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom).prerotate(deg), alpha=False)
+    # pix.samples 是临时bytes，copy() 让 QImage 持有自己的数据
+    return QImage(pix.samples, pix.width, pix.height, pix.stride, QImage.Format_RGB888).copy()
+
+
+# 预览框：配置字段 -> (标签, 颜色)
+PREVIEW_BOXES = [
+    ("invoice_no", "票号(20位)", QColor(255, 128, 0)),
+    ("invoice_date", "开票日期", QColor(0, 200, 0)),
+    ("total_amount", "价税合计", QColor(200, 0, 200)),
+    ("anchor", "锚点", QColor(0, 150, 255)),
+]
+PREVIEW_CACHE_PAGES = 24   # 预览 LRU 缓存的页数（QPixmap）
+PREVIEW_PREFETCH = 2       # 当前页之后预取的页数（之前预取1页）
+
+
+def draw_roi_boxes(pix: QPixmap, cfg: dict) -> QPixmap:
+    """在显示用的副本上用 QPainter 画ROI框，缓存里的页面图保持干净"""
+    out = pix.copy()
+    out.setDevicePixelRatio(pix.devicePixelRatio())
+    W = out.width() / out.devicePixelRatio()
+    H = out.height() / out.devicePixelRatio()
+    painter = QPainter(out)
+    painter.setRenderHint(QPainter.Antialiasing, True)
+    fm = painter.fontMetrics()
+    for key, label, color in PREVIEW_BOXES:
+        b = cfg.get(key)
+        if not b:
+            continue
+        rect = QRectF(b["x1"] * W, b["y1"] * H, (b["x2"] - b["x1"]) * W, (b["y2"] - b["y1"]) * H)
+        painter.setPen(QPen(color, 2, Qt.DashLine if key == "anchor" else Qt.SolidLine))
+        painter.setBrush(Qt.NoBrush)
+        painter.drawRect(rect)
+        tw, th = fm.horizontalAdvance(label) + 10, fm.height() + 4
+        tag = QRectF(rect.left(), max(0.0, rect.top() - th), tw, th)
+        painter.fillRect(tag, color)
+        painter.setPen(Qt.white)
+        painter.drawText(tag, Qt.AlignCenter, label)
+    painter.end()
+    return out
+
 
+class PreviewRenderer(QThread):
+    """
+    预览后台渲染线程：独占一个 fitz.Document（文档对象不跨线程共享），
+    按请求顺序逐页渲染成 QImage 发回GUI线程；新请求整体替换旧队列，翻页时过时的预取直接作废。
+    """
+    rendered = pyqtSignal(int, QImage)
+    failed = pyqtSignal(int, str)
 
-def norm_to_abs(norm_box, W, H):
-    x1 = int(norm_box["x1"] * W)
-    y1 = int(norm_box["y1"] * H)
-    x2 = int(norm_box["x2"] * W)
-    y2 = int(norm_box["y2"] * H)
-    return x1, y1, x2, y2
+    def __init__(self, pdf_path: str, width: int, rotate: str = "0"):
+        super().__init__()
+        self.pdf_path = pdf_path
+        self.width = width
+        self.rotate = rotate
+        self._wanted = []
+        self._stop = False
+        self._cond = threading.Condition()
+
+    def request(self, pages):
+        with self._cond:
+            self._wanted = list(pages)
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
 
+    def run(self):
+        doc = fitz.open(self.pdf_path)
+        try:
+            while True:
+                with self._cond:
+                    while not self._wanted and not self._stop:
+                        self._cond.wait()
+                    if self._stop:
+                        return
+                    i = self._wanted.pop(0)
+                try:
+                    img = render_page_qimage(doc, i, self.width, self.rotate)
+                except Exception as e:
+                    self.failed.emit(i, str(e))
+                    continue
+                self.rendered.emit(i, img)
+        finally:
+            doc.close()
 
-def draw_box(img, box, color, label):
-    x1, y1, x2, y2 = box
-    cv2.rectangle(img, (x1, y1), (x2, y2), color, 3)
-    (tw, th), _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.85, 2)
-    cv2.rectangle(img, (x1, max(0, y1 - th - 12)), (x1 + tw + 12, y1), color, -1)
-    cv2.putText(img, label, (x1 + 6, y1 - 7),
-                cv2.FONT_HERSHEY_SIMPLEX, 0.85, (255, 255, 255), 2)
 
+# ------------------ 常驻OCR进程（invoice_worker.py，行分隔JSON协议） ------------------
+class OcrService:
+    """
+    UI 只启动一次 invoice_worker.py，之后每个PDF都作为一个job提交给它：
+    省掉每个PDF的 Python 启动、cv2/fitz/rapidocr 导入和 RapidOCR 模型加载。
+    事件由读线程按 job id 分发给各自的 listener；非JSON行（日志）广播给所有 listener。
+    """
 
-def bgr_to_qpixmap(img_bgr):
-    rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
-    h, w, ch = rgb.shape
-    bytes_per_line = ch * w
-    qimg = QImage(rgb.data, w, h, bytes_per_line, QImage.Format_RGB888)
-    return QPixmap.fromImage(qimg)
+    def __init__(self):
+        self._proc = None
+        self._lock = threading.Lock()
+        self._listeners = {}  # job_id -> callable(event: dict)
+        self._seq = 0
 
+    def is_running(self) -> bool:
+        return self._proc is not None and self._proc.poll() is None
 
-# ------------------ 子进程 Worker：OCR（实时进度） ------------------
+    def ensure_started(self):
+        with self._lock:
+            if self.is_running():
+                return
+            script = Path(__file__).parent / "invoice_worker.py"
+            if not script.exists():
+                raise FileNotFoundError(f"缺少文件：{script}")
+            self._proc = subprocess.Popen(
+                [sys.executable, str(script)],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                encoding="utf-8",
+                errors="replace",
+                bufsize=1
+            )
+            threading.Thread(target=self._read_events, args=(self._proc,), daemon=True).start()
+
+    def _read_events(self, proc):
+        for line in proc.stdout:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                ev = json.loads(line)
+            except Exception:
+                ev = {"event": "log", "text": line}
+            with self._lock:
+                if ev.get("id") in self._listeners:
+                    targets = [self._listeners[ev["id"]]]
+                else:
+                    targets = list(self._listeners.values())
+            for cb in targets:
+                try:
+                    cb(ev)
+                except Exception:
+                    pass
+        # 进程退出：通知所有还在等的job
+        with self._lock:
+            targets = list(self._listeners.items())
+        for job_id, cb in targets:
+            cb({"event": "error", "id": job_id, "message": f"OCR进程已退出（退出码={proc.poll()}）"})
+
+    def _send(self, msg: dict):
+        with self._lock:
+            if not self.is_running():
+                raise RuntimeError("OCR进程未运行")
+            self._proc.stdin.write(json.dumps(msg, ensure_ascii=False) + "\n")
+            self._proc.stdin.flush()
+
+    def submit(self, job: dict, listener) -> str:
+        self.ensure_started()
+        with self._lock:
+            self._seq += 1
+            job_id = f"job{self._seq}"
+            self._listeners[job_id] = listener
+        self._send({"cmd": "submit", "id": job_id, **job})
+        return job_id
+
+    def release(self, job_id: str):
+        with self._lock:
+            self._listeners.pop(job_id, None)
+
+    def cancel(self, job_id: str):
+        try:
+            self._send({"cmd": "cancel", "id": job_id})
+        except Exception:
+            pass
+
+    def shutdown(self):
+        if not self.is_running():
+            return
+        try:
+            self._send({"cmd": "shutdown"})
+            self._proc.wait(timeout=5)
+        except Exception:
+            try:
+                self._proc.terminate()
+            except Exception:
+                pass
+
+
+# ------------------ Worker：提交到常驻OCR进程（实时进度） ------------------
 class RunOcrWorker(QThread):
     progress_text = pyqtSignal(str)
     progress_value = pyqtSignal(int, int)  # cur, total
     finished = pyqtSignal(str)
     failed = pyqtSignal(str)
 
-    def __init__(self, pdf_path: str, debug_dir: str | None):
+    def __init__(self, service: OcrService, pdf_path: str, debug_dir: str | None):
         super().__init__()
+        self.service = service
         self.pdf_path = pdf_path
         self.debug_dir = debug_dir
-        self._proc = None
+        self._job_id = None
+        self._cancel_requested = False
 
     def cancel(self):
-        try:
-            if self._proc and self._proc.poll() is None:
-                self._proc.terminate()
-        except Exception:
-            pass
+        # 协作式取消：worker处理完当前页后停止，进程保留给下一个PDF
+        self._cancel_requested = True
+        if self._job_id:
+            self.service.cancel(self._job_id)
 
     def run(self):
+        events = queue.Queue()
         try:
             self.progress_text.emit(f"开始处理：{self.pdf_path}")
             pdf = Path(self.pdf_path)
             ts = datetime.now().strftime("%Y%m%d_%H%M%S")
             out_xlsx = str(pdf.parent / f"invoice_extract_{ts}.xlsx")
 
-            cli = Path(__file__).parent / "invoice_cli.py"
-            if not cli.exists():
-                self.failed.emit(f"缺少文件：{cli}")
-                return
-
-            cmd = [sys.executable, str(cli), self.pdf_path, "--out", out_xlsx]
-            if self.debug_dir:
-                cmd += ["--debug_dir", self.debug_dir]
-
-            self._proc = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                encoding="utf-8",
-                errors="replace",
-                bufsize=1
-            )
+            if not self.service.is_running():
+                self.progress_text.emit("启动OCR进程（首次加载模型）...")
+            # 检查点日志按PDF固定路径：取消后再拖入同一PDF，已完成的页不再识别（ROI重新校准后自动作废）
+            journal = str(pdf.parent / f"{pdf.stem}_extract.journal.jsonl")
+            job = {"pdf": self.pdf_path, "out": out_xlsx, "debug_dir": self.debug_dir,
+                   "journal": journal, "resume": True}
+            self._job_id = self.service.submit(job, events.put)
+            if self._cancel_requested:
+                self.service.cancel(self._job_id)
 
-            last_result = None
             while True:
-                line = self._proc.stdout.readline() if self._proc.stdout else ""
-                if not line:
-                    if self._proc.poll() is not None:
-                        break
-                    continue
-                line = line.strip()
-
-                if line.startswith("PROGRESS "):
-                    parts = line.split()
-                    if len(parts) >= 3:
-                        try:
-                            cur = int(parts[1])
-                            total = int(parts[2])
-                            self.progress_value.emit(cur, total)
-                            self.progress_text.emit(f"处理中：{cur}/{total}")
-                        except Exception:
-                            self.progress_text.emit(line)
-                    else:
-                        self.progress_text.emit(line)
-                    continue
-
-                if line.startswith("RESULT "):
-                    last_result = line.replace("RESULT ", "", 1).strip()
-                    self.progress_text.emit(f"导出完成：{last_result}")
-                    continue
-
-                self.progress_text.emit(line)
-
-            rc = self._proc.poll()
-            if rc != 0:
-                self.failed.emit(f"子进程退出码={rc}（可能被取消或出错）")
-                return
-
-            if not last_result:
-                last_result = out_xlsx
-
-            self.finished.emit(last_result)
+                ev = events.get()
+                kind = ev.get("event")
+
+                if kind == "progress":
+                    cur, total = int(ev.get("cur", 0)), int(ev.get("total", 0))
+                    self.progress_value.emit(cur, total)
+                    self.progress_text.emit(f"处理中：{cur}/{total}")
+                elif kind == "result":
+                    self.progress_text.emit(f"导出完成：{ev.get('path')}（{ev.get('sec')}s）")
+                    self.finished.emit(ev.get("path") or out_xlsx)
+                    return
+                elif kind == "cancelled":
+                    self.failed.emit("任务已取消")
+                    return
+                elif kind == "error":
+                    self.failed.emit(ev.get("message") or "未知错误")
+                    return
+                elif kind == "log":
+                    self.progress_text.emit(ev.get("text", ""))
+                elif kind == "ready":
+                    self.progress_text.emit(f"OCR进程就绪（启动 {ev.get('startup_sec')}s）")
 
         except Exception as e:
             self.failed.emit(str(e))
+        finally:
+            if self._job_id:
+                self.service.release(self._job_id)
 
 
 # ------------------ 预览窗口 ------------------
 class PreviewDialog(QDialog):
-    def __init__(self, overlay_paths: list[Path], parent=None):
+    """
+    打开即显示：页面按需在后台线程按屏幕分辨率渲染，当前页优先、前后邻页预取；
+    渲染结果放进有上限的 LRU 缓存（QPixmap），ROI框显示时用 QPainter 叠加。
+    """
+
+    def __init__(self, pdf_path: str, total: int, cfg: dict, parent=None):
         super().__init__(parent)
         self.setWindowTitle("ROI 覆盖预览")
         self.resize(1100, 820)
 
-        self.overlay_paths = overlay_paths
-        self.total = len(overlay_paths)
+        self.pdf_name = Path(pdf_path).name
+        self.cfg = cfg
+        self.total = total
         self.idx = 0
+        self._cache = OrderedDict()   # 页号 -> QPixmap（最近用过的在末尾）
 
         self.setStyleSheet("""
             QDialog { background: #101418; }
@@ -253,27 +400,65 @@ class PreviewDialog(QDialog):
         layout.addWidget(scroll)
         self.setLayout(layout)
 
+        # 按当前显示宽度的物理像素渲染；窗口后来拉大时显示阶段再缩放
+        width = int(self.display_width() * self.devicePixelRatioF())
+        self.renderer = PreviewRenderer(pdf_path, width, cfg.get("rotate", "0"))
+        self.renderer.rendered.connect(self.on_rendered)
+        self.renderer.failed.connect(self.on_render_failed)
+        self.renderer.start()
+
         self.refresh()
 
+    def display_width(self) -> int:
+        return max(860, self.width() - 80)
+
     def refresh(self):
         if self.total <= 0:
-            self.lbl_info.setText("没有预览图片。")
+            self.lbl_info.setText("没有可预览的页面。")
             return
-        p = self.overlay_paths[self.idx]
-        self.lbl_info.setText(f"第 {self.idx+1}/{self.total} 页：{p.name}")
+        self.lbl_info.setText(f"第 {self.idx+1}/{self.total} 页：{self.pdf_name}")
         self.spin_page.blockSignals(True)
         self.spin_page.setValue(self.idx + 1)
         self.spin_page.blockSignals(False)
 
-        data = np.fromfile(str(p), dtype=np.uint8)
-        img = cv2.imdecode(data, cv2.IMREAD_COLOR)
-        if img is None:
-            self.image_label.setText("图片读取失败")
-            return
+        self.show_current()
+        wanted = [self.idx] + [self.idx + k for k in range(1, PREVIEW_PREFETCH + 1)] + [self.idx - 1]
+        self.renderer.request([i for i in wanted if 0 <= i < self.total and i not in self._cache])
 
-        pix = bgr_to_qpixmap(img)
-        w = max(860, self.width() - 80)
-        self.image_label.setPixmap(pix.scaledToWidth(w, Qt.SmoothTransformation))
+    def show_current(self):
+        pix = self._cache.get(self.idx)
+        if pix is None:
+            self.image_label.setText("渲染中...")
+            return
+        self._cache.move_to_end(self.idx)
+        dpr = self.devicePixelRatioF()
+        w = int(self.display_width() * dpr)
+        if pix.width() != w:
+            pix = pix.scaledToWidth(w, Qt.SmoothTransformation)
+        pix.setDevicePixelRatio(dpr)
+        self.image_label.setPixmap(draw_roi_boxes(pix, self.cfg))
+
+    def on_rendered(self, i: int, img: QImage):
+        self._cache[i] = QPixmap.fromImage(img)
+        self._cache.move_to_end(i)
+        while len(self._cache) > PREVIEW_CACHE_PAGES:
+            self._cache.popitem(last=False)
+        if i == self.idx:
+            self.show_current()
+
+    def on_render_failed(self, i: int, err: str):
+        if i == self.idx:
+            self.image_label.setText(f"第 {i+1} 页渲染失败：{err}")
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if self.total > 0:
+            self.show_current()
+
+    def done(self, r):
+        self.renderer.stop()
+        self.renderer.wait()
+        super().done(r)
 
     def prev_page(self):
         if self.idx > 0:
@@ -531,6 +716,12 @@ class MainWindow(QWidget):
         self.setLayout(root)
 
         self.ocr_worker = None
+        # 常驻OCR进程：窗口启动时就在后台加载，第一个PDF也不用等模型
+        self.ocr_service = OcrService()
+        try:
+            self.ocr_service.ensure_started()
+        except Exception as e:
+            self.append_log(f"⚠️ OCR进程启动失败：{e}")
 
         self.append_log(f"Python解释器：{sys.executable}")
         self.append_log(f"ROI配置固定路径：{ROI_CONFIG_PATH}")
@@ -540,6 +731,12 @@ class MainWindow(QWidget):
     def append_log(self, msg: str):
         self.log.append(msg)
 
+    def closeEvent(self, event):
+        if self.ocr_worker:
+            self.ocr_worker.cancel()
+        self.ocr_service.shutdown()
+        super().closeEvent(event)
+
     def set_controls_enabled(self, enabled: bool):
         self.btn_select.setEnabled(enabled)
         self.btn_calibrate.setEnabled(enabled)
@@ -588,7 +785,7 @@ class MainWindow(QWidget):
 
         self.set_controls_enabled(False)
 
-        self.ocr_worker = RunOcrWorker(pdf_path, debug_dir)
+        self.ocr_worker = RunOcrWorker(self.ocr_service, pdf_path, debug_dir)
         self.ocr_worker.progress_text.connect(self.on_progress_text)
         self.ocr_worker.progress_value.connect(self.on_progress_value)
         self.ocr_worker.finished.connect(self.on_ocr_finished)
@@ -680,7 +877,6 @@ class MainWindow(QWidget):
 
         try:
             cfg = json.loads(Path(ROI_CONFIG_PATH).read_text(encoding="utf-8"))
-            dpi = int(cfg.get("dpi", 300))
             rotate = cfg.get("rotate", "0")
         except Exception as e:
             QMessageBox.critical(self, "ROI配置错误", f"无法读取ROI配置：\n{e}")
@@ -689,43 +885,15 @@ class MainWindow(QWidget):
         max_pages = int(self.spin_max_pages.value())
 
         try:
-            pdf = Path(pdf_path)
-            doc = fitz.open(str(pdf))
-            total = len(doc)
+            with fitz.open(pdf_path) as doc:
+                total = len(doc)
             n = total if max_pages == 0 else min(total, max_pages)
-
-            ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-            out_dir = pdf.parent / f"roi_preview_{pdf.stem}_{ts}"
-            out_dir.mkdir(parents=True, exist_ok=True)
-
-            self.append_log(f"ROI预览：{pdf.name} rotate={rotate} dpi={dpi} pages={n}/{total}")
-
-            overlay_paths = []
-            for i in range(n):
-                img = render_pdf_page_to_bgr(doc, i, dpi=dpi)
-                img = rotate_img(img, rotate)
-                H, W = img.shape[:2]
-
-                inv_box = norm_to_abs(cfg["invoice_no"], W, H)
-                date_box = norm_to_abs(cfg["invoice_date"], W, H)
-                amt_box = norm_to_abs(cfg["total_amount"], W, H)
-
-                overlay = img.copy()
-                draw_box(overlay, inv_box, (0, 128, 255), "票号(20位)")
-                draw_box(overlay, date_box, (0, 200, 0), "开票日期")
-                draw_box(overlay, amt_box, (200, 0, 200), "价税合计")
-
-                out_img = out_dir / f"page_{i+1:03d}_overlay.png"
-                cv2.imencode(".png", overlay)[1].tofile(str(out_img))
-                overlay_paths.append(out_img)
-
-            doc.close()
-
-            if not overlay_paths:
-                QMessageBox.information(self, "预览", "没有生成任何预览图片。")
+            if n == 0:
+                QMessageBox.information(self, "预览", "PDF 没有页面。")
                 return
 
-            dlg = PreviewDialog(overlay_paths, parent=self)
+            self.append_log(f"ROI预览：{Path(pdf_path).name} rotate={rotate} pages={n}/{total}（按需渲染）")
+            dlg = PreviewDialog(pdf_path, n, cfg, parent=self)
             dlg.exec_()
 
         except Exception as e:
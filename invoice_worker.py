@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+常驻OCR worker（离线）：UI启动一次，之后所有PDF都复用同一个进程和已加载的RapidOCR模型。
+协议：stdin/stdout 每行一个JSON（UTF-8）。
+
+请求（stdin）：
+  {"cmd": "submit", "id": "job1", "pdf": "...", "out": "...xlsx", "debug_dir": null,
+   "options": {"render_mode": "clip", "batch_size": 8, "text_layer": true, "workers": 1}}
+  {"cmd": "submit", "id": "job2", "pdfs": ["a.pdf", "目录", "*.pdf"], "out": "...xlsx"}
+                                       # 多文件/目录/通配符：所有页一个任务队列，合并输出并附文件状态行
+  {"cmd": "submit", "id": "job3", "pdf": "...", "options": {"adaptive_dpi": true}, "dpi_history": "dpi.json"}
+                                       # 按字段自适应DPI；dpi_history 为历史通过率文件（可选）
+  options 里 "dedup": true / 汉明距离：相同ROI只OCR一次，结果加“重复票号”列
+  options 里 "roi_config": 本任务用的ROI配置（默认 invoice_core.ROI_CONFIG_PATH），"rec_batch_num": 识别模型一次推理的图片数；
+                                       # 两者决定的引擎设置（配置 engine 段 + rec_batch_num）与启动时不同时，
+                                       # 为任务另建一个引擎，设置相同的后续任务复用（同时最多多留一个）；
+                                       # workers>1 时子进程仍按本任务的配置各自建引擎
+  "debug": {"format": "jpg", "level": 80, "sample": "failed", "queue": 32}
+                                       # 配合 debug_dir：调试图格式/压缩级别/抽样，后台线程写出；结果事件带 debug 统计
+  "journal": "xxx.journal.jsonl"（或 true=<out>.journal.jsonl）, "resume": true
+                                       # 页级检查点：取消/崩溃后再提交同一任务，已完成的页直接并回结果
+  {"cmd": "cancel", "id": "job1"}      # 协作式取消：当前页处理完后停止，进程继续存活
+  {"cmd": "ping"}
+  {"cmd": "shutdown"}
+
+事件（stdout）：
+  {"event": "ready", "startup_sec": 1.23, "rss_mb": 310.5, "engine": "full"}   # engine: full / rec / rec+det
+  {"event": "started", "id": "job1", "pdf": "..."}
+  {"event": "progress", "id": "job1", "cur": 3, "total": 36}
+  {"event": "result", "id": "job1", "path": "...xlsx", "pages": 36, "sec": 12.3, "rss_mb": 320.1, "engine": "full"}
+  {"event": "cancelled", "id": "job1"}
+  {"event": "error", "id": "job1", "message": "..."}
+  {"event": "pong"}
+
+用法：
+python invoice_worker.py
+"""
+
+import sys
+import json
+import time
+import queue
+import threading
+import traceback
+from pathlib import Path
+
+_T0 = time.perf_counter()
+
+import invoice_core as core  # noqa: E402  重型依赖延迟导入，启动时由建引擎/预热一次性触发
+from invoice_cache import ResultCache  # noqa: E402
+from invoice_debug import DebugWriter, DEFAULT_QUEUE_PAGES  # noqa: E402
+from invoice_journal import PageJournal, default_journal_path  # noqa: E402
+
+# 允许通过 options 传给 invoice_core.iter_pdf_rows 的参数（rec_batch_num 只用于选引擎）
+JOB_OPTION_KEYS = ("render_mode", "workers", "batch_size", "text_layer", "color_mode", "adaptive_dpi", "dedup", "anchor",
+                   "auto_rotate", "roi_config", "rec_batch_num")
+# 决定检查点日志 tag 的参数（core.journal_tag）：续跑时这些变了就从头开始
+JOURNAL_TAG_KEYS = ("roi_config", "render_mode", "batch_size", "text_layer", "color_mode", "anchor", "auto_rotate",
+                    "adaptive", "dedup")
+
+_emit_lock = threading.Lock()
+
+
+def emit(event: str, **fields):
+    line = json.dumps({"event": event, **fields}, ensure_ascii=False)
+    with _emit_lock:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def load_startup_config():
+    """启动时读ROI配置（只为其中的 "engine" 段）；还没校准时返回空配置"""
+    try:
+        return core.load_roi_config(core.ROI_CONFIG_PATH)
+    except Exception:
+        return {}
+
+
+def engine_key(cfg, rec_batch_num: int | None = None):
+    """引擎由配置的 engine 段（会话线程数、lazy_det）和 rec_batch_num 决定；键相同的任务共用一个引擎"""
+    return (json.dumps(core.resolve_engine_config(cfg), sort_keys=True),
+            bool((cfg.get("engine") or {}).get("lazy_det")), int(rec_batch_num) if rec_batch_num else None)
+
+
+def build_engine(key):
+    engine_cfg, lazy_det, rec_batch_num = key
+    # 配置 engine.lazy_det：只加载识别模型，检测模型到第一次 det 回退时才加载
+    engine = core.create_engine(rec_batch_num=rec_batch_num, engine_cfg=json.loads(engine_cfg), lazy_det=lazy_det)
+    core.warm_up_engine(engine)
+    return engine
+
+
+class Worker:
+    def __init__(self):
+        self.cfg = load_startup_config()
+        self.key = engine_key(self.cfg)
+        self.engine = build_engine(self.key)
+        self._job_engine = None   # (键, 引擎)：与启动引擎设置不同的任务用
+        self.jobs = queue.Queue()
+        self.cancelled = set()
+        self._lock = threading.Lock()
+
+    # ---------- stdin 读线程 ----------
+    def read_commands(self):
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                msg = json.loads(line)
+            except Exception:
+                emit("error", id=None, message=f"无法解析的命令：{line}")
+                continue
+
+            cmd = msg.get("cmd")
+            if cmd == "submit":
+                self.jobs.put(msg)
+            elif cmd == "cancel":
+                with self._lock:
+                    self.cancelled.add(msg.get("id"))
+            elif cmd == "ping":
+                emit("pong")
+            elif cmd == "shutdown":
+                break
+            else:
+                emit("error", id=msg.get("id"), message=f"未知命令：{cmd}")
+        # stdin关闭或shutdown：让主循环退出
+        self.jobs.put(None)
+
+    def is_cancelled(self, job_id) -> bool:
+        with self._lock:
+            return job_id in self.cancelled
+
+    def engine_for(self, roi_config: str | None, rec_batch_num: int | None):
+        """本任务的引擎：设置与启动时相同就用常驻引擎，否则复用/新建一个任务引擎"""
+        cfg = core.load_roi_config(roi_config) if roi_config else self.cfg
+        key = engine_key(cfg, rec_batch_num)
+        if key == self.key:
+            return self.engine
+        if self._job_engine is None or self._job_engine[0] != key:
+            self._job_engine = None  # 先释放上一个任务引擎再建新的
+            self._job_engine = (key, build_engine(key))
+        return self._job_engine[1]
+
+    # ---------- 主线程：顺序执行任务 ----------
+    def run_job(self, msg):
+        job_id = msg.get("id")
+        batch = bool(msg.get("pdfs"))
+        if batch:
+            pdfs = core.expand_pdf_inputs(msg["pdfs"])
+            if not pdfs:
+                raise FileNotFoundError("未找到PDF：" + " ".join(msg["pdfs"]))
+        else:
+            pdfs = [msg["pdf"]]
+            if not Path(pdfs[0]).exists():
+                raise FileNotFoundError(pdfs[0])
+        pdf = Path(pdfs[0])
+        default_name = "batch_extract.xlsx" if batch else f"{pdf.stem}_extract.xlsx"
+        out_path = msg.get("out") or str(pdf.parent / default_name)
+        options = {k: v for k, v in (msg.get("options") or {}).items() if k in JOB_OPTION_KEYS}
+        engine = self.engine_for(options.get("roi_config"), options.pop("rec_batch_num", None))
+        cache = ResultCache(msg["cache"]) if msg.get("cache") else None
+        if options.pop("adaptive_dpi", None) or msg.get("dpi_history"):
+            options["adaptive"] = core.AdaptiveDpi(history_path=msg.get("dpi_history"))
+        if options.get("dedup") is not None:
+            dedup = options.pop("dedup")
+            if dedup is not False:
+                # true 或汉明距离（整数）
+                options["dedup"] = core.RoiDedup(0 if dedup is True else int(dedup))
+
+        if msg.get("journal"):
+            jpath = default_journal_path(out_path) if msg["journal"] is True else msg["journal"]
+            tag = core.journal_tag(**{k: options.get(k) for k in JOURNAL_TAG_KEYS})
+            options["journal"] = PageJournal(jpath, resume=bool(msg.get("resume")), tag=tag)
+
+        debug = None
+        if msg.get("debug_dir"):
+            d = msg.get("debug") or {}
+            debug = DebugWriter(msg["debug_dir"], fmt=d.get("format", "png"), level=d.get("level"),
+                                sample=d.get("sample", "all"), max_queue=d.get("queue", DEFAULT_QUEUE_PAGES))
+
+        def hook(cur, total):
+            emit("progress", id=job_id, cur=cur, total=total)
+
+        def rows_until_cancel(rows):
+            for row in rows:
+                if self.is_cancelled(job_id):
+                    raise JobCancelled()
+                yield row
+
+        t0 = time.perf_counter()
+        emit("started", id=job_id, pdf=str(pdf), files=len(pdfs))
+        if batch:
+            run, target = core.iter_batch_rows, pdfs
+        else:
+            run, target = core.iter_pdf_rows, pdfs[0]
+        rows = run(target, debug_writer=debug, progress_hook=hook,
+                   cache=cache, engine=engine, **options)
+        try:
+            if Path(out_path).suffix.lower() == ".xlsx":
+                collected = list(rows_until_cancel(rows))
+                out = core.export_rows_to_excel(collected, out_path)
+                pages = len(collected)
+            else:
+                with core.RowStreamWriter(out_path) as w:
+                    for row in rows_until_cancel(rows):
+                        w.write(row)
+                out, pages = str(w.path), w.count
+        finally:
+            rows.close()
+            if cache is not None:
+                cache.close()
+            if "adaptive" in options:
+                options["adaptive"].save()
+            if "journal" in options:
+                options["journal"].close()
+            if debug is not None:
+                debug.close()
+        if "journal" in options:
+            options["journal"].remove()
+        mem = core.engine_memory(engine)
+        extra = {"debug": debug.summary()} if debug is not None else {}
+        emit("result", id=job_id, path=out, pages=pages, sec=round(time.perf_counter() - t0, 3),
+             rss_mb=mem["rss_mb"], engine=mem["engine"], **extra)
+
+    def serve(self):
+        threading.Thread(target=self.read_commands, daemon=True).start()
+        mem = core.engine_memory(self.engine)
+        emit("ready", startup_sec=round(time.perf_counter() - _T0, 3), rss_mb=mem["rss_mb"], engine=mem["engine"])
+        while True:
+            msg = self.jobs.get()
+            if msg is None:
+                break
+            job_id = msg.get("id")
+            if self.is_cancelled(job_id):
+                emit("cancelled", id=job_id)
+                continue
+            try:
+                self.run_job(msg)
+            except JobCancelled:
+                emit("cancelled", id=job_id)
+            except Exception as e:
+                emit("error", id=job_id, message=f"{e}\n{traceback.format_exc()}")
+            finally:
+                with self._lock:
+                    self.cancelled.discard(job_id)
+
+
+def main():
+    try:
+        sys.stdout.reconfigure(encoding="utf-8")
+        sys.stdin.reconfigure(encoding="utf-8")
+    except Exception:
+        pass
+    Worker().serve()
+
+
+if __name__ == "__main__":
+    main()
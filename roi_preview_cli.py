@@ -6,9 +6,12 @@ ROI覆盖预览（离线）：
 - 按ROI画框（票号/日期/金额）
 - 输出 overlay 图片 + index.html（浏览器快速查看）
 - index.html 使用绝对 file:/// 路径，避免相对路径导致图片不显示
+- --format pdf：不渲染页面，直接在PDF副本上按ROI加矩形注释（矢量，可在任意阅读器里查看/删除），
+  ROI按 rotate 反向映射回PDF页面坐标，每页几毫秒，只输出一个PDF
 
 用法：
 python roi_preview_cli.py "xxx.pdf"
+python roi_preview_cli.py "xxx.pdf" --format pdf [--out 预览.pdf]
 """
 
 import json
@@ -23,22 +26,25 @@ import cv2
 ROI_CONFIG_PATH = r"C:\Users\MY43DN\Documents\ocr\roi_config.json"
 
 
-def rotate_img(img, rotate: str):
+def rotate_degrees(rotate: str) -> int:
+    """rotate参数 -> 渲染矩阵的旋转角度（PyMuPDF 正角度=顺时针）"""
     rotate = (rotate or "0").lower()
     if rotate in ["0", "none"]:
-        return img
+        return 0
     if rotate in ["cw90", "90", "right", "r"]:
-        return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+        return 90
     if rotate in ["ccw90", "-90", "left", "l"]:
-        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+        return -90
     if rotate in ["180", "flip"]:
-        return cv2.rotate(img, cv2.ROTATE_180)
+        return 180
     raise ValueError(f"不支持的rotate参数: {rotate}")
 
 
-def render_page(doc: fitz.Document, page_index: int, dpi: int):
+def render_page(doc: fitz.Document, page_index: int, dpi: int, rotate: str = "0"):
+    """渲染时直接按 rotate 旋转（旋转并入渲染矩阵），不再额外生成整页旋转副本"""
     page = doc[page_index]
-    pix = page.get_pixmap(dpi=dpi)
+    zoom = dpi / 72.0
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom).prerotate(rotate_degrees(rotate)))
     img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
     if pix.n == 4:
         img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
@@ -47,6 +53,60 @@ def render_page(doc: fitz.Document, page_index: int, dpi: int):
     return img
 
 
+def norm_to_pdf_rect(page: fitz.Page, norm_box, rotate: str) -> fitz.Rect:
+    """
+    “旋转后页面图像”上的相对ROI -> PDF页面坐标（page.rect 坐标系，注释直接使用）。
+    用与 render_page 相同的旋转矩阵：旋转后的页面外框上取ROI，再用逆矩阵变换回去。
+    """
+    m = fitz.Matrix(1, 1).prerotate(rotate_degrees(rotate))
+    r = page.rect * m
+    box = fitz.Rect(
+        r.x0 + norm_box["x1"] * r.width, r.y0 + norm_box["y1"] * r.height,
+        r.x0 + norm_box["x2"] * r.width, r.y0 + norm_box["y2"] * r.height,
+    )
+    return (box * ~m) & page.rect
+
+
+# 注释框：配置字段 -> (标签, 颜色RGB 0~1)，与UI预览一致
+ANNOT_BOXES = [
+    ("invoice_no", "票号(20位)", (1.0, 0.5, 0.0)),
+    ("invoice_date", "开票日期", (0.0, 0.78, 0.0)),
+    ("total_amount", "价税合计", (0.78, 0.0, 0.78)),
+    ("anchor", "锚点", (0.0, 0.59, 1.0)),
+]
+
+
+def annotate_pdf(pdf: Path, out_pdf: Path, cfg, max_pages: int = 0) -> int:
+    """
+    在PDF副本上为每页加ROI矩形注释（不渲染、不改页面内容），返回处理页数。
+    max_pages>0 时只保留前N页，输出文件更小。
+    """
+    rotate = cfg.get("rotate", "0")
+    doc = fitz.open(str(pdf))
+    try:
+        n = len(doc)
+        if max_pages and max_pages > 0 and max_pages < n:
+            doc.select(range(max_pages))
+            n = max_pages
+        for page in doc:
+            for key, label, color in ANNOT_BOXES:
+                b = cfg.get(key)
+                if not b:
+                    continue
+                rect = norm_to_pdf_rect(page, b, rotate)
+                if rect.is_empty:
+                    continue
+                annot = page.add_rect_annot(rect)
+                annot.set_colors(stroke=color)
+                annot.set_border(width=1.5, dashes=[3, 2] if key == "anchor" else None)
+                annot.set_info(title="ROI", content=label)
+                annot.update()
+        doc.save(str(out_pdf), garbage=1, deflate=True)
+    finally:
+        doc.close()
+    return n
+
+
 def norm_to_abs(norm_box, W, H):
     x1 = int(norm_box["x1"] * W)
     y1 = int(norm_box["y1"] * H)
@@ -74,6 +134,9 @@ def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("pdf", help="输入PDF")
     ap.add_argument("--max_pages", type=int, default=0, help="最多预览前N页（0=全部）")
+    ap.add_argument("--format", choices=["html", "pdf"], default="html",
+                    help="html=逐页渲染PNG+index.html；pdf=输出一个带ROI矩形注释的PDF副本（不渲染，快）")
+    ap.add_argument("--out", default=None, help="--format pdf 的输出路径（默认 <PDF名>_roi_preview.pdf）")
     args = ap.parse_args()
 
     cfg_path = Path(ROI_CONFIG_PATH)
@@ -85,6 +148,12 @@ def main():
     rotate = cfg.get("rotate", "0")
 
     pdf = Path(args.pdf)
+    if args.format == "pdf":
+        out_pdf = Path(args.out) if args.out else pdf.with_name(f"{pdf.stem}_roi_preview.pdf")
+        annotate_pdf(pdf, out_pdf, cfg, max_pages=args.max_pages)
+        print(str(out_pdf))
+        return
+
     doc = fitz.open(str(pdf))
     total_pages = len(doc)
     n = total_pages
@@ -97,15 +166,14 @@ def main():
 
     out_imgs = []
     for i in range(n):
-        img = render_page(doc, i, dpi=dpi)
-        img = rotate_img(img, rotate)
+        img = render_page(doc, i, dpi=dpi, rotate=rotate)
         H, W = img.shape[:2]
 
         inv_box = norm_to_abs(cfg["invoice_no"], W, H)
         date_box = norm_to_abs(cfg["invoice_date"], W, H)
         amt_box = norm_to_abs(cfg["total_amount"], W, H)
 
-        overlay = img.copy()
+        overlay = img  # cvtColor 已返回可写的新数组，直接画框
         draw_box(overlay, inv_box, (0, 128, 255), "票号(20位)")
         draw_box(overlay, date_box, (0, 200, 0), "开票日期")
         draw_box(overlay, amt_box, (200, 0, 200), "价税合计")
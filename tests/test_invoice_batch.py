@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""多文件输入：expand_pdf_inputs 的展开/去重/顺序，iter_batch_rows 的文件状态行和出错占位行"""
+
+import json
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+import invoice_core as core
+
+BOX = {"x1": 0.1, "y1": 0.1, "x2": 0.2, "y2": 0.2}
+
+
+def touch(path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"%PDF")
+    return path
+
+
+def test_expand_pdf_inputs(tmp_path):
+    a = touch(tmp_path / "a.pdf")
+    touch(tmp_path / "dir" / "sub" / "c.PDF")
+    touch(tmp_path / "dir" / "b.pdf")
+    touch(tmp_path / "dir" / "notes.txt")
+    got = core.expand_pdf_inputs([str(a), str(tmp_path / "dir"), str(tmp_path / "*.pdf")])
+    assert [Path(p).relative_to(tmp_path).as_posix() for p in got] == ["a.pdf", "dir/b.pdf", "dir/sub/c.PDF"]
+
+
+def test_expand_pdf_inputs_recursive_glob(tmp_path):
+    touch(tmp_path / "x" / "y" / "d.pdf")
+    touch(tmp_path / "x" / "e.txt")
+    got = core.expand_pdf_inputs([str(tmp_path / "**" / "*.pdf")])
+    assert [Path(p).name for p in got] == ["d.pdf"]
+
+
+def test_expand_pdf_inputs_missing(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        core.expand_pdf_inputs([str(tmp_path / "nope.pdf")])
+
+
+class FakeDoc:
+    PAGES = {"a.pdf": 3, "c.pdf": 1}
+
+    def __init__(self, path):
+        name = Path(path).name
+        if name not in self.PAGES:
+            raise RuntimeError("cannot open")
+        self.n = self.PAGES[name]
+
+    def __len__(self):
+        return self.n
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        pass
+
+
+def fake_pages_rows(doc, pages, pdf_path, cfg, engine, opts, **kw):
+    if Path(pdf_path).name == "c.pdf":
+        raise ValueError("bad page")
+    return [core.make_row(pdf_path, i, {"invoice_no": f"{i:020d}", "invoice_date": "20240101",
+                                        "total_amount": "1.00"}) for i in pages]
+
+
+def test_iter_batch_rows_status_rows(tmp_path, monkeypatch):
+    cfg = tmp_path / "roi.json"
+    cfg.write_text(json.dumps({"dpi": 300, "invoice_no": BOX, "invoice_date": BOX, "total_amount": BOX}),
+                   encoding="utf-8")
+    monkeypatch.setattr(core, "fitz", SimpleNamespace(open=FakeDoc))
+    monkeypatch.setattr(core, "extract_pages_rows", fake_pages_rows)
+    monkeypatch.setattr(core, "engine_memory", lambda engine: {})
+    progress = []
+
+    rows = list(core.iter_batch_rows(["a.pdf", "b.pdf", "c.pdf"], roi_config=str(cfg), batch_size=2,
+                                     engine=object(), progress_hook=lambda cur, total: progress.append((cur, total))))
+    summary = [(r["文件名"], r["页码"], r["状态"]) for r in rows]
+    assert summary == [
+        ("a.pdf", 1, None), ("a.pdf", 2, None), ("a.pdf", 3, None), ("a.pdf", None, "完成：3页"),
+        ("b.pdf", None, "失败：RuntimeError: cannot open"),
+        ("c.pdf", 1, "失败：ValueError: bad page"), ("c.pdf", None, "部分失败：1/1页"),
+    ]
+    assert progress[-1] == (4, 4)
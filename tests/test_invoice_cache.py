@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""ResultCache：命中/未命中、LRU淘汰、改ROI只让该字段失效、失败字段不缓存"""
+
+import itertools
+
+import pytest
+
+import invoice_cache
+import invoice_core as core
+from invoice_cache import ResultCache
+
+BOX = {"x1": 0.1, "y1": 0.1, "x2": 0.2, "y2": 0.2}
+CFG = {"dpi": 300, "rotate": "0", "invoice_no": BOX, "invoice_date": BOX, "total_amount": BOX}
+
+
+class FakeClock:
+    """每次调用时间加一秒，LRU顺序不受系统时钟精度影响"""
+
+    def __init__(self):
+        self._t = itertools.count(1)
+
+    def time(self):
+        return float(next(self._t))
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(invoice_cache, "time", FakeClock())
+    c = ResultCache(tmp_path / "cache.sqlite", max_entries=2)
+    yield c
+    c.close()
+
+
+def test_hit_and_miss(cache):
+    cache.put_many({"a": {"value": "1", "source": "ocr"}})
+    assert cache.get_many(["a", "b"]) == {"a": {"value": "1", "source": "ocr"}}
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.take_stats() == {"hits": 1, "misses": 1}
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
+def test_entries_survive_reopen(tmp_path):
+    path = tmp_path / "cache.sqlite"
+    c = ResultCache(path)
+    c.put_many({"a": {"value": "1", "source": "text"}})
+    c.close()
+    c = ResultCache(path)
+    assert c.get_many(["a"]) == {"a": {"value": "1", "source": "text"}}
+    c.close()
+
+
+def test_lru_evicts_least_recently_used(cache):
+    cache.put_many({"a": {"value": "1"}})
+    cache.put_many({"b": {"value": "2"}})
+    cache.get_many(["a"])          # a 比 b 新，命中时间随下一次写入写回
+    cache.put_many({"c": {"value": "3"}})
+    cache.evict()
+    assert set(cache.get_many(["a", "b", "c"])) == {"a", "c"}
+
+
+def test_hit_refresh_written_on_close(tmp_path, monkeypatch):
+    monkeypatch.setattr(invoice_cache, "time", FakeClock())
+    path = tmp_path / "cache.sqlite"
+    c = ResultCache(path, max_entries=1)
+    c.put_many({"a": {"value": "1"}, "b": {"value": "2"}})
+    c.get_many(["a"])
+    c.close()
+    c = ResultCache(path, max_entries=1)
+    c.evict()
+    assert set(c.get_many(["a", "b"])) == {"a"}
+    c.close()
+
+
+def test_roi_edit_invalidates_only_that_field(monkeypatch):
+    monkeypatch.setattr(core, "page_content_hash", lambda doc, page_index: "page")
+    opts = core.resolve_options(CFG)
+    before = core.page_cache_keys(None, 0, CFG, opts)
+    moved = {**CFG, "total_amount": {**BOX, "x2": 0.3}}
+    after = core.page_cache_keys(None, 0, moved, opts)
+    assert after["invoice_no"] == before["invoice_no"]
+    assert after["invoice_date"] == before["invoice_date"]
+    assert after["total_amount"] != before["total_amount"]
+
+
+def test_schema_version_invalidates_all_fields(monkeypatch):
+    monkeypatch.setattr(core, "page_content_hash", lambda doc, page_index: "page")
+    opts = core.resolve_options(CFG)
+    before = core.page_cache_keys(None, 0, CFG, opts)
+    monkeypatch.setattr(core, "RESULT_SCHEMA_VERSION", core.RESULT_SCHEMA_VERSION + 1)
+    after = core.page_cache_keys(None, 0, CFG, opts)
+    assert all(after[f] != before[f] for f in core.ROI_FIELDS)
+
+
+def test_failed_fields_are_not_cached(cache):
+    keys = {"invoice_no": "k_no", "invoice_date": "k_date", "total_amount": "k_amt"}
+    values = {"invoice_no": "1" * 20, "invoice_date": None, "total_amount": "12.30"}
+    sources = {"invoice_no": "ocr", "invoice_date": "ocr", "total_amount": "ocr"}
+    core.store_fields(cache, keys, values, sources, cached={"total_amount"})
+    assert cache.get_many(keys.values()) == {"k_no": {"value": "1" * 20, "source": "ocr"}}
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""RoiDedup / 重复票号：表有上限（LRU），近似匹配的分段索引不漏掉距离内的哈希"""
+
+import random
+from collections import OrderedDict
+
+import invoice_core as core
+
+
+class Bits(bytes):
+    def tobytes(self):
+        return bytes(self)
+
+
+def hamming(a: bytes, b: bytes) -> int:
+    return sum(bin(x ^ y).count("1") for x, y in zip(a, b))
+
+
+def test_exact_table_is_lru_capped():
+    dedup = core.RoiDedup(max_entries=2)
+    dedup.put("invoice_no", (b"a", None), "A")
+    dedup.put("invoice_no", (b"b", None), "B")
+    assert dedup.get("invoice_no", (b"a", None)) == "A"   # a 变成最近使用
+    dedup.put("invoice_no", (b"c", None), "C")
+    assert dedup.get("invoice_no", (b"b", None)) is None
+    assert dedup.get("invoice_no", (b"a", None)) == "A"
+    assert len(dedup.exact) == 2
+    assert dedup.hits == {"exact": 2, "near": 0} and dedup.misses == 1
+
+
+def test_bands_share_a_band_within_distance():
+    rng = random.Random(0)
+    for d in (1, 2, 4, 8):
+        dedup = core.RoiDedup(max_distance=d)
+        for _ in range(200):
+            a = bytes(rng.randrange(256) for _ in range(16))
+            b = bytearray(a)
+            for bit in rng.sample(range(128), rng.randint(0, d)):
+                b[bit // 8] ^= 1 << (bit % 8)
+            assert hamming(a, bytes(b)) <= d
+            assert set(dedup._bands("f", Bits(a))) & set(dedup._bands("f", Bits(bytes(b))))
+
+
+def test_bands_fall_back_to_one_bucket_for_short_hashes():
+    dedup = core.RoiDedup(max_distance=20)
+    assert dedup._bands("f", Bits(b"\x00" * 16)) == [("f", 16, -1, b"")]
+
+
+def test_duplicate_window_is_capped():
+    rows = [{"票号20位": no, "文件名": "a.pdf", "页码": i + 1} for i, no in enumerate(["1", "2", "1", "3", "2"])]
+    seen = OrderedDict()
+    out = list(core.flag_duplicate_invoices(rows, seen, max_entries=2))
+    # 第3行命中后“1”变成最近使用，第4行挤掉的是“2”，所以第5行不再标重复
+    assert [r["重复票号"] for r in out] == [None, None, "a.pdf 第1页", None, None]
+    assert len(seen) == 2
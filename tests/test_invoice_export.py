@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""流式导出：csv/jsonl 在 flush() 之后、close() 之前就能读出已写的行"""
+
+import csv
+import json
+
+import invoice_core as core
+
+
+def row(page):
+    return {"页码": page, "发票号码": f"{page:020d}", "开票日期": "20240101", "价税合计": "1.00"}
+
+
+def test_csv_readable_after_flush(tmp_path):
+    w = core.RowStreamWriter(tmp_path / "out.csv")
+    w.write(row(1))
+    w.write(row(2))
+    w.flush()
+    with open(w.path, encoding="utf-8-sig", newline="") as fh:
+        lines = list(csv.reader(fh))
+    assert lines[0] == w.cols
+    assert [r[lines[0].index("页码")] for r in lines[1:]] == ["1", "2"]
+    w.close()
+
+
+def test_jsonl_readable_after_flush(tmp_path):
+    w = core.RowStreamWriter(tmp_path / "out.jsonl")
+    w.write(row(1))
+    w.flush()
+    lines = w.path.read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["页码"] for line in lines] == [1]
+    w.close()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""PageJournal 续跑：半行恢复、tag 不一致作废、按页码并回；journal_tag 覆盖影响结果的选项"""
+
+import json
+
+import invoice_core as core
+from invoice_journal import PageJournal
+
+BOX = {"x1": 0.1, "y1": 0.1, "x2": 0.2, "y2": 0.2}
+
+
+def make_pdf(tmp_path, name="a.pdf", size=100):
+    p = tmp_path / name
+    p.write_bytes(b"x" * size)
+    return str(p)
+
+
+def row(page):
+    return {"页码": page + 1, "发票号码": f"{page:020d}"}
+
+
+def test_resume_skips_torn_last_line(tmp_path):
+    pdf, path = make_pdf(tmp_path), tmp_path / "out.journal.jsonl"
+    j = PageJournal(path, tag="t")
+    j.record(pdf, 0, row(0))
+    j.record(pdf, 1, row(1))
+    j.close()
+    text = path.read_text(encoding="utf-8")
+    path.write_text(text[:-10], encoding="utf-8")   # 最后一行只写了一半
+
+    j = PageJournal(path, resume=True, tag="t")
+    assert j.done_pages(pdf) == {0: row(0)}
+    j.record(pdf, 1, row(1))
+    j.close()
+    j = PageJournal(path, resume=True, tag="t")
+    assert j.done_pages(pdf) == {0: row(0), 1: row(1)}
+    j.close()
+
+
+def test_tag_mismatch_discards_records(tmp_path):
+    pdf, path = make_pdf(tmp_path), tmp_path / "out.journal.jsonl"
+    j = PageJournal(path, tag="old")
+    j.record(pdf, 0, row(0))
+    j.close()
+    j = PageJournal(path, resume=True, tag="new")
+    assert j.stale and j.done_pages(pdf) == {}
+    j.close()
+    assert json.loads(path.read_text(encoding="utf-8").splitlines()[0]) == {"tag": "new"}
+
+
+def test_torn_header_is_stale(tmp_path):
+    pdf, path = make_pdf(tmp_path), tmp_path / "out.journal.jsonl"
+    rec = json.dumps({"pdf": "x", "size": 100, "page": 0, "row": row(0)})
+    path.write_text('{"tag": "t\n' + rec + "\n", encoding="utf-8")
+    j = PageJournal(path, resume=True, tag="t")
+    assert j.stale and j.done_pages(pdf) == {}
+    j.close()
+
+
+def test_replaced_pdf_is_not_resumed(tmp_path):
+    pdf, path = make_pdf(tmp_path), tmp_path / "out.journal.jsonl"
+    j = PageJournal(path, tag="t")
+    j.record(pdf, 0, row(0))
+    j.close()
+    make_pdf(tmp_path, size=200)
+    j = PageJournal(path, resume=True, tag="t")
+    assert j.done_pages(pdf) == {}
+    j.close()
+
+
+def test_merge_resumed_keeps_page_order():
+    resumed = {0: row(0), 2: row(2), 5: row(5)}
+    merged = list(core.merge_resumed(iter([row(1), row(3), row(4)]), resumed))
+    assert [r["页码"] for r in merged] == [1, 2, 3, 4, 5, 6]
+    assert [r["页码"] for r in core.merge_resumed(iter([]), resumed)] == [1, 3, 6]
+
+
+def test_journal_tag_covers_result_options(tmp_path):
+    cfg = tmp_path / "roi.json"
+    cfg.write_text(json.dumps({"dpi": 300, "invoice_no": BOX, "invoice_date": BOX, "total_amount": BOX}),
+                   encoding="utf-8")
+    base = core.journal_tag(str(cfg))
+    assert core.journal_tag(str(cfg)) == base
+    for changed in (dict(text_layer=True), dict(render_mode="clip"), dict(color_mode="gray"),
+                    dict(auto_rotate=True), dict(batch_size=8), dict(adaptive=core.AdaptiveDpi()),
+                    dict(dedup=core.RoiDedup())):
+        assert core.journal_tag(str(cfg), **changed) != base, changed
+    cfg.write_text(json.dumps({"dpi": 200, "invoice_no": BOX, "invoice_date": BOX, "total_amount": BOX}),
+                   encoding="utf-8")
+    assert core.journal_tag(str(cfg)) != base
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""多版式：版式没有锚点时缓存键照常生成；自适应DPI档位和OCR策略链按本页版式的配置取"""
+
+import json
+
+import invoice_core as core
+from invoice_cache import ResultCache
+
+BOX = {"x1": 0.1, "y1": 0.1, "x2": 0.2, "y2": 0.2}
+ANCHOR = {"x1": 0.0, "y1": 0.0, "x2": 0.1, "y2": 0.1, "template": "AAAA", "dpi": 100}
+
+
+def write_config(path, **extra):
+    cfg = {"dpi": 300, "rotate": "0", "invoice_no": BOX, "invoice_date": BOX, "total_amount": BOX, **extra}
+    path.write_text(json.dumps(cfg), encoding="utf-8")
+    return path
+
+
+def test_cache_keys_for_anchorless_profile(tmp_path, monkeypatch):
+    write_config(tmp_path / "plain.json", dpi=200)
+    base = write_config(tmp_path / "roi.json", anchor=ANCHOR,
+                        profiles={"plain": {"config": "plain.json", "match": {"page_size": [210, 297]}}})
+    cfg = core.load_roi_config(base)
+    plain = cfg["profiles"]["plain"]
+    assert "anchor" not in plain and plain["dpi"] == 200
+
+    opts = core.resolve_options(cfg)
+    assert opts["anchor"] is True
+    monkeypatch.setattr(core, "page_content_hash", lambda doc, page_index: "page")
+    base_keys = core.page_cache_keys(None, 0, cfg, opts)
+    plain_keys = core.page_cache_keys(None, 0, plain, opts)
+    assert set(base_keys.values()).isdisjoint(plain_keys.values())
+
+    cache = ResultCache(tmp_path / "cache.sqlite")
+    cache.put_many({plain_keys["invoice_no"]: {"value": "1" * 20, "source": "ocr"}})
+    assert cache.get_many(plain_keys.values()) == {plain_keys["invoice_no"]: {"value": "1" * 20, "source": "ocr"}}
+    assert cache.get_many(base_keys.values()) == {}
+    cache.close()
+
+
+def test_profile_tiers_and_strategies(tmp_path):
+    write_config(tmp_path / "plain.json", dpi=200, dpi_tiers=[100, 200], ocr_strategies={"invoice_no": ["det_rec"]})
+    cfg = core.load_roi_config(write_config(tmp_path / "roi.json", profiles={"plain": {"config": "plain.json"}}))
+    plain = cfg["profiles"]["plain"]
+
+    adaptive = core.AdaptiveDpi().configure(cfg)
+    assert adaptive.tiers_for("invoice_no", cfg) == [150, 200, 300]
+    assert adaptive.tiers_for("invoice_no", plain) == [100, 200]
+
+    strategies = core.OcrStrategyChain().configure(cfg)
+    assert strategies.order("invoice_no", plain) == ["det_rec"]
+    assert strategies.order("invoice_no", cfg)[0] == "rec"
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""票号校验回归：只识别多读一位（21位）时不能截成20位当作通过"""
+
+import invoice_core as core
+
+
+class FakeRoi:
+    size = 1
+
+
+def test_invoice_no_validator_rejects_21_digits():
+    validate = core.FIELD_VALIDATORS["invoice_no"]
+    assert validate("164534732022888057663") is None
+    assert validate("139441177151620466610 1") is None
+    assert validate("1394411771516204661") is None
+    assert validate("No. 1394 4117 7151 6204 6610") == "13944117715162046610"
+
+
+def test_chain_falls_through_on_21_digit_rec(monkeypatch):
+    texts = {"rec": "139441177151620466610", "det_rec": "13944117715162046610"}
+    monkeypatch.setattr(core, "run_strategy", lambda engine, name, field, roi, retry=False: texts.get(name, ""))
+    strategies = core.OcrStrategyChain()
+    assert core.ocr_field(None, "invoice_no", FakeRoi(), strategies=strategies) == "13944117715162046610"
+    assert strategies.stats["invoice_no"]["rec"] == [1, 0]
+
+
+class FakeClip:
+    def __init__(self, dpi):
+        self.dpi = dpi
+        self.size = dpi
+
+
+def test_adaptive_dpi_escalates_on_21_digit_low_tier(monkeypatch):
+    # 150dpi 多读一位（截前20位就是错号），300dpi 读对：必须升档而不是接受低档
+    reads = {150: "136062616541111664992", 200: "136062616541111664992", 300: "13606261654111664992"}
+    monkeypatch.setattr(core, "norm_box_to_page_rect", lambda page, box, rotate: None)
+    monkeypatch.setattr(core, "render_pdf_clip_to_bgr", lambda page, rect, dpi, gray=False: FakeClip(dpi))
+    monkeypatch.setattr(core, "rotate_img", lambda img, rotate: img)
+    monkeypatch.setattr(core, "deskew_img", lambda img, angle: img)
+    monkeypatch.setattr(core, "run_strategy", lambda engine, name, field, roi, retry=False: reads[roi.dpi])
+    box = {"x1": 0, "y1": 0, "x2": 1, "y2": 1}
+    cfg = {"dpi": 300, "rotate": "0", "invoice_no": box, "invoice_date": box, "total_amount": box}
+    adaptive = core.AdaptiveDpi().configure(cfg)
+    value, roi = core.ocr_field_adaptive([None], 0, cfg, None, "invoice_no", adaptive)
+    assert value == "13606261654111664992"
+    assert roi.dpi == 300
+    assert adaptive.resolved["invoice_no"] == {300: 1}